@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Renders the APV configuration of a loadbalancer as a list of objects
+    (virtual services, groups, reals, health checks and policies), each
+    with the commands that create and remove it, so that the objects can
+    be compared with a running config and repaired one by one, or pushed
+    in bulk.
+"""
+from collections import namedtuple
+import hashlib
+
+from array_neutron_lbaas.array.adc_device import ADCDevice
+from array_neutron_lbaas.array.apv_driver import VAPV_TRIFFIC_INTERFACE
+
+# key: unique name of the object, e.g. "virtual:<listener id>"
+# token: the Neutron ID that names the object on the APV
+# prefixes: the running config lines of the object start with one of these
+# commands: creates the object; undo: removes it
+# parents: keys of objects whose removal also removes this one
+ConfigObject = namedtuple(
+    "ConfigObject",
+    ["key", "token", "prefixes", "commands", "undo", "parents"]
+)
+
+
+def render_loadbalancer(lb, listener_bandwidth=0):
+    """ Returns the ConfigObjects of a loadbalancer in the order in which
+        they must be created (parents before their children).
+    """
+    objects = []
+    for listener in lb.listeners:
+        commands = [
+            ADCDevice.create_virtual_service(
+                listener.id, lb.vip_address, listener.protocol_port,
+                listener.protocol, listener.connection_limit
+            )
+        ]
+        if listener_bandwidth:
+            commands.append(ADCDevice.configure_virtual_service_bandwidth(
+                listener.id, listener_bandwidth
+            ))
+        objects.append(ConfigObject(
+            "virtual:" + listener.id, listener.id,
+            ("slb virtual ", "qos virtual "), commands,
+            [ADCDevice.no_virtual_service(listener.id, listener.protocol)],
+            ()
+        ))
+    for pool in lb.pools:
+        if pool.listener is None:
+            continue
+        sp_type = None
+        ck_name = None
+        if pool.session_persistence:
+            sp_type = pool.session_persistence.type
+            ck_name = pool.session_persistence.cookie_name
+        group_key = "group:" + pool.id
+        objects.append(ConfigObject(
+            group_key, pool.id, ("slb group method ",),
+            [ADCDevice.create_group(pool.id, pool.lb_algorithm, sp_type)],
+            [ADCDevice.no_group(pool.id)], ()
+        ))
+        for member in pool.members:
+            objects.append(ConfigObject(
+                "real:" + member.id, member.id,
+                ("slb real ", "slb group member "),
+                [
+                    ADCDevice.create_real_server(
+                        member.id, member.address, member.protocol_port,
+                        pool.protocol
+                    ),
+                    ADCDevice.add_rs_into_group(
+                        pool.id, member.id, member.weight
+                    )
+                ],
+                [ADCDevice.no_real_server(pool.protocol, member.id)],
+                (group_key,)
+            ))
+        hm = pool.healthmonitor
+        if hm:
+            objects.append(ConfigObject(
+                "health:" + hm.id, hm.id,
+                ("slb health ", "slb group health "),
+                [
+                    ADCDevice.create_health_monitor(
+                        hm.id, hm.type, hm.delay, hm.max_retries,
+                        hm.timeout, hm.http_method, hm.url_path,
+                        hm.expected_codes
+                    ),
+                    ADCDevice.attach_hm_to_group(pool.id, hm.id)
+                ],
+                [
+                    ADCDevice.detach_hm_to_group(pool.id, hm.id),
+                    ADCDevice.no_health_monitor(hm.id)
+                ],
+                (group_key,)
+            ))
+        listener = pool.listener
+        objects.append(ConfigObject(
+            "policy:" + listener.id, listener.id, ("slb policy ",),
+            [
+                ADCDevice.create_policy(
+                    listener.id, pool.id, pool.lb_algorithm, sp_type,
+                    ck_name
+                )
+            ],
+            [
+                ADCDevice.no_policy(
+                    listener.id, pool.lb_algorithm, sp_type
+                )
+            ],
+            ("virtual:" + listener.id, group_key)
+        ))
+    return objects
+
+
+def render_instance(data_ip=None, netmask=None, bandwidth=0,
+                    cluster_priority=None, vip_addresses=()):
+    """ Returns the commands of the settings of a vAPV instance that do not
+        belong to any loadbalancer: the address of its traffic interface,
+        its bandwidth allocation and, for a member of an HA pair, its
+        virtual cluster.
+    """
+    interface_name = VAPV_TRIFFIC_INTERFACE
+    commands = []
+    if data_ip:
+        commands.append(ADCDevice.configure_ip(interface_name, data_ip,
+                                               netmask))
+    if bandwidth:
+        commands.append(ADCDevice.configure_interface_bandwidth(
+            interface_name, bandwidth
+        ))
+    if cluster_priority is not None:
+        commands.append(
+            ADCDevice.cluster_config_virtual_interface(interface_name)
+        )
+        for vip_address in vip_addresses:
+            commands.append(
+                ADCDevice.cluster_config_vip(interface_name, vip_address)
+            )
+        commands.append(ADCDevice.cluster_config_priority(
+            interface_name, cluster_priority
+        ))
+        commands.append(ADCDevice.cluster_enable(interface_name))
+    return commands
+
+
+def split_lines(commands):
+    """ Returns the normalized single-line commands of a list of commands,
+        some of which may be several commands joined by "; ".
+    """
+    lines = []
+    for command in commands:
+        for line in command.split(";"):
+            line = " ".join(line.split())
+            if line:
+                lines.append(line)
+    return lines
+
+
+def find_lines(running_config, obj):
+    """ Returns the normalized lines of the running config that belong to
+        a ConfigObject.
+    """
+    lines = []
+    for line in running_config:
+        line = " ".join(line.split())
+        if line.startswith(obj.prefixes) and obj.token in line.split():
+            lines.append(line)
+    return lines
+
+
+def checksum(lines):
+    """ Returns a checksum of a set of config lines, independent of their
+        order.
+    """
+    return hashlib.sha1("\n".join(sorted(lines)).encode("utf-8")).hexdigest()
@@ -263,6 +263,11 @@ class ADCDevice(object):
         cmd = "cluster virtual vip %s 100 %s" % (interface_name, vip_address)
         return cmd
 
+    @staticmethod
+    def no_cluster_vip(interface_name, vip_address):
+        cmd = "no cluster virtual vip %s 100 %s" % (interface_name, vip_address)
+        return cmd
+
     @staticmethod
     def cluster_config_priority(interface_name, priority):
         cmd = "cluster virtual priority %s 100 %d" % (interface_name, priority)
@@ -284,6 +289,48 @@ class ADCDevice(object):
         return cmd
 
 
+    @staticmethod
+    def configure_interface_bandwidth(interface, bandwidth):
+        # bandwidth in Mbps
+        cmd = "qos interface %s %dM" % (interface, bandwidth)
+        return cmd
+
+    @staticmethod
+    def no_interface_bandwidth(interface):
+        cmd = "no qos interface %s" % interface
+        return cmd
+
+    @staticmethod
+    def configure_virtual_service_bandwidth(name, bandwidth):
+        # bandwidth in Mbps
+        cmd = "qos virtual %s %dM" % (name, bandwidth)
+        return cmd
+
+    @staticmethod
+    def no_virtual_service_bandwidth(name):
+        cmd = "no qos virtual %s" % name
+        return cmd
+
+    @staticmethod
+    def show_running_config():
+        cmd = "show running"
+        return cmd
+
+    @staticmethod
+    def show_virtual_service_statistics():
+        cmd = "show statistics slb virtual all"
+        return cmd
+
+    @staticmethod
+    def show_cpu_statistics():
+        cmd = "show statistics cpu"
+        return cmd
+
+    @staticmethod
+    def show_interface_statistics(interface):
+        cmd = "show statistics interface %s" % interface
+        return cmd
+
     @staticmethod
     def write_memory():
         cmd = "write memory"
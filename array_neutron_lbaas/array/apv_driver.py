@@ -10,22 +10,201 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from collections import deque
+from functools import partial
 import json
+import re
 import requests
+from threading import Condition, Lock, Thread
 import time
 
 import six
 
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from array_neutron_lbaas.array import exceptions as driver_except
 from array_neutron_lbaas.array.adc_device import ADCDevice
+from array_neutron_lbaas.concurrency import ParallelExecutionError
+from array_neutron_lbaas.concurrency import run_in_parallel
 
 LOG = logging.getLogger(__name__)
 
 VAPV_TRIFFIC_INTERFACE="port2"
 VAPV_REST_USERNAME="restapi"
 VAPV_REST_PASSWORD="click1"
+# Number of CLI commands sent in one request by run_commands
+CLI_BATCH_SIZE=100
+# Cluster priorities of the members of an HA pair; the higher one owns
+# the cluster VIPs while it is up
+CLUSTER_PRIORITY_PRIMARY=200
+CLUSTER_PRIORITY_SECONDARY=100
+# Seconds that a write waits for the instances required by the
+# write_policy, as long as run_cli_extend retries an instance
+WRITE_TIMEOUT=600
+# Seconds between reports of the queued writes of an unavailable instance
+WRITE_LAG_REPORT_INTERVAL=60
+
+# Counters in the output of the statistics commands
+CURRENT_CONNECTIONS_PATTERN = re.compile(
+    r"current\s+connections?\s*[:=]?\s*(\d+)", re.IGNORECASE)
+BYTES_IN_PATTERN = re.compile(
+    r"(?:input|received|rx)\s+bytes\s*[:=]?\s*(\d+)", re.IGNORECASE)
+BYTES_OUT_PATTERN = re.compile(
+    r"(?:output|sent|tx)\s+bytes\s*[:=]?\s*(\d+)", re.IGNORECASE)
+CPU_UTILIZATION_PATTERN = re.compile(
+    r"cpu\s+(?:utilization|usage)\s*[:=]?\s*(\d+(?:\.\d+)?)\s*%",
+    re.IGNORECASE)
+
+
+def _sum_counters(pattern, output):
+    return sum(int(value) for value in pattern.findall(output))
+
+
+class WriteAcks(object):
+    """ Records the instances that have applied a write, and those that
+        failed to.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.applied = set()
+        self.failed = {}
+        self.condition = Condition()
+
+    def add(self, base_rest_url):
+        with self.condition:
+            self.applied.add(base_rest_url)
+            self.condition.notify_all()
+
+    def fail(self, base_rest_url, error):
+        with self.condition:
+            self.failed[base_rest_url] = error
+            self.condition.notify_all()
+
+    def wait(self, required, timeout, primary=None):
+        """ Returns whether required instances, including primary if
+            given, applied the write within timeout seconds. Raises the
+            error of an instance whose failure means they cannot.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if primary in self.failed:
+                    raise self.failed[primary]
+                if len(self.applied) >= required and \
+                        (primary is None or primary in self.applied):
+                    return True
+                if self.total - len(self.failed) < required:
+                    raise list(self.failed.values())[0]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+
+class InstanceWriter(object):
+    """ Applies the writes to one vAPV instance in order, in a thread of
+        its own, under the PRIMARY and QUORUM write policies. Writes that
+        the instance cannot apply, e.g. while it is down, stay queued and
+        are retried until it comes back; lag() is the age of the oldest.
+    """
+    def __init__(self, base_rest_url):
+        self.base_rest_url = base_rest_url
+        self.api = ArrayAPVAPIDriver([])
+        self.entries = deque()
+        self.lock = Lock()
+        self.thread = None
+
+    def submit(self, commands, acks):
+        with self.lock:
+            if len(self.entries) >= cfg.CONF.lbaas_settings.write_queue_max:
+                LOG.error("Instance %s is too far behind; dropping its %d "
+                          "queued writes. Resync it.",
+                          self.base_rest_url, len(self.entries))
+                error = driver_except.TimeOutException()
+                for dropped in self.entries:
+                    dropped[2].fail(self.base_rest_url, error)
+                self.entries.clear()
+            self.entries.append((time.time(), commands, acks))
+            if self.thread is None:
+                self.thread = Thread(target=self._run,
+                                     name="vapv-writer " + self.base_rest_url)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def pending(self):
+        with self.lock:
+            return len(self.entries)
+
+    def lag(self):
+        """ Returns the seconds for which the oldest queued write has been
+            waiting, 0 if none is.
+        """
+        with self.lock:
+            if not self.entries:
+                return 0
+            return time.time() - self.entries[0][0]
+
+    def _run(self):
+        failed_since = None
+        reported_at = 0
+        while True:
+            with self.lock:
+                if not self.entries:
+                    self.thread = None
+                    return
+                entry = self.entries[0]
+            queued_at, commands, acks = entry
+            try:
+                for cmd in commands:
+                    self.api.run_cli_extend(self.base_rest_url, cmd,
+                                            conn_max_retries=1)
+            except driver_except.TimeOutException:
+                # run_cli_extend has waited before giving up
+                if failed_since is None:
+                    failed_since = queued_at
+                if time.time() - reported_at >= WRITE_LAG_REPORT_INTERVAL:
+                    reported_at = time.time()
+                    LOG.warning("Instance %s is unavailable: %d writes "
+                                "queued, %d seconds behind.",
+                                self.base_rest_url, self.pending(),
+                                self.lag())
+                continue
+            except Exception as e:
+                # The instance is up but the write cannot be applied, so
+                # retrying it would only hold up the writes behind it
+                LOG.error("Error writing %s to instance %s: %s",
+                          commands, self.base_rest_url, e)
+                self._pop(entry)
+                acks.fail(self.base_rest_url, e)
+                continue
+            caught_up = self._pop(entry)
+            acks.add(self.base_rest_url)
+            if failed_since is not None and caught_up:
+                LOG.info("Instance %s caught up after %d seconds.",
+                         self.base_rest_url, time.time() - failed_since)
+                failed_since = None
+
+    def _pop(self, entry):
+        # Returns whether the queue is empty afterwards
+        with self.lock:
+            if self.entries and self.entries[0] is entry:
+                self.entries.popleft()
+            return not self.entries
+
+
+_instance_writers = {}
+_instance_writers_lock = Lock()
+
+
+def get_instance_writer(base_rest_url):
+    with _instance_writers_lock:
+        writer = _instance_writers.get(base_rest_url)
+        if writer is None:
+            writer = _instance_writers[base_rest_url] = InstanceWriter(
+                base_rest_url)
+        return writer
+
 
 
 class ArrayAPVAPIDriver(object):
@@ -46,6 +225,9 @@ class ArrayAPVAPIDriver(object):
 
         # create vip
         self._create_vip(argu['vip_address'], argu['netmask'])
+        # A new instance's bandwidth allocation, if any, comes with it
+        if argu.get('bandwidth'):
+            self.set_instance_bandwidth(argu)
 
 
     def delete_loadbalancer(self, argu):
@@ -84,6 +266,64 @@ class ArrayAPVAPIDriver(object):
                        )
 
 
+    def set_instance_bandwidth(self, argu):
+        """ Limits the traffic interface to argu['bandwidth'] Mbps;
+            0 removes the limit.
+        """
+        if argu['bandwidth']:
+            cmd_apv_qos = ADCDevice.configure_interface_bandwidth(
+                VAPV_TRIFFIC_INTERFACE, argu['bandwidth'])
+        else:
+            cmd_apv_qos = ADCDevice.no_interface_bandwidth(
+                VAPV_TRIFFIC_INTERFACE)
+        self._write([cmd_apv_qos])
+
+
+    def set_listener_bandwidth(self, argu):
+        """ Limits the virtual service of a listener to argu['bandwidth']
+            Mbps; 0 removes the limit.
+        """
+        if argu['bandwidth']:
+            cmd_apv_qos = ADCDevice.configure_virtual_service_bandwidth(
+                argu['listener_id'], argu['bandwidth'])
+        else:
+            cmd_apv_qos = ADCDevice.no_virtual_service_bandwidth(
+                argu['listener_id'])
+        self._write([cmd_apv_qos])
+
+
+    def configure_cluster(self, argu):
+        """ Makes the instances members of the virtual cluster of the
+            traffic interface with priority argu['priority'], owning the
+            VIPs in argu['vip_addresses'], and enables the cluster.
+        """
+        interface_name = VAPV_TRIFFIC_INTERFACE
+        commands = [ADCDevice.cluster_config_virtual_interface(interface_name)]
+        for vip_address in argu['vip_addresses']:
+            commands.append(ADCDevice.cluster_config_vip(interface_name,
+                                                         vip_address))
+        commands.append(ADCDevice.cluster_config_priority(interface_name,
+                                                          argu['priority']))
+        commands.append(ADCDevice.cluster_enable(interface_name))
+        self.run_commands({'commands': commands})
+
+
+    def add_cluster_vip(self, argu):
+        """ Adds argu['vip_address'] to the VIPs of the virtual cluster """
+        cmd_apv_cluster_vip = ADCDevice.cluster_config_vip(
+            VAPV_TRIFFIC_INTERFACE, argu['vip_address'])
+        self._write([cmd_apv_cluster_vip])
+
+
+    def delete_cluster_vip(self, argu):
+        """ Removes argu['vip_address'] from the VIPs of the virtual
+            cluster
+        """
+        cmd_apv_no_cluster_vip = ADCDevice.no_cluster_vip(
+            VAPV_TRIFFIC_INTERFACE, argu['vip_address'])
+        self._write([cmd_apv_no_cluster_vip])
+
+
     def _create_vip(self, vip_address, netmask):
         """ create vip"""
 
@@ -91,8 +331,7 @@ class ArrayAPVAPIDriver(object):
         # configure vip
         LOG.debug("Configure the vip address into interface")
         cmd_apv_config_ip = ADCDevice.configure_ip(interface_name, vip_address, netmask)
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_config_ip)
+        self._write([cmd_apv_config_ip])
 
 
     def _delete_vip(self):
@@ -100,8 +339,7 @@ class ArrayAPVAPIDriver(object):
 
         LOG.debug("no the vip address into interface")
         cmd_apv_no_ip = ADCDevice.no_ip(interface_name)
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_no_ip)
+        self._write([cmd_apv_no_ip])
 
 
     def _create_vs(self,
@@ -118,8 +356,7 @@ class ArrayAPVAPIDriver(object):
                                                              protocol,
                                                              connection_limit
                                                             )
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_create_vs)
+        self._write([cmd_apv_create_vs])
 
 
     def _delete_vs(self, listener_id, protocol):
@@ -127,8 +364,7 @@ class ArrayAPVAPIDriver(object):
                                                      listener_id,
                                                      protocol
                                                     )
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_no_vs)
+        self._write([cmd_apv_no_vs])
 
 
     def _create_policy(self,
@@ -147,8 +383,7 @@ class ArrayAPVAPIDriver(object):
                                                         cookie_name
                                                        )
 
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_create_policy)
+        self._write([cmd_apv_create_policy])
 
 
     def _delete_policy(self, listener_id, session_persistence_type, lb_algorithm):
@@ -158,8 +393,7 @@ class ArrayAPVAPIDriver(object):
                                                 lb_algorithm,
                                                 session_persistence_type
                                                )
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_no_policy)
+        self._write([cmd_apv_no_policy])
 
 
     def create_pool(self, argu):
@@ -169,8 +403,7 @@ class ArrayAPVAPIDriver(object):
             LOG.error("In create_pool, it should not pass the None.")
 
         cmd_apv_create_group = ADCDevice.create_group(argu['pool_id'], argu['lb_algorithm'], argu['session_persistence_type'])
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_create_group)
+        self._write([cmd_apv_create_group])
 
         # create policy
         self._create_policy(argu['pool_id'],
@@ -195,8 +428,7 @@ class ArrayAPVAPIDriver(object):
                            )
 
         cmd_apv_no_group = ADCDevice.no_group(argu['pool_id'])
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_no_group)
+        self._write([cmd_apv_no_group])
 
 
     def create_member(self, argu):
@@ -217,9 +449,7 @@ class ArrayAPVAPIDriver(object):
                                                                argu['member_id'],
                                                                argu['member_weight']
                                                                )
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_create_real_server)
-            self.run_cli_extend(base_rest_url, cmd_apv_add_rs_into_group)
+        self._write([cmd_apv_create_real_server, cmd_apv_add_rs_into_group])
 
 
     def delete_member(self, argu):
@@ -230,8 +460,7 @@ class ArrayAPVAPIDriver(object):
 
         cmd_apv_no_rs = ADCDevice.no_real_server(argu['protocol'], argu['member_id'])
 
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_no_rs)
+        self._write([cmd_apv_no_rs])
 
 
     def create_health_monitor(self, argu):
@@ -251,9 +480,7 @@ class ArrayAPVAPIDriver(object):
                                                            )
 
         cmd_apv_attach_hm = ADCDevice.attach_hm_to_group(argu['pool_id'], argu['hm_id'])
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_create_hm)
-            self.run_cli_extend(base_rest_url, cmd_apv_attach_hm)
+        self._write([cmd_apv_create_hm, cmd_apv_attach_hm])
 
 
     def delete_health_monitor(self, argu):
@@ -264,26 +491,129 @@ class ArrayAPVAPIDriver(object):
         cmd_apv_detach_hm = ADCDevice.detach_hm_to_group(argu['pool_id'], argu['hm_id'])
 
         cmd_apv_no_hm = ADCDevice.no_health_monitor(argu['hm_id'])
-        for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_detach_hm)
-            self.run_cli_extend(base_rest_url, cmd_apv_no_hm)
+        self._write([cmd_apv_detach_hm, cmd_apv_no_hm])
 
 
     def write_memory(self, argu):
         cmd_apv_write_memory = ADCDevice.write_memory()
+        self._write([cmd_apv_write_memory])
+
+
+    def run_commands(self, argu):
+        """ Runs argu['commands'], a list of CLI commands, in order. The
+            commands are sent CLI_BATCH_SIZE lines per request.
+        """
+        commands = argu['commands']
+        self._write([
+            "\n".join(commands[start:start + CLI_BATCH_SIZE])
+            for start in six.moves.xrange(0, len(commands), CLI_BATCH_SIZE)
+        ])
+
+
+    def _write(self, commands):
+        """ Runs commands, a list of CLI commands, in order on the
+            instances, and returns when the write_policy is satisfied.
+        """
+        write_policy = cfg.CONF.lbaas_settings.write_policy
+        if write_policy == "ALL":
+            if len(self.base_rest_urls) == 1:
+                self._run_all(self.base_rest_urls[0], commands)
+            else:
+                try:
+                    run_in_parallel([
+                        partial(self._run_all, base_rest_url, commands)
+                        for base_rest_url in self.base_rest_urls
+                    ])
+                except ParallelExecutionError as e:
+                    raise [error for error in e.errors if error is not None][0]
+            return
+        if write_policy == "PRIMARY":
+            # Only the primary's own ack counts
+            required = 1
+            primary = self.base_rest_urls[0]
+        else:
+            required = len(self.base_rest_urls) // 2 + 1
+            primary = None
+        # Each instance's writer applies its writes in order, so a lagging
+        # instance is only caught up after what it missed
+        acks = WriteAcks(len(self.base_rest_urls))
         for base_rest_url in self.base_rest_urls:
-            self.run_cli_extend(base_rest_url, cmd_apv_write_memory)
-
-
-    def run_cli_extend(self, base_rest_url, cmd):
+            get_instance_writer(base_rest_url).submit(commands, acks)
+        if not acks.wait(required, WRITE_TIMEOUT, primary):
+            LOG.error("Write not acknowledged by %(required)d of "
+                      "%(total)d instances: %(cmd)s",
+                      {'required': required,
+                       'total': len(self.base_rest_urls),
+                       'cmd': commands})
+            raise driver_except.TimeOutException()
+
+
+    def _run_all(self, base_rest_url, commands):
+        for cmd in commands:
+            self.run_cli_extend(base_rest_url, cmd)
+
+
+    def get_running_config(self, conn_max_retries=1):
+        """ Returns the running config of the first instance that answers,
+            or None if none does.
+        """
+        cmd_apv_show_running = ADCDevice.show_running_config()
+        for base_rest_url in self.base_rest_urls:
+            try:
+                return self.run_cli_extend(base_rest_url,
+                    cmd_apv_show_running, conn_max_retries).text
+            except (driver_except.TimeOutException,
+                    driver_except.CommandRejectedException):
+                continue
+        return None
+
+
+    def get_statistics(self, conn_max_retries=1):
+        """ Returns the current connections of all virtual services, the
+            byte counters of the traffic interface and the CPU utilization
+            (percent, None if not reported), read from the first instance
+            that answers, or None if none does.
+        """
+        cmd_apv_show_vs = ADCDevice.show_virtual_service_statistics()
+        cmd_apv_show_interface = ADCDevice.show_interface_statistics(
+            VAPV_TRIFFIC_INTERFACE)
+        cmd_apv_show_cpu = ADCDevice.show_cpu_statistics()
+        for base_rest_url in self.base_rest_urls:
+            try:
+                vs_output = self.run_cli_extend(base_rest_url,
+                    cmd_apv_show_vs, conn_max_retries).text
+                interface_output = self.run_cli_extend(base_rest_url,
+                    cmd_apv_show_interface, conn_max_retries).text
+                cpu_output = self.run_cli_extend(base_rest_url,
+                    cmd_apv_show_cpu, conn_max_retries).text
+            except (driver_except.TimeOutException,
+                    driver_except.CommandRejectedException):
+                continue
+            cpu_values = [
+                float(value)
+                for value in CPU_UTILIZATION_PATTERN.findall(cpu_output)
+            ]
+            return {
+                "connections": _sum_counters(CURRENT_CONNECTIONS_PATTERN,
+                                             vs_output),
+                "bytes_in": _sum_counters(BYTES_IN_PATTERN, interface_output),
+                "bytes_out": _sum_counters(BYTES_OUT_PATTERN,
+                                           interface_output),
+                "cpu": max(cpu_values) if cpu_values else None,
+            }
+        return None
+
+
+    def run_cli_extend(self, base_rest_url, cmd, conn_max_retries=60):
         url = base_rest_url + '/cli_extend'
         payload = {
             "cmd": cmd
         }
         LOG.debug("Run the URL: --%s--", url)
         LOG.debug("Run the CLI: --%s--", cmd)
-        conn_max_retries = 60
         conn_retry_interval = 10
+        exception = None
+        status_code = None
         for a in six.moves.xrange(conn_max_retries):
             try:
                 r = requests.post(url,
@@ -294,13 +624,23 @@ class ArrayAPVAPIDriver(object):
                 LOG.debug("status_code: %d", r.status_code)
                 if r.status_code == 200:
                     return r
-                else:
+                status_code = r.status_code
+                if a + 1 < conn_max_retries:
                     time.sleep(conn_retry_interval)
             except (requests.ConnectionError, requests.Timeout) as e:
                 exception = e
+                status_code = None
                 LOG.warning("Could not connect to instance. Retrying.")
                 time.sleep(conn_retry_interval)
 
+        if status_code is not None:
+            # The instance answered, but not with success
+            LOG.error("Instance %(url)s rejected the CLI --%(cmd)s-- with "
+                      "status %(status)d",
+                      {'url': url, 'cmd': cmd, 'status': status_code})
+            raise driver_except.CommandRejectedException(
+                errstr="status {}".format(status_code))
+
         LOG.error("Connection retries (currently set to %(max_retries)s) "
                   "exhausted.  The vapv is unavailable. Reason: "
                   "%(exception)s",
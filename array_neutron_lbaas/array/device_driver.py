@@ -11,9 +11,14 @@
 # limitations under the License.
 #
 
+from functools import partial
+
 from oslo_log import log as logging
 
 from array_neutron_lbaas.array.apv_driver import ArrayAPVAPIDriver
+from array_neutron_lbaas.array.apv_driver import CLUSTER_PRIORITY_PRIMARY
+from array_neutron_lbaas.array.apv_driver import CLUSTER_PRIORITY_SECONDARY
+from array_neutron_lbaas.concurrency import run_in_parallel
 
 LOG = logging.getLogger(__name__)
 
@@ -23,23 +28,63 @@ class ArrayADCDriver(object):
         APV/AVX instance via RESTful API
     """
     def __init__(self):
-        pass
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """
+        Registers listener(vapv) to be called after each change saved on
+        a vAPV instance.
+        """
+        self.listeners.append(listener)
+
+    def _get_management_ips(self, vapv):
+        # Changes go to both members of an HA pair, primary first
+        return [
+            address for address in [vapv['pri_mgmt_address'],
+                                    vapv.get('sec_mgmt_address')]
+            if address
+        ]
+
+    def _changed(self, vapv):
+        for listener in self.listeners:
+            try:
+                listener(vapv)
+            except Exception as e:
+                LOG.error("Error notifying a change of vAPV %s: %s",
+                          vapv['hostname'], e)
 
     def create_loadbalancer(self, lb, vapv, network_config):
         """
         Used to allocate the VIP to loadbalancer
         """
         LOG.debug("Create a loadbalancer on Array ADC device(%s)", lb)
+
+        if 'pri_data_ip' in network_config:
+            # Both members of an HA pair are configured at the same time
+            bandwidth = network_config.get('bandwidth', 0)
+            calls = [partial(self._create_vip, vapv['pri_mgmt_address'],
+                             network_config['pri_data_ip'],
+                             network_config['pri_data_netmask'], bandwidth)]
+            if network_config.get('sec_data_ip'):
+                calls.append(partial(self._create_vip,
+                                     vapv['sec_mgmt_address'],
+                                     network_config['sec_data_ip'],
+                                     network_config['pri_data_netmask'],
+                                     bandwidth))
+            run_in_parallel(calls)
+            self._changed(vapv)
+
+
+    def _create_vip(self, address, vip_address, netmask, bandwidth=0):
         argu = {}
 
-        if len(network_config) == 2:
-            argu['vip_address'] = network_config['pri_data_ip']
-            argu['netmask'] = network_config['pri_data_netmask']
+        argu['vip_address'] = vip_address
+        argu['netmask'] = netmask
+        argu['bandwidth'] = bandwidth
 
-            management_ip = [vapv['pri_mgmt_address'],]
-            driver = ArrayAPVAPIDriver(management_ip)
-            driver.create_loadbalancer(argu)
-            driver.write_memory(argu)
+        driver = ArrayAPVAPIDriver([address,])
+        driver.create_loadbalancer(argu)
+        driver.write_memory(argu)
 
 
     def update_loadbalancer(self, obj, old_obj):
@@ -51,14 +96,142 @@ class ArrayADCDriver(object):
         LOG.debug("Delete a loadbalancer on Array ADC device")
         argu = {}
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.delete_loadbalancer(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
+
+
+    def configure_cluster(self, vapv, vip_addresses):
+        """
+        Configures the members of an HA pair as a virtual cluster owning
+        vip_addresses, the primary with the higher priority, so that the
+        appliances fail the VIPs over between themselves. Both members are
+        configured at the same time.
+        """
+        run_in_parallel([
+            partial(self._configure_cluster_member, vapv['pri_mgmt_address'],
+                    CLUSTER_PRIORITY_PRIMARY, vip_addresses),
+            partial(self._configure_cluster_member, vapv['sec_mgmt_address'],
+                    CLUSTER_PRIORITY_SECONDARY, vip_addresses)
+        ])
+        self._changed(vapv)
+
+
+    def _configure_cluster_member(self, address, priority, vip_addresses):
+        argu = {}
+
+        argu['priority'] = priority
+        argu['vip_addresses'] = vip_addresses
+
+        driver = ArrayAPVAPIDriver([address,])
+        driver.configure_cluster(argu)
+        driver.write_memory(argu)
+
+
+    def add_cluster_vip(self, vapv, vip_address):
+        """
+        Adds a loadbalancer VIP to the virtual cluster of an HA pair.
+        """
+        self._update_cluster_vip(vapv, vip_address, "add_cluster_vip")
+
+
+    def delete_cluster_vip(self, vapv, vip_address):
+        """
+        Removes a loadbalancer VIP from the virtual cluster of an HA pair.
+        """
+        self._update_cluster_vip(vapv, vip_address, "delete_cluster_vip")
+
+
+    def _update_cluster_vip(self, vapv, vip_address, method):
+        argu = {}
+
+        argu['vip_address'] = vip_address
+
+        def update(address):
+            driver = ArrayAPVAPIDriver([address,])
+            getattr(driver, method)(argu)
+            driver.write_memory(argu)
+
+        run_in_parallel([
+            partial(update, vapv['pri_mgmt_address']),
+            partial(update, vapv['sec_mgmt_address'])
+        ])
+        self._changed(vapv)
 
 
     def get_stats(self, instance):
-        pass
+        """
+        Returns the connection, byte and CPU counters of a vAPV instance,
+        or None if it cannot be reached.
+        """
+        management_ip = [
+            address for address in [instance['pri_mgmt_address'],
+                                    instance.get('sec_mgmt_address')]
+            if address
+        ]
+        driver = ArrayAPVAPIDriver(management_ip)
+        return driver.get_statistics()
+
+
+    def get_running_config(self, vapv):
+        """
+        Returns the lines of the running config of a vAPV instance, or
+        None if it cannot be reached.
+        """
+        management_ip = [vapv['pri_mgmt_address'],]
+        driver = ArrayAPVAPIDriver(management_ip)
+        output = driver.get_running_config()
+        if output is None:
+            return None
+        return output.splitlines()
+
+
+    def run_commands(self, vapv, commands, management_ip=None):
+        """
+        Pushes a list of CLI commands to a vAPV (by default to all its
+        instances) and saves its config.
+        """
+        argu = {}
+
+        argu['commands'] = commands
+
+        if management_ip is None:
+            management_ip = self._get_management_ips(vapv)
+        driver = ArrayAPVAPIDriver(management_ip)
+        driver.run_commands(argu)
+        driver.write_memory(argu)
+        self._changed(vapv)
+
+
+    def update_instance_bandwidth(self, vapv, bandwidth):
+        """
+        Applies the bandwidth allocation (Mbps, 0 for none) of a vAPV
+        instance to its traffic interface.
+        """
+        argu = {}
+
+        argu['bandwidth'] = bandwidth
+
+        management_ip = self._get_management_ips(vapv)
+        driver = ArrayAPVAPIDriver(management_ip)
+        driver.set_instance_bandwidth(argu)
+        driver.write_memory(argu)
+        self._changed(vapv)
+
+
+    def update_listener_bandwidth(self, listener, vapv, bandwidth):
+        argu = {}
+
+        argu['listener_id'] = listener.id
+        argu['bandwidth'] = bandwidth
+
+        management_ip = self._get_management_ips(vapv)
+        driver = ArrayAPVAPIDriver(management_ip)
+        driver.set_listener_bandwidth(argu)
+        driver.write_memory(argu)
+        self._changed(vapv)
 
 
     def create_listener(self, lb, listener, vapv):
@@ -71,10 +244,11 @@ class ArrayADCDriver(object):
         argu['vip_id'] = listener.loadbalancer_id
         argu['vip_address'] = lb.vip_address
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.create_listener(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
 
     def update_listener(self, lb, listener, old, vapv):
@@ -95,10 +269,11 @@ class ArrayADCDriver(object):
         argu['protocol'] = listener.protocol
         argu['vip_id'] = listener.loadbalancer_id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.delete_listener(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
 
     def create_pool(self, pool, vapv):
@@ -117,10 +292,11 @@ class ArrayADCDriver(object):
         argu['lb_algorithm'] = pool.lb_algorithm
         argu['vip_id'] = listener.loadbalancer_id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.create_pool(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
 
     def update_pool(self, obj, old_obj, vapv):
@@ -164,10 +340,11 @@ class ArrayADCDriver(object):
         argu['lb_algorithm'] = pool.lb_algorithm
         argu['vip_id'] = pool.listener.loadbalancer_id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.delete_pool(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
     def create_member(self, member, vapv):
         argu = {}
@@ -182,10 +359,11 @@ class ArrayADCDriver(object):
         argu['pool_id'] = pool.id
         argu['vip_id'] = lb.id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.create_member(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
     def update_member(self, member, old, vapv):
         # see: https://wiki.openstack.org/wiki/Neutron/LBaaS/API_2.0#Update_a_Member_of_a_Pool
@@ -202,10 +380,11 @@ class ArrayADCDriver(object):
         argu['protocol'] = pool.protocol
         argu['vip_id'] = lb.id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.delete_member(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
     def create_health_monitor(self, hm, vapv):
         argu = {}
@@ -223,10 +402,11 @@ class ArrayADCDriver(object):
         argu['pool_id'] = pool.id
         argu['vip_id'] = lb.id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.create_health_monitor(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
     def update_health_monitor(self, hm, old, vapv):
 
@@ -251,8 +431,9 @@ class ArrayADCDriver(object):
         argu['pool_id'] = pool.id
         argu['vip_id'] = lb.id
 
-        management_ip = [vapv['pri_mgmt_address'],]
+        management_ip = self._get_management_ips(vapv)
         driver = ArrayAPVAPIDriver(management_ip)
         driver.delete_health_monitor(argu)
         driver.write_memory(argu)
+        self._changed(vapv)
 
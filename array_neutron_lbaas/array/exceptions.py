@@ -96,3 +96,8 @@ class ArrayADCException(q_exception.NeutronException):
 class TimeOutException(ArrayADCException):
 
     message = "Timeout exception."
+
+
+class CommandRejectedException(ArrayADCException):
+
+    message = "Command rejected by the instance: %(errstr)s"
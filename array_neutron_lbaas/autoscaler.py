@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.db import api as db_api
+from concurrency import PeriodicWorker
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Autoscaler(object):
+    """
+    Scales vAPV capacity up when its utilization stays high and back down
+    when it stays low.
+
+    The utilization of a vAPV is the highest of its CPU utilization and
+    its connections and throughput relative to vapv_max_connections and
+    vapv_max_throughput, as sampled by the driver's StatsCollector. It has
+    to stay above autoscale_high_threshold (or below
+    autoscale_low_threshold) for autoscale_periods consecutive samples
+    before the driver's scale_up (or scale_down) hook is called; the gap
+    between the thresholds gives hysteresis. After an action, a vAPV is
+    left alone for autoscale_cooldown seconds. All these settings can be
+    customized per tenant (for shared vAPVs, the LBaaS project).
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.interval = cfg.CONF.lbaas_settings.autoscale_interval
+        self.enabled = bool(self.interval)
+        self.high_periods = {}
+        self.low_periods = {}
+        self.worker = None
+
+    def start(self):
+        self.worker = PeriodicWorker(
+            self.evaluate, self.interval, name="vapv-autoscaler"
+        )
+        self.worker.start()
+
+    def evaluate(self):
+        session = db_api.get_admin_session()
+        vapvs = self.driver.array_amphora_db.find_vapvs(session)
+        for vapv in vapvs:
+            try:
+                self._evaluate(session, vapv)
+            except Exception as e:
+                LOG.error("\nError autoscaling vAPV {}: {}".format(
+                    vapv['hostname'], e
+                ))
+        # Forget vAPVs that have been deleted
+        hostnames = set(vapv['hostname'] for vapv in vapvs)
+        for periods in [self.high_periods, self.low_periods]:
+            for hostname in periods.keys():
+                if hostname not in hostnames:
+                    del periods[hostname]
+
+    def utilization(self, hostname):
+        """
+        Returns the utilization (0 to 1, or more if overloaded) of the
+        vAPV, or None if there is no recent sample of it.
+        """
+        sample = self.driver.stats_collector.get(hostname)
+        if sample is None:
+            return None
+        settings = cfg.CONF.lbaas_settings
+        usage = [
+            float(sample['connections']) / settings.vapv_max_connections,
+            float(sample['throughput']) / settings.vapv_max_throughput
+        ]
+        if sample['cpu'] is not None:
+            usage.append(sample['cpu'] / 100.0)
+        return max(usage)
+
+    def _evaluate(self, session, vapv):
+        hostname = vapv['hostname']
+        settings = self._get_settings(vapv['tenant_id'])
+        utilization = self.utilization(hostname)
+        if not settings['enabled'] or utilization is None:
+            self.high_periods.pop(hostname, None)
+            self.low_periods.pop(hostname, None)
+            return
+        if utilization > settings['high_threshold']:
+            self.high_periods[hostname] = \
+                self.high_periods.get(hostname, 0) + 1
+            self.low_periods.pop(hostname, None)
+        elif utilization < settings['low_threshold']:
+            self.low_periods[hostname] = \
+                self.low_periods.get(hostname, 0) + 1
+            self.high_periods.pop(hostname, None)
+        else:
+            self.high_periods.pop(hostname, None)
+            self.low_periods.pop(hostname, None)
+            return
+        if self.high_periods.get(hostname, 0) >= settings['periods']:
+            direction = "up"
+            action = self.driver.scale_up
+        elif self.low_periods.get(hostname, 0) >= settings['periods']:
+            direction = "down"
+            action = self.driver.scale_down
+        else:
+            return
+        self.high_periods.pop(hostname, None)
+        self.low_periods.pop(hostname, None)
+        # Also stops other neutron-server workers acting on the same vAPV
+        if not self.driver.array_amphora_db.mark_scaled(
+                session, hostname, settings['cooldown']):
+            LOG.debug("\nvAPV {} is cooling down; not scaling {}".format(
+                hostname, direction
+            ))
+            return
+        LOG.info("\nScaling vAPV {} {} (utilization {:.2f})".format(
+            hostname, direction, utilization
+        ))
+        if not action(vapv, settings['flavors']):
+            LOG.info("\nvAPV {} cannot be scaled {} any further".format(
+                hostname, direction
+            ))
+
+    def _get_settings(self, tenant_id):
+        # Tenant customizations are stored as strings
+        def get(param):
+            return self.driver._get_setting(
+                tenant_id, "lbaas_settings", "autoscale_{}".format(param)
+            )
+        enabled = get("enabled")
+        flavors = get("flavors") or []
+        if isinstance(flavors, basestring):
+            flavors = [
+                flavor.strip() for flavor in flavors.split(",")
+                if flavor.strip()
+            ]
+        return {
+            "enabled": enabled is True or str(enabled).lower() == "true",
+            "high_threshold": float(get("high_threshold")),
+            "low_threshold": float(get("low_threshold")),
+            "periods": int(get("periods")),
+            "cooldown": int(get("cooldown")),
+            "flavors": flavors
+        }
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from threading import Lock
+from time import time
+
+
+class TTLCache(object):
+    """
+    Thread-safe dictionary whose entries expire ttl seconds after they were
+    stored. A ttl of 0 disables caching.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return default
+            if expires < time():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = (value, time() + self.ttl)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() to produce and
+        store it on a miss.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Removes key from the cache, or every entry if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """
+        Removes every entry whose value satisfies predicate(value).
+        """
+        with self._lock:
+            for key, (value, expires) in self._entries.items():
+                if predicate(value):
+                    del self._entries[key]
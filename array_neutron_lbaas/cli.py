@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas import device_driver
+from neutron.common import config as common_config
+from neutron_lbaas.db.loadbalancer import loadbalancer_dbv2
+from oslo_config import cfg
+from oslo_log import log as logging
+
+
+class PluginDb(object):
+    """
+    Stands in for the LBaaS plugin, of which the driver only uses the
+    database API.
+    """
+    db = loadbalancer_dbv2.LoadBalancerPluginDbv2()
+
+
+def parse_args(argv):
+    """
+    Returns the --name=value parameters in argv as a dict of
+    name: [value, ...], with dashes in the names replaced by underscores.
+
+    :raises: ValueError if a parameter is not in that form.
+    """
+    args = {}
+    for arg in argv:
+        if not arg.startswith("--") or "=" not in arg:
+            raise ValueError("unrecognized parameter '%s'" % arg)
+        name, value = arg[2:].split("=", 1)
+        args.setdefault(name.replace("-", "_"), []).append(value.strip())
+    return args
+
+
+def load_driver(config_files, name):
+    """
+    Loads the Neutron and vAPV LBaaS configuration and returns the device
+    driver for use by a console script, without its background workers.
+    """
+    common_config.init(
+        ["--config-file=%s" % config_file for config_file in config_files]
+    )
+    logging.setup(cfg.CONF, name)
+    for option, value in [("autoscale_interval", 0),
+                          ("mgmt_reserve_size", 0),
+                          ("reconcile_interval", 0),
+                          ("snapshot_delay", 0),
+                          ("standby_pool_az_targets", {}),
+                          ("standby_pool_size", 0),
+                          ("stats_collection_interval", 0),
+                          # Scripts exit without waiting for queued writes
+                          ("write_policy", "ALL")]:
+        cfg.CONF.set_override(option, value, "lbaas_settings")
+    return device_driver.get_device_driver().ArrayDeviceDriverV2(PluginDb())
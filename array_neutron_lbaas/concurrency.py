@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from oslo_log import log as logging
+from threading import Event, Lock, Thread
+
+LOG = logging.getLogger(__name__)
+
+
+class ParallelExecutionError(Exception):
+    """
+    Raised by run_in_parallel when at least one call failed. The results of
+    the calls that succeeded are kept so that callers can roll them back.
+    """
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        super(ParallelExecutionError, self).__init__(
+            "; ".join([str(error) for error in errors if error is not None])
+        )
+
+
+def run_in_parallel(calls):
+    """
+    Runs each zero-argument callable in calls in its own thread and waits
+    for all of them to finish.
+
+    :returns: list of return values, in the same order as calls.
+    :raises: ParallelExecutionError if any of the calls raised.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def runner(index, call):
+        try:
+            results[index] = call()
+        except Exception as e:
+            errors[index] = e
+
+    threads = [
+        Thread(target=runner, args=(index, call))
+        for index, call in enumerate(calls)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if any(error is not None for error in errors):
+        raise ParallelExecutionError(results, errors)
+    return results
+
+
+def run_with_limit(calls, limit, callback=None):
+    """
+    Runs the zero-argument callables in calls, at most limit at a time, and
+    waits for all of them to finish. callback(index, result, error) is
+    called as each one finishes.
+
+    :returns: (results, errors): lists in the same order as calls, with None
+              for calls that failed or succeeded respectively.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    pending = list(enumerate(calls))
+    lock = Lock()
+
+    def runner():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, call = pending.pop(0)
+            try:
+                results[index] = call()
+            except Exception as e:
+                errors[index] = e
+            if callback is not None:
+                with lock:
+                    callback(index, results[index], errors[index])
+
+    threads = [Thread(target=runner) for _ in xrange(min(limit, len(calls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class PeriodicWorker(Thread):
+    """
+    Daemon thread that calls task every interval seconds. Calling wake()
+    runs the task again straight away.
+    """
+    def __init__(self, task, interval, name=None):
+        self.task = task
+        self.interval = interval
+        self.wakeup = Event()
+        super(PeriodicWorker, self).__init__(name=name)
+        self.daemon = True
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                self.task()
+            except Exception as e:
+                LOG.error("\nError in periodic task {}: {}".format(
+                    self.name, e
+                ))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
@@ -0,0 +1,32 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+try:
+    from neutron_lib import context as n_context
+except ImportError:
+    from neutron import context as n_context
+
+
+def get_admin_context():
+    """
+    Returns a Neutron admin context for work done outside of an API
+    request, e.g. from background threads that have no request context.
+    """
+    return n_context.get_admin_context()
+
+
+def get_admin_session():
+    """
+    Returns a Neutron DB session for work done outside of an API request,
+    e.g. from background threads that have no request context.
+    """
+    return get_admin_context().session
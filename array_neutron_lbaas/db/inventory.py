@@ -0,0 +1,139 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from threading import Lock
+
+
+class AmphoraInventory(object):
+    """In-process index of array_amphora records.
+
+    Records are indexed by hostname, tenant_id and subnet_id. The index is
+    loaded from the database and then kept current by the
+    ArrayAmphoraRepository write paths of this process; writes made by
+    other neutron-server workers are picked up when it is reloaded.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._records = {}
+        self._by_tenant = {}
+        self._by_subnet = {}
+        self.loaded = False
+        # Generation of the last removal of each hostname since the last
+        # load, so that a load cannot bring back what it raced with
+        self._generation = 0
+        self._removed = {}
+
+    def generation(self):
+        """Returns a marker to pass to load, taken before reading the
+        records."""
+        with self._lock:
+            return self._generation
+
+    def load(self, records, since=None):
+        """Replaces the contents of the index with records.
+
+        Records removed from the index after generation since, i.e. while
+        they were being read, are left out.
+        """
+        records = list(records)
+        with self._lock:
+            removed = set(
+                hostname for hostname, generation in self._removed.items()
+                if since is None or generation > since
+            )
+            self._records = {}
+            self._by_tenant = {}
+            self._by_subnet = {}
+            for record in records:
+                if record['hostname'] not in removed:
+                    self._add(record)
+            self._removed = dict(
+                (hostname, generation)
+                for hostname, generation in self._removed.items()
+                if since is not None and generation > since
+            )
+            self.loaded = True
+
+    def put(self, record):
+        with self._lock:
+            self._discard(record['hostname'])
+            self._add(record)
+
+    def update(self, hostname, **fields):
+        with self._lock:
+            record = self._records.get(hostname)
+            if record is None:
+                return
+            self._discard(hostname)
+            record = dict(record, **fields)
+            self._add(record)
+
+    def remove(self, hostname):
+        with self._lock:
+            self._discard(hostname)
+            self._mark_removed(hostname)
+
+    def remove_ids(self, ids):
+        ids = set(ids)
+        with self._lock:
+            for hostname, record in list(self._records.items()):
+                if record['id'] in ids:
+                    self._discard(hostname)
+                    self._mark_removed(hostname)
+
+    def get(self, hostname):
+        """Returns a copy of the record for hostname, or None."""
+        with self._lock:
+            record = self._records.get(hostname)
+            return dict(record) if record is not None else None
+
+    def find(self, tenant_id=None, subnet_id=None):
+        """Returns copies of the records matching tenant_id and subnet_id."""
+        with self._lock:
+            hostnames = None
+            if tenant_id is not None:
+                hostnames = set(self._by_tenant.get(tenant_id, ()))
+            if subnet_id is not None:
+                subnet_hostnames = self._by_subnet.get(subnet_id, set())
+                if hostnames is None:
+                    hostnames = set(subnet_hostnames)
+                else:
+                    hostnames &= subnet_hostnames
+            if hostnames is None:
+                hostnames = self._records.keys()
+            return [dict(self._records[hostname]) for hostname in hostnames]
+
+    def _add(self, record):
+        hostname = record['hostname']
+        self._records[hostname] = record
+        self._by_tenant.setdefault(record['tenant_id'], set()).add(hostname)
+        self._by_subnet.setdefault(record['subnet_id'], set()).add(hostname)
+
+    def _mark_removed(self, hostname):
+        self._generation += 1
+        self._removed[hostname] = self._generation
+
+    def _discard(self, hostname):
+        record = self._records.pop(hostname, None)
+        if record is None:
+            return
+        for index, key in [(self._by_tenant, record['tenant_id']),
+                           (self._by_subnet, record['subnet_id'])]:
+            hostnames = index.get(key)
+            if hostnames is not None:
+                hostnames.discard(hostname)
+                if not hostnames:
+                    del index[key]
+
+
+INVENTORY = AmphoraInventory()
@@ -0,0 +1,115 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+import sqlalchemy as sa
+
+import models
+
+
+def upgrade(engine):
+    """Brings an existing Array LBaaS schema up to date.
+
+    Tables that do not exist yet are created from the models; schema
+    changes to existing tables are applied with Alembic operations. Each
+    step checks the current schema first, so upgrade can be run any number
+    of times.
+
+    :param engine: A Sql Alchemy engine bound to the Neutron database.
+    :returns: list of descriptions of the changes that were made.
+    """
+    changes = []
+    with engine.begin() as connection:
+        inspector = sa.inspect(connection)
+        existing_tables = inspector.get_table_names()
+        for table in models.BaseTable.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(connection)
+                changes.append("created table {}".format(table.name))
+        op = Operations(MigrationContext.configure(connection))
+        for migration in MIGRATIONS:
+            change = migration(inspector, op, existing_tables)
+            if change:
+                changes.append(change)
+    return changes
+
+
+def add_amphora_hostname_index(inspector, op, existing_tables):
+    # Tables created above already have the index
+    if "array_amphora" not in existing_tables:
+        return None
+    indexes = [
+        index['name'] for index in inspector.get_indexes("array_amphora")
+    ]
+    if models.AMPHORA_HOSTNAME_INDEX in indexes:
+        return None
+    op.create_index(
+        models.AMPHORA_HOSTNAME_INDEX, "array_amphora", ["hostname"],
+        unique=True
+    )
+    return "added unique index on array_amphora.hostname"
+
+
+def add_amphora_capacity_counters(inspector, op, existing_tables):
+    if "array_amphora" not in existing_tables:
+        return None
+    columns = [
+        column['name'] for column in inspector.get_columns("array_amphora")
+    ]
+    added = []
+    for name in ["listener_count", "member_count", "bandwidth"]:
+        if name not in columns:
+            op.add_column("array_amphora", sa.Column(
+                name, sa.Integer(), nullable=False, server_default="0"
+            ))
+            added.append(name)
+    if not added:
+        return None
+    return "added columns {} to array_amphora".format(", ".join(added))
+
+
+def add_amphora_scaled_at(inspector, op, existing_tables):
+    if "array_amphora" not in existing_tables:
+        return None
+    columns = [
+        column['name'] for column in inspector.get_columns("array_amphora")
+    ]
+    if "scaled_at" in columns:
+        return None
+    op.add_column("array_amphora", sa.Column(
+        "scaled_at", sa.DateTime(), nullable=True
+    ))
+    return "added column scaled_at to array_amphora"
+
+
+def add_amphora_reconciled_at(inspector, op, existing_tables):
+    if "array_amphora" not in existing_tables:
+        return None
+    columns = [
+        column['name'] for column in inspector.get_columns("array_amphora")
+    ]
+    if "reconciled_at" in columns:
+        return None
+    op.add_column("array_amphora", sa.Column(
+        "reconciled_at", sa.DateTime(), nullable=True
+    ))
+    return "added column reconciled_at to array_amphora"
+
+
+# Schema changes, oldest first
+MIGRATIONS = [
+    add_amphora_hostname_index,
+    add_amphora_capacity_counters,
+    add_amphora_scaled_at,
+    add_amphora_reconciled_at,
+]
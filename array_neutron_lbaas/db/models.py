@@ -16,33 +16,144 @@ import sqlalchemy as sa
 
 BaseTable = declarative_base()
 
-class ArrayAmphora(BaseTable, models_v2.HasId, models_v2.HasTenant):
+# Life cycle of pre-allocated (reserved) resources
+RESERVE_BUILDING = "BUILDING"
+RESERVE_READY = "READY"
+RESERVE_CLAIMED = "CLAIMED"
+
+AMPHORA_HOSTNAME_INDEX = "uniq_array_amphora0hostname"
+
+
+class ArrayModelBase(object):
+
+    def to_dict(self, **kwargs):
+        """Returns the record's column values as a dict.
+
+        Passing <column>=False leaves that column out.
+        """
+        ret = {}
+        for key in self._get_column_keys():
+            if not kwargs.get(key, True):
+                continue
+            value = getattr(self, key)
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            ret[key] = value
+        return ret
+
+    @classmethod
+    def _get_column_keys(cls):
+        # Worked out once per model class rather than on every call
+        keys = cls.__dict__.get('_column_keys')
+        if keys is None:
+            keys = tuple(
+                attr.key for attr in sa.inspect(cls).column_attrs
+            )
+            cls._column_keys = keys
+        return keys
+
+    def from_dict(cls, model_dict):
+        return cls(**model_dict)
+
+
+class ArrayAmphora(BaseTable, ArrayModelBase, models_v2.HasId,
+                   models_v2.HasTenant):
     """Represents an Array load balancer."""
 
     __tablename__ = "array_amphora"
+    __table_args__ = (
+        sa.Index(AMPHORA_HOSTNAME_INDEX, "hostname", unique=True),
+    )
 
     in_use_lb = sa.Column(sa.Integer(), nullable=False)
     subnet_id = sa.Column(sa.String(36), nullable=False)
     pri_mgmt_address = sa.Column(sa.String(64), nullable=True)
     sec_mgmt_address = sa.Column(sa.String(64), nullable=True)
     hostname = sa.Column(sa.String(64), nullable=True)
+    # Capacity counters used to place loadbalancers on shared vAPVs
+    listener_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                               server_default="0")
+    member_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                             server_default="0")
+    bandwidth = sa.Column(sa.Integer(), nullable=False, default=0,
+                          server_default="0")
+    # Time of the last autoscaling action, for the cooldown
+    scaled_at = sa.Column(sa.DateTime(), nullable=True)
+    # Time the running config was last checked for drift
+    reconciled_at = sa.Column(sa.DateTime(), nullable=True)
 
-    def to_dict(self, **kwargs):
-        ret = {}
-        for attr in self.__dict__:
-            if attr.startswith('_') or not kwargs.get(attr, True):
-                continue
-            if isinstance(getattr(self, attr), list):
-                ret[attr] = []
-                for item in self.__dict__[attr]:
-                    ret[attr] = item
-            elif isinstance(self.__dict__[attr], unicode):
-                ret[attr.encode('utf8')] = self.__dict__[attr].encode('utf8')
-            else:
-                ret[attr] = self.__dict__[attr]
-        return ret
 
-    def from_dict(cls, model_dict):
-        return cls(**model_dict)
+class ArrayStandbyVapv(BaseTable, ArrayModelBase, models_v2.HasId):
+    """Represents a pre-booted vAPV instance waiting for a loadbalancer."""
+
+    __tablename__ = "array_standby_vapv"
+
+    hostname = sa.Column(sa.String(64), nullable=False)
+    status = sa.Column(sa.String(16), nullable=False)
+    server_id = sa.Column(sa.String(36), nullable=True)
+    mgmt_port_id = sa.Column(sa.String(36), nullable=True)
+    mgmt_address = sa.Column(sa.String(64), nullable=True)
+    availability_zone = sa.Column(sa.String(255), nullable=True)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class ArrayMgmtReserve(BaseTable, ArrayModelBase, models_v2.HasId):
+    """Represents a pre-allocated management port or floating IP."""
+
+    __tablename__ = "array_mgmt_reserve"
+
+    resource_type = sa.Column(sa.String(16), nullable=False)
+    resource_id = sa.Column(sa.String(36), nullable=True)
+    address = sa.Column(sa.String(64), nullable=True)
+    status = sa.Column(sa.String(16), nullable=False)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class ArraySpawnLock(BaseTable, ArrayModelBase):
+    """Marks a vAPV that a neutron-server worker is currently spawning."""
+
+    __tablename__ = "array_spawn_lock"
+
+    hostname = sa.Column(sa.String(64), primary_key=True)
+    owner = sa.Column(sa.String(255), nullable=False)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class ArrayLbPlacement(BaseTable, ArrayModelBase):
+    """Records which shared vAPV hosts a loadbalancer."""
+
+    __tablename__ = "array_lb_placement"
+
+    loadbalancer_id = sa.Column(sa.String(36), primary_key=True)
+    tenant_id = sa.Column(sa.String(255), nullable=False)
+    identifier = sa.Column(sa.String(64), nullable=False)
+    hostname = sa.Column(sa.String(64), nullable=False, index=True)
+    bandwidth = sa.Column(sa.Integer(), nullable=False, default=0)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class ArrayConfigChecksum(BaseTable, ArrayModelBase):
+    """Records the checksums of one configuration object on a vAPV."""
+
+    __tablename__ = "array_config_checksum"
+
+    hostname = sa.Column(sa.String(64), primary_key=True)
+    object_key = sa.Column(sa.String(80), primary_key=True)
+    # Checksum of the commands rendered from Neutron
+    expected = sa.Column(sa.String(40), nullable=False)
+    # Checksum of the object's lines in the running config, once known
+    device = sa.Column(sa.String(40), nullable=True)
+    updated_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class ArrayConfigSnapshot(BaseTable, ArrayModelBase):
+    """Holds one version of the rendered configuration of a vAPV."""
 
+    __tablename__ = "array_config_snapshot"
 
+    hostname = sa.Column(sa.String(64), primary_key=True)
+    version = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    checksum = sa.Column(sa.String(40), nullable=False)
+    # zlib-compressed CLI commands, one per line
+    content = sa.Column(sa.LargeBinary(), nullable=False)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
@@ -10,8 +10,28 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+from sqlalchemy import exc as sa_exc
+try:
+    from oslo_db import exception as db_exc
+    DUPLICATE_ENTRY_ERRORS = (sa_exc.IntegrityError, db_exc.DBDuplicateEntry)
+except ImportError:
+    DUPLICATE_ENTRY_ERRORS = (sa_exc.IntegrityError,)
+from uuid import uuid4
+
+from inventory import INVENTORY
 import models
 
+# Maximum number of rows per bulk statement; keeps IN clauses and
+# executemany batches within database limits
+BULK_CHUNK_SIZE = 500
+
+
+def _chunks(items):
+    for start in xrange(0, len(items), BULK_CHUNK_SIZE):
+        yield items[start:start + BULK_CHUNK_SIZE]
+
+
 class BaseRepository(object):
     model_class = None
 
@@ -41,10 +61,62 @@ class BaseRepository(object):
             session.flush()
 
     def delete_batch(self, session, ids=None):
-        """Batch deletes by entity ids."""
-        ids = ids or []
-        for id in ids:
-            self.delete(session, id=id)
+        """Batch deletes by entity ids.
+
+        Runs one DELETE ... WHERE id IN (...) per BULK_CHUNK_SIZE ids.
+
+        :returns: number of deleted rows.
+        """
+        ids = list(ids or [])
+        deleted = 0
+        with session.begin(subtransactions=True):
+            for chunk in _chunks(ids):
+                deleted += session.query(self.model_class).filter(
+                    self.model_class.id.in_(chunk)
+                ).delete(synchronize_session=False)
+        return deleted
+
+    def bulk_create(self, session, records):
+        """Inserts many entities with executemany.
+
+        Scalar column defaults are filled in, and records are inserted in
+        groups with the same attributes, as executemany needs.
+
+        :param records: list of dicts of model attributes. Ids are
+                        generated for records that do not have one.
+        :returns: list of the inserted records, with their ids. Columns
+                  with only a server default are left out.
+        """
+        table = self.model_class.__table__
+        records = [dict(record) for record in records]
+        groups = {}
+        for record in records:
+            if "id" in table.columns:
+                record.setdefault("id", str(uuid4()))
+            for column in table.columns:
+                if column.default is not None and column.default.is_scalar:
+                    record.setdefault(column.key, column.default.arg)
+            groups.setdefault(frozenset(record), []).append(record)
+        with session.begin(subtransactions=True):
+            for group in groups.values():
+                for chunk in _chunks(group):
+                    session.execute(table.insert(), chunk)
+        return records
+
+    def bulk_get(self, session, ids):
+        """Retrieves the entities with the given ids.
+
+        :returns: list of dicts, in no particular order. Ids that do not
+                  exist are skipped.
+        """
+        results = []
+        for chunk in _chunks(list(ids)):
+            results.extend(
+                model.to_dict() for model in session.query(
+                    self.model_class
+                ).filter(self.model_class.id.in_(chunk))
+            )
+        return results
 
     def update(self, session, id, **model_kwargs):
         """Updates an entity in the database.
@@ -80,30 +152,499 @@ class BaseRepository(object):
 
 
 class ArrayAmphoraRepository(BaseRepository):
+    """Amphora records, mirrored in the in-process inventory index."""
     model_class = models.ArrayAmphora
+    inventory = INVENTORY
+
+    def load_inventory(self, session):
+        """(Re)loads the inventory index from the database."""
+        since = self.inventory.generation()
+        self.inventory.load(
+            (model.to_dict() for model in session.query(self.model_class)),
+            since
+        )
+
+    def create(self, session, **model_kwargs):
+        record = super(ArrayAmphoraRepository, self).create(
+            session, **model_kwargs
+        )
+        self.inventory.put(record)
+        return record
 
-    def get_vapv_by_hostname(self, session, hostname):
+    def bulk_create(self, session, records):
+        records = super(ArrayAmphoraRepository, self).bulk_create(
+            session, records
+        )
+        # Indexed as stored, server defaults included
+        records = self.bulk_get(session, [record['id'] for record in records])
+        for record in records:
+            self.inventory.put(record)
+        return records
+
+    def update(self, session, id, **model_kwargs):
+        super(ArrayAmphoraRepository, self).update(
+            session, id, **model_kwargs
+        )
+        record = super(ArrayAmphoraRepository, self).get(session, id=id)
+        if record is not None:
+            self.inventory.put(record)
+
+    def delete(self, session, **filters):
+        hostnames = [
+            hostname for (hostname,) in session.query(
+                self.model_class.hostname
+            ).filter_by(**filters)
+        ]
+        super(ArrayAmphoraRepository, self).delete(session, **filters)
+        for hostname in hostnames:
+            self.inventory.remove(hostname)
+
+    def delete_if_unused(self, session, hostname):
+        """Deletes the record of a vAPV that hosts no loadbalancers.
+
+        The check and the delete are one statement, so a concurrent
+        claim_capacity either lands before it, and the record is kept, or
+        finds no record.
+
+        :returns: True if the record was deleted.
+        """
+        with session.begin(subtransactions=True):
+            deleted = session.query(self.model_class).filter(
+                self.model_class.hostname == hostname,
+                self.model_class.in_use_lb == 0
+            ).delete(synchronize_session=False)
+        if deleted:
+            self.inventory.remove(hostname)
+        return bool(deleted)
+
+    def delete_batch(self, session, ids=None):
+        ids = list(ids or [])
+        deleted = super(ArrayAmphoraRepository, self).delete_batch(
+            session, ids
+        )
+        self.inventory.remove_ids(ids)
+        return deleted
+
+    def get_vapv_by_hostname(self, session, hostname, confirm=False):
+        """Returns the record of a vAPV, or None.
+
+        The inventory index may still hold a record that another worker
+        has deleted, so with confirm the database is always asked, as it
+        must be for placement and spawn decisions.
+        """
+        if not confirm:
+            vapv = self.inventory.get(hostname)
+            if vapv is not None:
+                return vapv
+        # Not indexed (yet): it may have been created by another worker
         vapv = session.query(self.model_class).filter_by(hostname=hostname).first()
         if vapv:
-            return vapv.to_dict()
+            vapv = vapv.to_dict()
+            self.inventory.put(vapv)
+            return vapv
+        if confirm:
+            self.inventory.remove(hostname)
         return None
 
+    def find_vapvs(self, session, tenant_id=None, subnet_id=None,
+                   confirm=False):
+        """Returns the vAPV records of a tenant and/or subnet.
+
+        The inventory index is used once it has been loaded, unless confirm
+        asks for the database; until then the database is queried.
+        """
+        if self.inventory.loaded and not confirm:
+            return self.inventory.find(tenant_id=tenant_id, subnet_id=subnet_id)
+        filters = {}
+        if tenant_id is not None:
+            filters['tenant_id'] = tenant_id
+        if subnet_id is not None:
+            filters['subnet_id'] = subnet_id
+        return [
+            model.to_dict() for model in
+            session.query(self.model_class).filter_by(**filters)
+        ]
+
     def increment_inuselb(self, session, hostname):
-        vapv = session.query(self.model_class).filter_by(hostname=hostname).first()
-        if vapv:
-            (vapv.in_use_lb) = (vapv.in_use_lb) + 1
-            return vapv.in_use_lb
-        return -1
+        return self.adjust_counters(
+            session, hostname, in_use_lb=1
+        )['in_use_lb']
 
     def decrement_inuselb(self, session, hostname):
-        vapv = session.query(self.model_class).filter_by(hostname=hostname).first()
-        if vapv:
-            (vapv.in_use_lb) = (vapv.in_use_lb) - 1
-            return vapv.in_use_lb
-        return -1
+        return self.adjust_counters(
+            session, hostname, in_use_lb=-1
+        )['in_use_lb']
+
+    def adjust_counters(self, session, hostname, **deltas):
+        """Atomically adds deltas to counter columns of the vAPV.
+
+        Counters are changed by a single UPDATE so that concurrent
+        loadbalancer creates and deletes cannot lose updates, e.g.
+        adjust_counters(session, hostname, in_use_lb=1, bandwidth=100).
+
+        :returns: dict of the new counter values; each is -1 if there is
+                  no such vAPV.
+        """
+        columns = [getattr(self.model_class, name) for name in deltas]
+        with session.begin(subtransactions=True):
+            updated = session.query(self.model_class).filter_by(
+                hostname=hostname
+            ).update(
+                {
+                    column: column + delta
+                    for column, delta in zip(columns, deltas.values())
+                },
+                synchronize_session=False
+            )
+            if not updated:
+                return {name: -1 for name in deltas}
+            values = dict(zip(
+                deltas.keys(),
+                session.query(*columns).filter_by(hostname=hostname).one()
+            ))
+        self.inventory.update(hostname, **values)
+        return values
+
+    def claim_capacity(self, session, hostname, max_loadbalancers,
+                       max_bandwidth, bandwidth, max_listeners=0,
+                       max_members=0, listener_count=0, member_count=0):
+        """Adds a loadbalancer to a shared vAPV if it still has room.
+
+        The limits are checked in the same UPDATE that increments the
+        counters, so concurrent placements by several workers cannot
+        overfill the vAPV. A limit of 0 means unlimited; as with
+        BinPackingScheduler.fits, a loadbalancer without listeners or
+        members still needs room for one.
+
+        :returns: True if the loadbalancer was added.
+        """
+        model = self.model_class
+        with session.begin(subtransactions=True):
+            query = session.query(model).filter(
+                model.hostname == hostname,
+                model.in_use_lb < max_loadbalancers
+            )
+            if max_bandwidth:
+                query = query.filter(
+                    model.bandwidth + bandwidth <= max_bandwidth
+                )
+            if max_listeners:
+                query = query.filter(
+                    model.listener_count + max(listener_count, 1) <=
+                    max_listeners
+                )
+            if max_members:
+                query = query.filter(
+                    model.member_count + max(member_count, 1) <= max_members
+                )
+            updated = query.update(
+                {
+                    model.in_use_lb: model.in_use_lb + 1,
+                    model.bandwidth: model.bandwidth + bandwidth,
+                    model.listener_count: model.listener_count +
+                    listener_count,
+                    model.member_count: model.member_count + member_count
+                },
+                synchronize_session=False
+            )
+            if not updated:
+                return False
+            values = session.query(
+                model.in_use_lb, model.bandwidth, model.listener_count,
+                model.member_count
+            ).filter_by(hostname=hostname).one()
+        self.inventory.update(hostname, **dict(zip(
+            ["in_use_lb", "bandwidth", "listener_count", "member_count"],
+            values
+        )))
+        return True
+
+    def mark_scaled(self, session, hostname, cooldown):
+        """Starts an autoscaling action on the vAPV unless one was started
+        less than cooldown seconds ago.
+
+        The check and the update are a single conditional UPDATE, so only
+        one neutron-server worker acts on the vAPV.
+
+        :returns: True if the caller may go ahead.
+        """
+        return self._mark(session, hostname, "scaled_at", cooldown)
+
+    def mark_reconciled(self, session, hostname, interval):
+        """Starts a drift check of the vAPV unless one was started less
+        than interval seconds ago, by any neutron-server worker.
+
+        :returns: True if the caller may go ahead.
+        """
+        return self._mark(session, hostname, "reconciled_at", interval)
+
+    def _mark(self, session, hostname, column_name, min_age):
+        model = self.model_class
+        column = getattr(model, column_name)
+        now = datetime.datetime.utcnow()
+        with session.begin(subtransactions=True):
+            updated = session.query(model).filter(
+                model.hostname == hostname,
+                column.is_(None) |
+                (column < now - datetime.timedelta(seconds=min_age))
+            ).update({column: now}, synchronize_session=False)
+        if updated:
+            self.inventory.update(hostname, **{column_name: now})
+        return bool(updated)
 
     def get_inuselb_by_hostname(self, session, hostname):
-        vapv = session.query(self.model_class).filter_by(hostname=hostname).first()
-        if vapv:
-            return vapv.in_use_lb
-        return -1
+        in_use_lb = session.query(self.model_class.in_use_lb).filter_by(
+            hostname=hostname
+        ).scalar()
+        if in_use_lb is None:
+            return -1
+        return in_use_lb
+
+
+class ArrayLbPlacementRepository(BaseRepository):
+    model_class = models.ArrayLbPlacement
+
+    def get_by_hostname(self, session, hostname):
+        """Returns the placements on a vAPV, oldest first."""
+        return [
+            model.to_dict() for model in session.query(
+                self.model_class
+            ).filter_by(hostname=hostname).order_by(
+                self.model_class.created_at
+            )
+        ]
+
+    def update_bandwidth(self, session, loadbalancer_id, bandwidth):
+        with session.begin(subtransactions=True):
+            session.query(self.model_class).filter_by(
+                loadbalancer_id=loadbalancer_id
+            ).update({"bandwidth": bandwidth})
+
+    def move(self, session, loadbalancer_id, hostname, identifier):
+        with session.begin(subtransactions=True):
+            session.query(self.model_class).filter_by(
+                loadbalancer_id=loadbalancer_id
+            ).update({"hostname": hostname, "identifier": identifier})
+
+
+class ArrayConfigChecksumRepository(BaseRepository):
+    model_class = models.ArrayConfigChecksum
+
+    def get_by_hostname(self, session, hostname):
+        """Returns the checksum records of a vAPV keyed by object_key."""
+        return dict(
+            (model.object_key, model.to_dict()) for model in session.query(
+                self.model_class
+            ).filter_by(hostname=hostname)
+        )
+
+    def save(self, session, hostname, object_key, expected, device):
+        now = datetime.datetime.utcnow()
+        with session.begin(subtransactions=True):
+            updated = session.query(self.model_class).filter_by(
+                hostname=hostname, object_key=object_key
+            ).update(
+                {"expected": expected, "device": device, "updated_at": now},
+                synchronize_session=False
+            )
+            if not updated:
+                session.add(self.model_class(
+                    hostname=hostname, object_key=object_key,
+                    expected=expected, device=device, updated_at=now
+                ))
+
+    def delete_stale(self, session, hostname, object_keys):
+        """Deletes the records of a vAPV's objects not in object_keys."""
+        query = session.query(self.model_class).filter(
+            self.model_class.hostname == hostname
+        )
+        if object_keys:
+            query = query.filter(
+                ~self.model_class.object_key.in_(list(object_keys))
+            )
+        with session.begin(subtransactions=True):
+            return query.delete(synchronize_session=False)
+
+    def delete_hostnames_except(self, session, hostnames):
+        """Deletes the records of vAPVs that no longer exist."""
+        query = session.query(self.model_class)
+        if hostnames:
+            query = query.filter(
+                ~self.model_class.hostname.in_(list(hostnames))
+            )
+        with session.begin(subtransactions=True):
+            return query.delete(synchronize_session=False)
+
+
+class ArrayConfigSnapshotRepository(BaseRepository):
+    model_class = models.ArrayConfigSnapshot
+
+    def get_latest(self, session, hostname):
+        model = session.query(self.model_class).filter_by(
+            hostname=hostname
+        ).order_by(self.model_class.version.desc()).first()
+        if not model:
+            return None
+        return model.to_dict()
+
+    def list_versions(self, session, hostname):
+        """Returns the snapshots of a vAPV without their content, newest
+        first."""
+        return [
+            model.to_dict(content=False) for model in session.query(
+                self.model_class
+            ).filter_by(hostname=hostname).order_by(
+                self.model_class.version.desc()
+            )
+        ]
+
+    def add_version(self, session, hostname, checksum, content, keep):
+        """Stores a new snapshot of a vAPV unless its latest snapshot has
+        the same checksum, and prunes all but the newest keep versions.
+
+        :returns: the new version number, or None if nothing changed.
+        """
+        latest = session.query(
+            self.model_class.version, self.model_class.checksum
+        ).filter_by(hostname=hostname).order_by(
+            self.model_class.version.desc()
+        ).first()
+        if latest is not None and latest.checksum == checksum:
+            return None
+        version = latest.version + 1 if latest is not None else 1
+        try:
+            with session.begin(subtransactions=True):
+                session.add(self.model_class(
+                    hostname=hostname, version=version, checksum=checksum,
+                    content=content, created_at=datetime.datetime.utcnow()
+                ))
+        except DUPLICATE_ENTRY_ERRORS:
+            # Taken by another neutron-server worker at the same time
+            return None
+        with session.begin(subtransactions=True):
+            session.query(self.model_class).filter(
+                self.model_class.hostname == hostname,
+                self.model_class.version <= version - keep
+            ).delete(synchronize_session=False)
+        return version
+
+    def delete_hostnames_except(self, session, hostnames):
+        """Deletes the snapshots of vAPVs that no longer exist."""
+        query = session.query(self.model_class)
+        if hostnames:
+            query = query.filter(
+                ~self.model_class.hostname.in_(list(hostnames))
+            )
+        with session.begin(subtransactions=True):
+            return query.delete(synchronize_session=False)
+
+
+class ReserveRepository(BaseRepository):
+    """Common methods for tables of pre-allocated resources."""
+
+    def count(self, session, **filters):
+        """Counts resources that are being built or are ready to claim."""
+        return session.query(self.model_class).filter(
+            self.model_class.status.in_(
+                [models.RESERVE_BUILDING, models.RESERVE_READY]
+            )
+        ).filter_by(**filters).count()
+
+    def claim(self, session, **filters):
+        """Atomically takes one ready resource out of the reserve.
+
+        The status is flipped with a conditional UPDATE so that only one
+        neutron-server worker can win a given resource.
+
+        :returns: the claimed record, or None if the reserve is empty.
+        """
+        query = session.query(self.model_class.id).filter_by(
+            status=models.RESERVE_READY, **filters
+        )
+        for (record_id,) in query.order_by(self.model_class.created_at):
+            with session.begin(subtransactions=True):
+                claimed = session.query(self.model_class).filter_by(
+                    id=record_id, status=models.RESERVE_READY
+                ).update(
+                    {"status": models.RESERVE_CLAIMED},
+                    synchronize_session=False
+                )
+            if claimed:
+                return self.get(session, id=record_id)
+        return None
+
+    def get_stale(self, session, max_age, **filters):
+        """Returns records stuck in BUILDING for longer than max_age secs."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=max_age
+        )
+        stale = session.query(self.model_class).filter(
+            self.model_class.status == models.RESERVE_BUILDING,
+            self.model_class.created_at < cutoff
+        ).filter_by(**filters).all()
+        return [record.to_dict() for record in stale]
+
+
+class ArrayStandbyVapvRepository(ReserveRepository):
+    model_class = models.ArrayStandbyVapv
+
+
+class ArrayMgmtReserveRepository(ReserveRepository):
+    model_class = models.ArrayMgmtReserve
+
+
+class ArraySpawnLockRepository(BaseRepository):
+    model_class = models.ArraySpawnLock
+
+    def acquire(self, session, hostname, owner):
+        """Takes the spawn lock for hostname.
+
+        The hostname is the primary key, so only one neutron-server worker
+        can insert the row.
+
+        :returns: True if the lock was taken, False if it is already held.
+        """
+        try:
+            with session.begin(subtransactions=True):
+                session.add(self.model_class(
+                    hostname=hostname, owner=owner,
+                    created_at=datetime.datetime.utcnow()
+                ))
+        except DUPLICATE_ENTRY_ERRORS:
+            return False
+        return True
+
+    def release(self, session, hostname, owner):
+        with session.begin(subtransactions=True):
+            session.query(self.model_class).filter_by(
+                hostname=hostname, owner=owner
+            ).delete(synchronize_session=False)
+
+    def acquire_or_break(self, session, hostname, owner, max_age):
+        """Takes the lock, breaking it first if held for over max_age secs.
+
+        :returns: True if the lock was taken.
+        """
+        if self.acquire(session, hostname, owner):
+            return True
+        return bool(self.break_stale(session, hostname, max_age)) and \
+            self.acquire(session, hostname, owner)
+
+    def refresh(self, session, hostname, owner):
+        """Restarts the age of a lock held by owner."""
+        with session.begin(subtransactions=True):
+            session.query(self.model_class).filter_by(
+                hostname=hostname, owner=owner
+            ).update({"created_at": datetime.datetime.utcnow()},
+                     synchronize_session=False)
+
+    def break_stale(self, session, hostname, max_age):
+        """Removes a lock on hostname held for longer than max_age secs."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=max_age
+        )
+        with session.begin(subtransactions=True):
+            return session.query(self.model_class).filter(
+                self.model_class.hostname == hostname,
+                self.model_class.created_at < cutoff
+            ).delete(synchronize_session=False)
@@ -21,24 +21,77 @@ LOG = logging.getLogger(__name__)
 
 lbaas_setting_opts = [
     cfg.BoolOpt('allow_different_host_hint', default=True, help=
-                'Deploy secondary instances on different compute node. '
+                'Deploy primary and secondary instances on different compute '
+                'nodes using a Nova anti-affinity server group. '
                 'DO NOT set to True if there is only one compute node '
                 '(e.g. DevStack)'),
     cfg.BoolOpt('allow_tenant_customizations', default=False,
                help='Allow certain global settings to be overriden on a '
                'per-tanant basis'),
+    cfg.IntOpt('autoscale_cooldown', default=1800, help=
+               'Seconds after an autoscaling action during which the vAPV '
+               'is not scaled again'),
+    cfg.BoolOpt('autoscale_enabled', default=False, help=
+                'Resize vAPVs (and, in the SHARED deployment model, move '
+                'loadbalancers between them) according to their '
+                'utilization'),
+    cfg.ListOpt('autoscale_flavors', default=[], help=
+                'Nova flavor IDs that vAPVs may be resized between, smallest '
+                'first'),
+    cfg.FloatOpt('autoscale_high_threshold', default=0.8, help=
+                 'Utilization (0-1) above which a vAPV is scaled up'),
+    cfg.IntOpt('autoscale_interval', default=60, help=
+               'Seconds between autoscaling checks. 0 disables the '
+               'autoscaler. Requires stats_collection_interval.'),
+    cfg.FloatOpt('autoscale_low_threshold', default=0.2, help=
+                 'Utilization (0-1) below which a vAPV is scaled down'),
+    cfg.IntOpt('autoscale_periods', default=3, help=
+               'Number of consecutive autoscaling checks for which the '
+               'utilization must stay beyond a threshold before acting'),
     cfg.BoolOpt('deploy_ha_pairs', default=False, help=
                 'If set to True, an HA pair of vAPVs will be deployed in '
                 'the PER_TENANT and PER_LOADBALANCER deployment models. '
                 'If False, single vAPV insatnces are deployed'),
+    cfg.IntOpt('customization_cache_ttl', default=300, help=
+               'Seconds for which a tenant\'s customizations are cached. '
+               '0 disables the cache.'),
+    cfg.IntOpt('customization_version_interval', default=10, help=
+               'Minimum number of seconds between checks for tenant '
+               'customizations changed by other processes'),
+    cfg.IntOpt('customizations_db_pool_size', default=5, help=
+               'Number of pooled connections to the tenant customizations '
+               'database'),
+    cfg.IntOpt('customizations_db_max_overflow', default=10, help=
+               'Number of connections to the tenant customizations database '
+               'that may be opened beyond the pool size under load'),
     cfg.StrOpt('deployment_model', help=
                'SHARED for a shared pool of vAPVs. '
                'PER_TENANT for deploying private vAPV instance per tenant. '
                'PER_LB for deploying private vAPV instance per loadbalancer.'
                'PER_SUBNET for deploying private vAPV instance per subnet.'
                ),
+    cfg.IntOpt('description_update_timeout', default=600, help=
+               'Maximum number of seconds to wait for a new loadbalancer to '
+               'leave PENDING_CREATE before giving up on adding the vAPV '
+               'details to its description'),
+    cfg.StrOpt('endpoint_cache_file', help=
+               'Optional file in which the Neutron and Nova endpoints found '
+               'in the Keystone catalog are cached, shared by all '
+               'neutron-server workers'),
+    cfg.IntOpt('endpoint_cache_ttl', default=3600, help=
+               'Seconds for which the on-disk endpoint cache is valid'),
     cfg.StrOpt('flavor_id',
                help='ID of flavor to use for vAPV instance'),
+    cfg.IntOpt('identity_cache_ttl', default=600, help=
+               'Seconds for which the vAPV identifier and hostname of each '
+               'loadbalancer are cached. Changes to a tenant\'s '
+               'deployment_model made from another process are picked up '
+               'after this interval. Loadbalancers on shared vAPVs are not '
+               'cached. 0 disables the cache.'),
+    cfg.IntOpt('inventory_refresh_interval', default=60, help=
+               'Seconds between reloads of the in-process index of vAPV '
+               'records, which picks up vAPVs created or deleted by other '
+               'neutron-server workers'),
     cfg.StrOpt('keystone_version', default="3",
                help='Version of Keystone API to use'),
     cfg.BoolOpt('https_offload', default=True,
@@ -56,35 +109,139 @@ lbaas_setting_opts = [
                       'dedicated mgmt network (MGMT_NET)'),
     cfg.StrOpt('management_network',
                help='Neutron ID of network for admin traffic'),
+    cfg.StrOpt('management_security_group', help=
+               'Neutron ID of a security group shared by all vAPV management '
+               'ports (e.g. lb-mgmt-sec-grp). Required for the MGMT_NET '
+               'management port reserve.'),
+    cfg.IntOpt('mgmt_reserve_size', default=0, help=
+               'Number of ready-made management ports (MGMT_NET) or '
+               'floating IPs (FLOATING_IP) to keep in reserve for new vAPVs. '
+               '0 disables the reserve.'),
+    cfg.IntOpt('mgmt_reserve_refill_interval', default=30, help=
+               'Seconds between checks that top up the management reserve'),
     cfg.StrOpt('openstack_password', default="password",
                help='Password of OpenStack admin account'),
     cfg.StrOpt('admin_project_id',
                help='Keystone ID of admin project'),
     cfg.StrOpt('openstack_username', default="admin",
                help='LBaaS instance container project'),
+    cfg.FloatOpt('placement_connections_weight', default=1.0, help=
+                 'Weight of current connections in the load score used to '
+                 'place new loadbalancers on shared vAPVs'),
+    cfg.FloatOpt('placement_headroom', default=0.2, help=
+                 'Fraction of a shared vAPV\'s capacity '
+                 '(vapv_max_connections, vapv_max_throughput) that must be '
+                 'left spare for it to take new loadbalancers'),
+    cfg.FloatOpt('placement_throughput_weight', default=1.0, help=
+                 'Weight of throughput in the load score used to place new '
+                 'loadbalancers on shared vAPVs'),
     cfg.StrOpt('primary_az', help='Availability Zone for primary vAPV'),
+    cfg.StrOpt('provider_name', default="arrayvapv", help=
+               'Name of this driver\'s service_provider entry in the '
+               'Neutron LBaaS configuration, used to find the '
+               'loadbalancers that it manages'),
+    cfg.IntOpt('reconcile_interval', default=0, help=
+               'Seconds between checks of the vAPVs\' running config '
+               'against Neutron, e.g. 300. 0 disables the reconciler. '
+               'Requires array_lbaas_init_db upgrade on existing '
+               'deployments.'),
+    cfg.IntOpt('reconcile_max_repairs', default=10, help=
+               'Maximum number of configuration objects repaired on one '
+               'vAPV per reconciler run'),
+    cfg.IntOpt('reconcile_max_vapvs', default=20, help=
+               'Maximum number of vAPVs checked per reconciler run; the '
+               'least recently checked go first'),
+    cfg.BoolOpt('reconcile_repair', default=False, help=
+                'Repair configuration objects that have drifted from '
+                'Neutron. A repair removes and recreates the object and '
+                'those depending on it, interrupting their traffic. If '
+                'False, drift is only logged.'),
     cfg.BoolOpt('roll_back_on_error', default=True, help=
                 'If True, an error during loadbalancer provisioning will '
                 'result in newly-created resources being deleted so as to '
                 'return the system to its previous state. Set to False if '
                 'you wish to leave resources in place for troubleshooting.'),
     cfg.StrOpt('secondary_az', help='Availability Zone for secondary vAPV'),
+    cfg.IntOpt('shared_max_bandwidth', default=0, help=
+               'SHARED deployment model: total bandwidth that the '
+               'loadbalancers placed on one vAPV may reserve. '
+               '0 means unlimited.'),
+    cfg.IntOpt('shared_max_listeners', default=200, help=
+               'SHARED deployment model: number of listeners above which '
+               'a vAPV takes no further loadbalancers. 0 means unlimited.'),
+    cfg.IntOpt('shared_max_loadbalancers', default=50, help=
+               'SHARED deployment model: maximum number of loadbalancers '
+               'placed on one vAPV'),
+    cfg.IntOpt('shared_max_members', default=1000, help=
+               'SHARED deployment model: number of pool members above which '
+               'a vAPV takes no further loadbalancers. 0 means unlimited.'),
     cfg.ListOpt('shared_subnets', help=
                 'List of Neutron subnet IDs that represent the available '
-                'shared subnets'),
+                'shared subnets. In the SHARED deployment model, '
+                'loadbalancers may only be created on these subnets if set.'),
+    cfg.IntOpt('stats_collection_interval', default=0, help=
+               'Seconds between reads of the connection and traffic '
+               'statistics of each vAPV, used for load-aware placement '
+               'and by the autoscaler. 0 disables collection.'),
+    cfg.IntOpt('subnet_cache_ttl', default=300, help=
+               'Seconds for which Neutron subnet details (CIDR, network, '
+               'gateway) are cached. 0 disables the cache.'),
+    cfg.IntOpt('snapshot_delay', default=0, help=
+               'Seconds after the last configuration change on a vAPV '
+               'before a snapshot of its configuration is taken. 0 '
+               'disables snapshots.'),
+    cfg.IntOpt('snapshot_versions', default=5, help=
+               'Number of configuration snapshots kept per vAPV'),
+    cfg.IntOpt('spawn_lock_timeout', default=1800, help=
+               'Seconds that a loadbalancer create waits for a vAPV being '
+               'spawned by a concurrent request before giving up.'),
     cfg.BoolOpt('specify_az', default=False, help=
                 'If set to true, admin can specify which Availibility Zones '
                 'the primary and secondary vAPVs are deployed in.'),
+    cfg.IntOpt('standby_pool_size', default=0, help=
+               'Number of pre-booted, unassigned vAPV instances to keep '
+               'ready in the LBaaS project so that new loadbalancers do not '
+               'wait for a Nova boot. Requires MGMT_NET management mode and '
+               'single (non-HA) instances. 0 disables the pool.'),
+    cfg.DictOpt('standby_pool_az_targets', default={}, help=
+                'Per Availability Zone standby pool targets, e.g. '
+                'nova-az1:2,nova-az2:1. Overrides standby_pool_size when '
+                'set.'),
+    cfg.IntOpt('standby_pool_refill_interval', default=60, help=
+               'Seconds between checks that top up the standby pool'),
+    cfg.IntOpt('standby_pool_build_timeout', default=1800, help=
+               'Seconds after which a standby vAPV that has not finished '
+               'booting is considered failed and is removed'),
     cfg.StrOpt('service_endpoint_address',
                help='Service Endpoint Address of Services Director cluster'
                ),
     cfg.StrOpt('tenant_customizations_db', help=
                'Database connection string for customizations DB '
-               '(<db_type>://<username>:<password>@<db_host>/<db_name>)')
+               '(<db_type>://<username>:<password>@<db_host>/<db_name>)'),
+    cfg.IntOpt('vapv_max_connections', default=100000, help=
+               'Number of concurrent connections that one vAPV is expected '
+               'to handle, used to score its load'),
+    cfg.IntOpt('vapv_max_throughput', default=1000, help=
+               'Throughput (Mbps) that one vAPV is expected to handle, used '
+               'to score its load'),
+    cfg.StrOpt('write_policy', default="ALL",
+               choices=["ALL", "PRIMARY", "QUORUM"], help=
+               'When a configuration change to the instances of an HA pair '
+               'completes: ALL once every instance has applied it, PRIMARY '
+               'once the primary has (the others catch up in the '
+               'background), QUORUM once a majority of the instances '
+               'have.'),
+    cfg.IntOpt('write_queue_max', default=1000, help=
+               'Number of configuration changes queued for an instance '
+               'that lags behind under the PRIMARY or QUORUM write_policy '
+               'before its queue is dropped and it must be resynced')
 ]
 services_director_setting_opts = [
     cfg.IntOpt('bandwidth',
-               help='Bandwidth allowance for vAPV instances')
+               help='Bandwidth allowance (Mbps) for vAPV instances, enforced '
+               'on the traffic interface. 0 means unlimited.'),
+    cfg.IntOpt('listener_bandwidth', default=0, help=
+               'Bandwidth limit (Mbps) of each listener. 0 means unlimited.')
 ]
 vapv_setting_opts = [
     cfg.IntOpt('admin_port', default=9090,
@@ -135,14 +292,31 @@ def check_required_settings(required):
         raise Exception(error_msg)
 
 
-if cfg.CONF.lbaas_settings.deployment_model is None:
-    raise Exception(
-        "LBaaS: No value for deployment_model in lbaas_settings. "
-        "Either the value is not in the Array LBaaS configuration file "
-        "or the configuration file was not passed to the neutron server."
-    )
+_selected_driver = None
 
-if cfg.CONF.lbaas_settings.deployment_model != "SHARED":
+
+def get_device_driver():
+    """
+    Validates the configuration and returns the device driver module for
+    the configured deployment model. The driver modules (and the client
+    libraries they pull in) are only imported on first call, so importing
+    this module just registers the configuration options.
+    """
+    global _selected_driver
+    if _selected_driver is not None:
+        return _selected_driver
+    if cfg.CONF.lbaas_settings.deployment_model is None:
+        raise Exception(
+            "LBaaS: No value for deployment_model in lbaas_settings. "
+            "Either the value is not in the Array LBaaS configuration file "
+            "or the configuration file was not passed to the neutron server."
+        )
+    if cfg.CONF.lbaas_settings.deployment_model == "SHARED" and \
+            cfg.CONF.lbaas_settings.deploy_ha_pairs is True:
+        raise Exception(
+            "LBaaS: The SHARED deployment model does not support HA pairs. "
+            "Set deploy_ha_pairs to False."
+        )
     check_required_settings({
         "lbaas_settings": {
             "flavor_id":
@@ -163,8 +337,11 @@ if cfg.CONF.lbaas_settings.deployment_model != "SHARED":
         "vapv_settings": {
         }
     })
-    if cfg.CONF.lbaas_settings.deploy_ha_pairs is True:
+    if cfg.CONF.lbaas_settings.deployment_model == "SHARED":
+        import driver_shared as selected_driver
+    elif cfg.CONF.lbaas_settings.deploy_ha_pairs is True:
         import driver_private_instances_ha as selected_driver
     else:
         import driver_private_instances as selected_driver
-device_driver = selected_driver
+    _selected_driver = selected_driver
+    return _selected_driver
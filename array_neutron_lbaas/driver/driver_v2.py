@@ -13,7 +13,7 @@
 #
 #
 
-from array_neutron_lbaas.device_driver import device_driver
+from array_neutron_lbaas import device_driver
 from neutron_lbaas.drivers import driver_base
 import threading
 import logging
@@ -30,7 +30,8 @@ class ArrayLoadBalancerDriver(driver_base.LoadBalancerBaseDriver):
         self.pool = ArrayPoolManager(self)
         self.member = ArrayMemberManager(self)
         self.health_monitor = ArrayHealthMonitorManager(self)
-        self.device_driver = device_driver.ArrayDeviceDriverV2(plugin)
+        self.device_driver = device_driver.get_device_driver().\
+            ArrayDeviceDriverV2(plugin)
 
 
 class ArrayLoadBalancerManager(driver_base.BaseLoadBalancerManager):
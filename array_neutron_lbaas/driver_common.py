@@ -15,24 +15,30 @@
 #
 #
 
-from array_neutron_lbaas_customizations_db import helper \
-    as customization_helper
+from array_neutron_lbaas.db import api as db_api
 from array_neutron_lbaas.db import repository
-from array_neutron_lbaas.array import device_driver
-from neutron_lbaas.common.tls_utils.cert_parser import get_host_names
+from array_neutron_lbaas.array import adc_config, device_driver
+from concurrency import PeriodicWorker
+from identity import IdentityResolver
 from openstack_connector import OpenStackInterface
 from oslo_config import cfg
 from oslo_log import log as logging
 from traceback import format_exc
-try:
-    from neutron_lbaas.common.cert_manager import CERT_MANAGER_PLUGIN
-except ImportError:
-    from neutron_lbaas.common import cert_manager
-    CERT_MANAGER_PLUGIN = cert_manager.get_backend()
 
 LOG = logging.getLogger(__name__)
 
 
+def get_cert_manager():
+    # The cert manager backend (e.g. Barbican) is only loaded when a
+    # TERMINATED_HTTPS listener first needs a certificate
+    try:
+        from neutron_lbaas.common.cert_manager import CERT_MANAGER_PLUGIN
+    except ImportError:
+        from neutron_lbaas.common import cert_manager
+        CERT_MANAGER_PLUGIN = cert_manager.get_backend()
+    return CERT_MANAGER_PLUGIN.CertManager
+
+
 def logging_wrapper(lbaas_func):
     def log_writer(*args):
         LOG.debug(
@@ -65,17 +71,30 @@ class vAPVDeviceDriverCommon(object):
 
     def __init__(self):
         self.openstack_connector = OpenStackInterface()
-        self.certificate_manager = CERT_MANAGER_PLUGIN.CertManager
         self.array_amphora_db = repository.ArrayAmphoraRepository()
         self.array_vapv_driver = device_driver.ArrayADCDriver()
-        # Get connector to tenant customizations database if enabled...
-        if cfg.CONF.lbaas_settings.allow_tenant_customizations is True:
-            self.customizations_db = customization_helper.\
-                ArrayLbaasTenantCustomizationsDatabaseHelper(
-                    cfg.CONF.lbaas_settings.tenant_customizations_db
-                )
-        else:
-            self.customizations_db = None
+        # Tenant customizations are shared with the OpenStack connector
+        self.tenant_settings = self.openstack_connector.tenant_settings
+        self.customizations_db = self.tenant_settings.helper
+        # Memoized loadbalancer -> vAPV identifier/hostname lookups
+        self.identity = IdentityResolver(
+            self.openstack_connector.get_identifier, self._format_hostname,
+            cfg.CONF.lbaas_settings.identity_cache_ttl,
+            self._is_cacheable_identifier
+        )
+        self.tenant_settings.add_listener(self.identity.customization_changed)
+        # Load the amphora inventory index now and keep it in step with
+        # changes made by other neutron-server workers
+        self.inventory_refresher = PeriodicWorker(
+            self._refresh_inventory,
+            cfg.CONF.lbaas_settings.inventory_refresh_interval,
+            name="vapv-inventory"
+        )
+        self.inventory_refresher.start()
+
+    @property
+    def certificate_manager(self):
+        return get_cert_manager()
 
 #############
 # LISTENERS #
@@ -96,7 +115,7 @@ class vAPVDeviceDriverCommon(object):
             self._clean_up_certificates(vapv, listener.id)
         # Modify Neutron security group to allow access to data port...
         if use_security_group:
-            identifier = self.openstack_connector.get_identifier(lb)
+            identifier = self.identity.identifier(lb)
             if not old or old.protocol_port != listener.protocol_port:
                 LOG.debug("will allow port %s", str(listener.protocol_port))
                 protocol = 'udp' if listener.protocol == "UDP" else 'tcp'
@@ -113,6 +132,7 @@ class vAPVDeviceDriverCommon(object):
             self.array_vapv_driver.update_listener(lb, listener, old, vapv)
         else:
             self.array_vapv_driver.create_listener(lb, listener, vapv)
+        self._update_listener_bandwidths(lb, vapv)
 
     def delete_listener(self, context, listener, vapv, use_security_group=False):
         # Delete associated SSL certificates
@@ -121,14 +141,15 @@ class vAPVDeviceDriverCommon(object):
         if use_security_group:
             # Delete security group rule for the listener port/protocol
             protocol = 'udp' if listener.protocol == "UDP" else 'tcp'
-            identifier = self.openstack_connector.get_identifier(
-                listener.loadbalancer
-            )
+            identifier = self.identity.identifier(listener.loadbalancer)
             self.openstack_connector.block_port(
                 listener.loadbalancer, listener.protocol_port, identifier,
                 protocol
             )
         self.array_vapv_driver.delete_listener(listener, vapv)
+        self._update_listener_bandwidths(
+            listener.loadbalancer, vapv, deleted_listener=listener
+        )
 
 #########
 # POOLS #
@@ -305,23 +326,66 @@ class vAPVDeviceDriverCommon(object):
 # MISC #
 ########
 
+    def _refresh_inventory(self):
+        self.array_amphora_db.load_inventory(db_api.get_admin_session())
+
+    def _is_cacheable_identifier(self, identifier):
+        return True
+
     def _get_setting(self, tenant_id, section, param):
-        setting = None
-        if self.customizations_db:
-            setting = self.customizations_db.get_customization(
-                tenant_id, section, param
+        return self.tenant_settings.get(tenant_id, section, param)
+
+    def _get_listener_bandwidth(self, lb, listener_count):
+        """
+        Returns the rate limit (Mbps, 0 for none) of each of the
+        loadbalancer's listeners: the tenant's listener_bandwidth and, on
+        vAPVs shared by several loadbalancers, an equal share of the
+        loadbalancer's bandwidth, whichever is lower.
+        """
+        limits = []
+        listener_bandwidth = self._get_setting(
+            lb.tenant_id, "services_director_settings", "listener_bandwidth"
+        )
+        if listener_bandwidth:
+            limits.append(int(listener_bandwidth))
+        lb_bandwidth = getattr(lb, "bandwidth", 0) or 0
+        if lb_bandwidth and listener_count and self._get_setting(
+                lb.tenant_id, "lbaas_settings",
+                "deployment_model") != "PER_LOADBALANCER":
+            limits.append(max(1, lb_bandwidth / listener_count))
+        return min(limits) if limits else 0
+
+    def _update_listener_bandwidths(self, lb, vapv, deleted_listener=None,
+                                    force=False):
+        """
+        Applies the listener rate limits of a loadbalancer to the vAPV.
+        Nothing is pushed when there is no limit, unless force is True
+        (e.g. to remove a limit after the loadbalancer's bandwidth was
+        cleared).
+        """
+        listeners = [
+            listener for listener in lb.listeners
+            if deleted_listener is None or listener.id != deleted_listener.id
+        ]
+        bandwidth = self._get_listener_bandwidth(lb, len(listeners))
+        if not bandwidth and not force:
+            return
+        for listener in listeners:
+            self.array_vapv_driver.update_listener_bandwidth(
+                listener, vapv, bandwidth
             )
-        if setting is None:
-            global_section = getattr(cfg.CONF, section)
-            setting = getattr(global_section, param)
-        return setting
+
+    def _render_configuration(self, lb):
+        """
+        Returns the device configuration objects of a loadbalancer, in
+        the order in which they must be created.
+        """
+        return adc_config.render_loadbalancer(
+            lb, self._get_listener_bandwidth(lb, len(lb.listeners))
+        )
 
     def _get_custom_settings(self, tenant_id):
-        if self.customizations_db:
-            return self.customizations_db.get_all_tenant_customizations(
-                tenant_id
-            )
-        return None
+        return self.tenant_settings.get_all(tenant_id)
 
     def _codes_to_regex(self, status_codes):
         return "({})".format("|".join(
@@ -397,6 +461,7 @@ class vAPVDeviceDriverCommon(object):
         }
         # Configure SNI certificates
         if listener.sni_containers:
+            from neutron_lbaas.common.tls_utils import cert_parser
             for sni_container in listener.sni_containers:
                 container_id = self._get_container_id(
                     sni_container.tls_container_id
@@ -406,7 +471,9 @@ class vAPVDeviceDriverCommon(object):
                     vapv, listener.id, sni_container.tls_container_id
                 )
                 # Get CN and subjectAltNames from certificate
-                cert_hostnames = get_host_names(cert.get_certificate())
+                cert_hostnames = cert_parser.get_host_names(
+                    cert.get_certificate()
+                )
                 # Add the CN and the certificate to the virtual server
                 # SNI certificate mapping table
                 ssl_settings['server_cert_host_mapping'].append(
@@ -15,14 +15,25 @@
 #
 #
 
+from array_neutron_lbaas.db import api as db_api
+from autoscaler import Autoscaler
+from concurrency import PeriodicWorker
 from driver_common import vAPVDeviceDriverCommon, logging_wrapper
 from oslo_config import cfg
 from oslo_log import log as logging
-from threading import Thread
-from time import sleep
+from reconciler import Reconciler
+from snapshots import ConfigSnapshots
+from spawn_registry import SpawnRegistry
+from standby_pool import StandbyPool
+from stats_collector import StatsCollector
+from threading import Lock
+from time import sleep, time
 
 LOG = logging.getLogger(__name__)
 
+# Seconds between checks of loadbalancers waiting for a description update
+DESCRIPTION_POLL_INTERVAL = 3
+
 
 class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
     """
@@ -31,6 +42,28 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
 
     def __init__(self, plugin):
         super(ArrayDeviceDriverV2, self).__init__()
+        self.plugin = plugin
+        self.standby_pool = StandbyPool(self.openstack_connector)
+        self.spawn_registry = SpawnRegistry()
+        self.description_poller = DescriptionPoller(self.openstack_connector)
+        if self.standby_pool.enabled:
+            self.standby_pool.start()
+        if self.openstack_connector.mgmt_reserve.enabled:
+            self.openstack_connector.mgmt_reserve.start()
+        self.stats_collector = StatsCollector(
+            self.array_vapv_driver, self.array_amphora_db
+        )
+        self.autoscaler = Autoscaler(self)
+        if self.stats_collector.enabled:
+            self.stats_collector.start()
+            if self.autoscaler.enabled:
+                self.autoscaler.start()
+        self.reconciler = Reconciler(self)
+        if self.reconciler.enabled:
+            self.reconciler.start()
+        self.snapshots = ConfigSnapshots(self)
+        if self.snapshots.enabled:
+            self.snapshots.start()
         LOG.info("\nArray vAPV LBaaS module initialized.")
 
     @logging_wrapper
@@ -41,76 +74,53 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
         will always be spawned by this call.  If the deployemnt model is
         PER_TENANT, a new instance will only be spawned if one does not
         already exist for the tenant.
+
+        :returns: True if this call spawned and recorded the vAPV.
         """
         self._assert_not_mgmt_network(lb.vip_subnet_id)
         deployment_model = self._get_setting(
             lb.tenant_id, "lbaas_settings", "deployment_model"
         )
-        mgmt_ip = None
         vapv = None
-        ports = None
         existed = True
-        network_config = {}
         hostname = self._get_hostname(lb)
 
         LOG.debug("enter create_loadbalancer: ", deployment_model)
         if deployment_model == "PER_LOADBALANCER":
-            ports = self._spawn_vapv(hostname, lb)
+            self._create_subnet_vapv(context, hostname, lb)
+            existed = False
         elif deployment_model == "PER_SUBNET":
-            # In case several loadbalancers are created in a batch, give an
-            # existing instance time to come up before spawning a new one.
-            count = 0
-            if self.openstack_connector.subnet_in_use(lb):
-                while not self.openstack_connector.vapv_exists(hostname):
-                    count += 1
-                    sleep(5)
-                    if count > 5:
-                        break;
-            # No instance is coming up so spawn one.
-            if not self.openstack_connector.vapv_exists(hostname):
-                LOG.debug("will create vapv vm")
-                existed = False
-                ports = self._spawn_vapv(hostname, lb)
-                sleep(5)
+            # If several loadbalancers are created on the subnet in a batch,
+            # only the first spawns the instance; the others wait for it.
+            existed = not self.spawn_registry.run_once(
+                hostname,
+                exists=lambda: self._vapv_registered(context, hostname),
+                spawn=lambda: self._create_subnet_vapv(context, hostname, lb)
+            )
         elif deployment_model == "PER_TENANT":
-            if not self.openstack_connector.vapv_exists(lb.tenant_id, hostname):
-                ports = self._spawn_vapv(hostname, lb)
-                sleep(5)
-            elif not self.openstack_connector.vapv_has_subnet_port(hostname,lb):
+            # The tenant's vAPV is spawned and recorded once, as above
+            existed = not self.spawn_registry.run_once(
+                hostname,
+                exists=lambda: self._vapv_registered(context, hostname) or
+                self.openstack_connector.vapv_exists(hostname),
+                spawn=lambda: self._create_subnet_vapv(context, hostname, lb)
+            )
+            if existed and not self.openstack_connector.vapv_has_subnet_port(
+                    hostname, lb):
                 self._attach_subnet_port(hostname, lb)
 
-        if ports:
-            if type(hostname) is tuple:
-                pass #FIXME
-            else:
-                mgmt_port = ports['mgmt']
-                data_port = ports['data']
-                if mgmt_port:
-                    mgmt_ip = mgmt_port['fixed_ips'][0]['ip_address']
-                network_config['pri_data_ip'] = data_port['fixed_ips'][0]['ip_address']
-                network_config['pri_data_netmask'] = self.openstack_connector.get_subnet_netmask(lb.vip_subnet_id)
-        else:
-            mgmt_ip = self.openstack_connector.get_mgmt_ip(hostname)
-            data_port = self.openstack_connector.get_server_ports(hostname)
-
         LOG.debug("hostname is: --%s--", hostname)
         if existed:
-            self.array_amphora_db.increment_inuselb(context.session, hostname)
-            vapv = self.array_amphora_db.get_vapv_by_hostname(context.session, hostname)
-        else:
-            vapv = self.create_vapv(context, tenant_id=lb.tenant_id,
-                subnet_id=lb.vip_subnet_id,
-                pri_mgmt_address=mgmt_ip,
-                in_use_lb=1,
-                hostname=hostname
+            self.array_amphora_db.increment_inuselb(
+                context.session, self._get_record_hostname(hostname)
             )
-            self.array_vapv_driver.create_loadbalancer(lb, vapv, network_config)
+        vapv = self.array_amphora_db.get_vapv_by_hostname(
+            context.session, self._get_record_hostname(hostname)
+        )
 
         LOG.debug("create lb vapv: --%s--", vapv)
-        description_updater_thread = DescriptionUpdater(
-            self.openstack_connector, lb, hostname
-        )
-        description_updater_thread.start()
+        self.description_poller.add(lb)
+        return not existed
 
     @logging_wrapper
     def update_loadbalancer(self, context, lb, old):
@@ -124,7 +134,7 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
             lb.tenant_id, "lbaas_settings", "deployment_model"
         )
         hostname = self._get_hostname(lb)
-        if deployment_model in ["PER_TENANT", "PER_SUBNET"]:
+        if deployment_model in ["PER_TENANT", "PER_SUBNET", "SHARED"]:
             # Update allowed_address_pairs
             if not old or lb.vip_address != old.vip_address:
                 port_ids = self.openstack_connector.get_server_port_ids(
@@ -133,9 +143,7 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
                 self.openstack_connector.add_ip_to_ports(
                     lb.vip_address, port_ids
                 )
-        # Update bandwidth allocation
-        #if old is not None and old.bandwidth != lb.bandwidth:
-        #    self._update_instance_bandwidth(hostname, lb.bandwidth)
+        self._update_bandwidth(context, lb, old)
 
     @logging_wrapper
     def delete_loadbalancer(self, context, lb):
@@ -152,8 +160,11 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
         )
         deleted = False
         hostname = self._get_hostname(lb)
+        record_hostname = self._get_record_hostname(hostname)
         if deployment_model in ["PER_TENANT", "PER_SUBNET"]:
-            inuse = self.array_amphora_db.get_inuselb_by_hostname(context.session, hostname)
+            inuse = self.array_amphora_db.get_inuselb_by_hostname(
+                context.session, record_hostname
+            )
             if inuse < 2:
                 LOG.debug(
                     "\ndelete_loadbalancer({}): "
@@ -162,13 +173,19 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
                 deleted = True
                 self._destroy_vapv(hostname, lb)
         elif deployment_model == "PER_LOADBALANCER":
+            deleted = True
             self._destroy_vapv(hostname, lb)
 
         # update the db
         if deleted:
-            self.array_amphora_db.delete(context.session, hostname=hostname)
+            self.array_amphora_db.delete(
+                context.session, hostname=record_hostname
+            )
         else:
-            self.array_amphora_db.decrement_inuselb(context.session, hostname)
+            self.array_amphora_db.decrement_inuselb(
+                context.session, record_hostname
+            )
+        self.identity.invalidate(lb.id)
 
 #############
 # LISTENERS #
@@ -198,7 +215,7 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
         deployment_model = self._get_setting(
             pool.tenant_id, "lbaas_settings", "deployment_model"
         )
-        if deployment_model in ["PER_TENANT", "PER_SUBNET"]:
+        if deployment_model in ["PER_TENANT", "PER_SUBNET", "SHARED"]:
             hostname = self._get_hostname(pool.root_loadbalancer)
         elif deployment_model == "PER_LOADBALANCER":
             if pool.listener.loadbalancer is not None:
@@ -257,7 +274,7 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
         )
         hostname = self._get_hostname(loadbalancer)
         vapv = self._get_vapv(context, hostname)
-        if deployment_model in ["PER_TENANT", "PER_SUBNET"]:
+        if deployment_model in ["PER_TENANT", "PER_SUBNET", "SHARED"]:
             return super(ArrayDeviceDriverV2, self).stats(
                 vapv, loadbalancer.vip_address
             )
@@ -268,12 +285,174 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
 # MISC #
 ########
 
+    def get_loadbalancers(self, context, filters=None):
+        """
+        Returns the loadbalancers of this provider as Neutron data models.
+        """
+        provider_name = cfg.CONF.lbaas_settings.provider_name
+        return [
+            lb for lb in self.plugin.db.get_loadbalancers(
+                context, filters=filters
+            )
+            if lb.provider is not None and
+            lb.provider.provider_name == provider_name
+        ]
+
+    def get_hosted_loadbalancers(self, context, vapv):
+        """
+        Returns the loadbalancers on a vAPV, looking only at those of the
+        tenant it was recorded for.
+        """
+        return self.get_vapv_loadbalancers(
+            context, self.get_loadbalancers(
+                context, filters={"tenant_id": [vapv['tenant_id']]}
+            )
+        ).get(vapv['hostname'], (vapv, []))[1]
+
+    def get_vapv_loadbalancers(self, context, loadbalancers,
+                               unresolved=None):
+        """
+        Groups loadbalancers by the vAPV that hosts them. Returns a dict of
+        hostname: (vAPV record, [loadbalancer, ...]); loadbalancers whose
+        vAPV has no record (e.g. PER_LOADBALANCER and PER_TENANT ones) are
+        left out, and appended to unresolved if it is a list.
+        """
+        vapvs = {}
+        for lb in loadbalancers:
+            try:
+                vapv = self._get_vapv(context, self._get_hostname(lb))
+            except Exception as e:
+                LOG.warning("\nNo vAPV found for loadbalancer {}: {}".format(
+                    lb.id, e
+                ))
+                vapv = None
+            if vapv is None:
+                if unresolved is not None:
+                    unresolved.append(lb)
+                continue
+            vapvs.setdefault(vapv['hostname'], (vapv, []))[1].append(lb)
+        return vapvs
+
     def _get_hostname(self, lb):
-        identifier = self.openstack_connector.get_identifier(lb)
+        return self.identity.hostname(lb)
+
+    def _format_hostname(self, identifier):
         return "vapv-{}".format(identifier)
 
+    def _get_record_hostname(self, hostname):
+        # HA pairs are recorded under the primary's hostname
+        if isinstance(hostname, tuple):
+            return hostname[0]
+        return hostname
+
+    def _update_bandwidth(self, context, lb, old):
+        """
+        Applies a change of the loadbalancer's bandwidth: a vAPV of its
+        own is limited as a whole, otherwise the loadbalancer's listeners
+        are.
+        """
+        if old is None or \
+                getattr(old, "bandwidth", 0) == getattr(lb, "bandwidth", 0):
+            return
+        deployment_model = self._get_setting(
+            lb.tenant_id, "lbaas_settings", "deployment_model"
+        )
+        hostname = self._get_hostname(lb)
+        if deployment_model == "PER_LOADBALANCER":
+            self._update_instance_bandwidth(
+                hostname, self._get_instance_bandwidth(lb)
+            )
+        else:
+            self._update_listener_bandwidths(
+                lb, self._get_vapv(context, hostname), force=True
+            )
+
     def _update_instance_bandwidth(self, hostnames, bandwidth):
-        pass
+        """
+        Applies a bandwidth allocation (Mbps, 0 for none) to the traffic
+        interface of a vAPV (or of both members of an HA pair).
+        """
+        if isinstance(hostnames, basestring):
+            hostnames = (hostnames,)
+        vapv = self.array_amphora_db.get_vapv_by_hostname(
+            db_api.get_admin_session(), hostnames[0]
+        )
+        if vapv is None:
+            # PER_LOADBALANCER vAPVs have no record; find them in Nova
+            vapv = {
+                "hostname": hostnames[0],
+                "pri_mgmt_address": self.openstack_connector.get_mgmt_ip(
+                    hostnames[0]
+                ),
+                "sec_mgmt_address": self.openstack_connector.get_mgmt_ip(
+                    hostnames[1]
+                ) if len(hostnames) > 1 else None
+            }
+        self.array_vapv_driver.update_instance_bandwidth(vapv, bandwidth)
+        LOG.debug("\nBandwidth of vAPV {} set to {}".format(
+            hostnames[0], bandwidth
+        ))
+
+    def _get_instance_bandwidth(self, lb):
+        """
+        Returns the bandwidth allocation of a new vAPV: the loadbalancer's
+        own bandwidth if the vAPV is for it alone, otherwise (or if it has
+        none) the tenant's services_director_settings bandwidth.
+        """
+        deployment_model = self._get_setting(
+            lb.tenant_id, "lbaas_settings", "deployment_model"
+        )
+        bandwidth = getattr(lb, "bandwidth", 0) or 0
+        if deployment_model != "PER_LOADBALANCER" or not bandwidth:
+            bandwidth = self._get_setting(
+                lb.tenant_id, "services_director_settings", "bandwidth"
+            )
+        return int(bandwidth or 0)
+
+    def scale_up(self, vapv, flavors):
+        """
+        Autoscaler hook: resizes the vAPV to the next larger of flavors.
+        Returns True if it did.
+        """
+        return self._resize_vapv(vapv, flavors, 1)
+
+    def scale_down(self, vapv, flavors):
+        """
+        Autoscaler hook: resizes the vAPV to the next smaller of flavors.
+        Returns True if it did.
+        """
+        return self._resize_vapv(vapv, flavors, -1)
+
+    def _resize_vapv(self, vapv, flavors, step):
+        hostnames = self._get_instance_hostnames(vapv)
+        server_ids = [
+            self.openstack_connector.get_server_id_from_hostname(hostname)
+            for hostname in hostnames
+        ]
+        current = self.openstack_connector.get_server_flavor(server_ids[0])
+        if current not in flavors:
+            LOG.warning(
+                "\nCannot resize vAPV {}: flavor {} is not one of the "
+                "autoscale_flavors".format(vapv['hostname'], current)
+            )
+            return False
+        index = flavors.index(current) + step
+        if index < 0 or index >= len(flavors):
+            return False
+        # Members of an HA pair are resized one at a time, the secondary
+        # first, so that one of them keeps serving traffic
+        for server_id in reversed(server_ids):
+            self.openstack_connector.resize_server(server_id, flavors[index])
+        LOG.info("\nvAPV {} resized from flavor {} to {}".format(
+            vapv['hostname'], current, flavors[index]
+        ))
+        return True
+
+    def _get_instance_hostnames(self, vapv):
+        """
+        Returns the hostnames of the Nova instances of a vAPV record.
+        """
+        return [vapv['hostname']]
 
     def _get_vapv(self, context, hostname):
         """
@@ -288,6 +467,61 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
             raise Exception("Could not contact vAPV instance")
         return self.array_amphora_db.get_vapv_by_hostname(context.session, hostname)
 
+    def _vapv_registered(self, context, hostname):
+        # Decides whether to spawn, so the index alone is not trusted
+        return self.array_amphora_db.get_vapv_by_hostname(
+            context.session, self._get_record_hostname(hostname),
+            confirm=True
+        ) is not None
+
+    def _create_subnet_vapv(self, context, hostname, lb, identifier=None,
+                            **record):
+        """
+        Spawns the vAPV for a subnet, tenant or loadbalancer and records it
+        with in_use_lb=1. Any record keyword arguments override the fields
+        of the new vAPV record. The members of an HA pair are recorded
+        together, under the primary's hostname, and configured as a virtual
+        cluster. The bandwidth allocation is part of the first
+        configuration, which waits for the new instances to answer.
+        """
+        LOG.debug("will create vapv vm")
+        ports = self._spawn_vapv(hostname, lb, identifier)
+        sleep(5)
+        mgmt_ip = None
+        sec_mgmt_ip = None
+        network_config = {}
+        netmask = self.openstack_connector.get_subnet_netmask(lb.vip_subnet_id)
+        if type(hostname) is tuple:
+            primary = ports[hostname[0]]
+            secondary = ports[hostname[1]]
+            mgmt_ip = primary['mgmt_ip']
+            sec_mgmt_ip = secondary['mgmt_ip']
+            network_config['pri_data_ip'] = \
+                primary['ports']['data']['fixed_ips'][0]['ip_address']
+            network_config['sec_data_ip'] = \
+                secondary['ports']['data']['fixed_ips'][0]['ip_address']
+            network_config['pri_data_netmask'] = netmask
+        else:
+            mgmt_port = ports['mgmt']
+            data_port = ports['data']
+            if mgmt_port:
+                mgmt_ip = mgmt_port['fixed_ips'][0]['ip_address']
+            network_config['pri_data_ip'] = data_port['fixed_ips'][0]['ip_address']
+            network_config['pri_data_netmask'] = netmask
+        network_config['bandwidth'] = self._get_instance_bandwidth(lb)
+        fields = dict(tenant_id=lb.tenant_id,
+            subnet_id=lb.vip_subnet_id,
+            pri_mgmt_address=mgmt_ip,
+            sec_mgmt_address=sec_mgmt_ip,
+            in_use_lb=1,
+            hostname=self._get_record_hostname(hostname)
+        )
+        fields.update(record)
+        vapv = self.create_vapv(context, **fields)
+        self.array_vapv_driver.create_loadbalancer(lb, vapv, network_config)
+        if vapv.get('sec_mgmt_address'):
+            self.array_vapv_driver.configure_cluster(vapv, [lb.vip_address])
+
     def _assert_not_mgmt_network(self, subnet_id):
         network_id = self.openstack_connector.get_network_for_subnet(subnet_id)
         if network_id == cfg.CONF.lbaas_settings.management_network:
@@ -299,13 +533,19 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
     def _detach_subnet_port(self, hostname, lb):
         pass
 
-    def _spawn_vapv(self, hostname, lb):
+    def _spawn_vapv(self, hostname, lb, identifier=None):
         """
         Creates a vAPV instance as a Nova VM.
         The VM is registered with Services Director to provide licensing and
         configuration proxying.
         """
-        identifier = self.openstack_connector.get_identifier(lb)
+        if identifier is None:
+            identifier = self.identity.identifier(lb)
+        # Use a pre-booted instance from the standby pool if there is one
+        if self.standby_pool.enabled:
+            ports = self.standby_pool.claim(hostname, lb, identifier)
+            if ports is not None:
+                return ports
         # Initialize lists for roll-back on error
         port_ids = []
         security_groups = []
@@ -333,15 +573,6 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
                 security_groups = [sec_grp, mgmt_sec_grp]
                 port_ids.append(data_port['id'])
                 port_ids.append(mgmt_port['id'])
-            # Register instance record...
-            try:
-                bandwidth = lb.bandwidth
-                if bandwidth == 0:
-                    raise AttributeError()
-            except AttributeError:
-                bandwidth = self._get_setting(
-                    lb.tenant_id, "services_director_settings", "bandwidth"
-                )
             # Start instance...
             vm = self.openstack_connector.create_vapv(hostname, lb, ports)
             vms.append(vm['id'])
@@ -367,33 +598,82 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverCommon):
         rather than actually deleting it from the database).
         """
         self.openstack_connector.destroy_vapv(hostname, lb)
+        self.openstack_connector.invalidate_subnet(lb.vip_subnet_id)
         LOG.debug("\nvAPV {} destroyed".format(hostname))
 
 
-class DescriptionUpdater(Thread):
-    def __init__(self, os_conn, lb, hostnames):
-        self.openstack_connector = os_conn
-        self.lb = lb
-        if isinstance(hostnames, basestring):
-            self.hostnames = [hostnames]
-        else:
-            self.hostnames = hostnames
-        super(DescriptionUpdater, self).__init__()
+class DescriptionPoller(object):
+    """
+    Waits for newly created loadbalancers to leave PENDING_CREATE and then
+    adds the vAPV details to their descriptions. A single background thread
+    checks all pending loadbalancers with one list_loadbalancers call per
+    tick.
+    """
 
-    def run(self):
-        ip_addresses = []
+    def __init__(self, openstack_connector):
+        self.openstack_connector = openstack_connector
+        self.pending = {}
+        self.poller = None
+        self._lock = Lock()
+
+    def add(self, lb):
+        deadline = time() + cfg.CONF.lbaas_settings.description_update_timeout
+        with self._lock:
+            self.pending[lb.id] = (lb, deadline)
+            if self.poller is None:
+                self.poller = PeriodicWorker(
+                    self.poll, DESCRIPTION_POLL_INTERVAL,
+                    name="vapv-description-poller"
+                )
+                self.poller.start()
+
+    def poll(self):
+        with self._lock:
+            pending = dict(self.pending)
+        if not pending:
+            return
         neutron = self.openstack_connector.get_neutron_client()
-        while True:
-            lb = neutron.show_loadbalancer(self.lb.id)
-            if lb['loadbalancer']['provisioning_status'] != "PENDING_CREATE":
-                break
-            sleep(3)
+        statuses = {
+            lb['id']: lb['provisioning_status']
+            for lb in neutron.list_loadbalancers(
+                id=pending.keys(), fields=["id", "provisioning_status"]
+            )['loadbalancers']
+        }
+        now = time()
+        finished = []
+        for lb_id, (lb, deadline) in pending.iteritems():
+            status = statuses.get(lb_id)
+            if status == "PENDING_CREATE":
+                if now > deadline:
+                    LOG.warning(
+                        "\nGave up waiting for loadbalancer {} to leave "
+                        "PENDING_CREATE".format(lb_id)
+                    )
+                    finished.append(lb_id)
+                continue
+            finished.append(lb_id)
+            # A loadbalancer that is no longer listed has been deleted
+            if status is not None:
+                self._update_description(neutron, lb)
+        with self._lock:
+            for lb_id in finished:
+                self.pending.pop(lb_id, None)
+
+    def _update_description(self, neutron, lb):
+        ip_addresses = []
         body = {"loadbalancer": {
             "description": "{} {}".format(
-                self.lb.description,
+                lb.description,
                 "(vAPVs: {}; VIP: {})".format(
-                    ", ".join(ip_addresses), self.lb.vip_address
+                    ", ".join(ip_addresses), lb.vip_address
                 )
             )
         }}
-        neutron.update_loadbalancer(self.lb.id, body)
+        try:
+            neutron.update_loadbalancer(lb.id, body)
+        except Exception as e:
+            LOG.error(
+                "\nError updating description of loadbalancer {}: {}".format(
+                    lb.id, e
+                )
+            )
@@ -15,9 +15,11 @@
 #
 #
 
+from concurrency import ParallelExecutionError, run_in_parallel
 from driver_common import logging_wrapper
 from driver_private_instances import ArrayDeviceDriverV2 \
     as vAPVDeviceDriverPrivateInstances
+from functools import partial
 from oslo_config import cfg
 from oslo_log import log as logging
 
@@ -38,27 +40,30 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
         PER_TENANT, a new cluster will only be spawned if one does not
         already exist for the tenant.
         """
-        super(ArrayDeviceDriverV2, self).create_loadbalancer(context, lb)
-        deployment_model = self._get_setting(
-            lb.tenant_id, "lbaas_settings", "deployment_model"
+        spawned = super(ArrayDeviceDriverV2, self).create_loadbalancer(
+            context, lb
         )
-        if deployment_model == "PER_LOADBALANCER":
-            self.update_loadbalancer(context, lb, None)
+        # A newly spawned pair was configured as a cluster owning the VIP
+        self._update_loadbalancer(context, lb, None, cluster_configured=spawned)
+        return spawned
 
     @logging_wrapper
     def update_loadbalancer(self, context, lb, old):
         """
-        Creates or updates a TrafficIP group for the loadbalancer VIP address.
-        The VIP is added to the allowed_address_pairs of the vAPV's
-        Neutron port to enable it to receive traffic to this address.
+        Adds the loadbalancer VIP to the virtual cluster of the vAPV pair,
+        so that the appliances fail it over between themselves. The VIP is
+        added to the allowed_address_pairs of both vAPVs' Neutron ports to
+        enable either of them to receive traffic to this address.
         Can update the bandwidth allocation to the vAPV cluster members.
         """
+        self._update_loadbalancer(context, lb, old)
+
+    def _update_loadbalancer(self, context, lb, old, cluster_configured=False):
         LOG.debug("\nupdate_loadbalancer({}): called".format(lb.id))
         hostnames = self._get_hostname(lb)
-        # Update the TrafficIP group
-        vapv = self._get_vapv(hostnames)
-        # Update allowed_address_pairs
+        vapv = self._get_vapv(context, hostnames)
         if not old or lb.vip_address != old.vip_address:
+            # Update allowed_address_pairs
             for hostname in hostnames:
                 port_ids = self.openstack_connector.get_server_port_ids(
                     hostname
@@ -66,52 +71,58 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
                 self.openstack_connector.add_ip_to_ports(
                     lb.vip_address, port_ids
                 )
+            # Update the cluster VIPs
+            if vapv is not None and vapv.get('sec_mgmt_address') and \
+                    not cluster_configured:
+                if old is not None:
+                    self.array_vapv_driver.delete_cluster_vip(
+                        vapv, old.vip_address
+                    )
+                self.array_vapv_driver.add_cluster_vip(vapv, lb.vip_address)
         # Update bandwidth allocation
-        if old is not None and old.bandwidth != lb.bandwidth:
-            self._update_instance_bandwidth(hostnames, lb.bandwidth)
+        self._update_bandwidth(context, lb, old)
 
     @logging_wrapper
     def delete_loadbalancer(self, context, lb):
         """
-        Deletes the listen IP from a vAPV.
+        Deletes the listen IP from a vAPV cluster.
         In the case of PER_LOADBALANCER deployments, this involves destroying
-        the whole vAPV instance. In the case of a PER_TENANT deployment, it
-        involves deleting the TrafficIP Group associated with the VIP address.
-        When the last TrafficIP Group has been deleted, the instance is
-        destroyed.
+        the whole vAPV cluster. Otherwise, it involves removing the VIP from
+        the cluster; when the last loadbalancer has been deleted, the
+        cluster is destroyed.
         """
-        deployment_model = self._get_setting(
-            lb.tenant_id, "lbaas_settings", "deployment_model"
-        )
         hostnames = self._get_hostname(lb)
-        if deployment_model in ["PER_TENANT", "PER_SUBNET"]:
-            vapv = self._get_vapv(hostnames)
-            if not vapv.tip_group.list():
-                self._destroy_vapv(hostnames, lb)
-            elif deployment_model == "PER_TENANT":
-                # Delete subnet ports if no longer required
-                if self.openstack_connector.subnet_in_use(lb) is False:
-                    self._detach_subnet_port(vapv, hostnames, lb)
-                for hostname in hostnames:
-                    port_ids = self.openstack_connector.get_server_port_ids(
-                        hostname
-                    )
-                    self.openstack_connector.delete_ip_from_ports(
-                        lb.vip_address, port_ids
-                    )
-        elif deployment_model == "PER_LOADBALANCER":
-            self._destroy_vapv(hostnames, lb)
+        vapv = self._get_vapv(context, hostnames)
+        if vapv is not None and vapv.get('sec_mgmt_address') and \
+                self.array_amphora_db.get_inuselb_by_hostname(
+                    context.session, vapv['hostname']) > 1:
+            # The cluster stays up for its other loadbalancers
+            self.array_vapv_driver.delete_cluster_vip(vapv, lb.vip_address)
+            for hostname in hostnames:
+                port_ids = self.openstack_connector.get_server_port_ids(
+                    hostname
+                )
+                self.openstack_connector.delete_ip_from_ports(
+                    lb.vip_address, port_ids
+                )
+        super(ArrayDeviceDriverV2, self).delete_loadbalancer(context, lb)
 
 ########
 # MISC #
 ########
 
-    def _get_hostname(self, lb):
-        identifier = self.openstack_connector.get_identifier(lb)
+    def _format_hostname(self, identifier):
         return (
             "vapv-{}-pri".format(identifier), "vapv-{}-sec".format(identifier)
         )
 
+    def _get_instance_hostnames(self, vapv):
+        # HA pairs are recorded under the primary's hostname
+        primary = vapv['hostname']
+        if not primary.endswith("-pri"):
+            return [primary]
+        return [primary, "{}-sec".format(primary[:-len("-pri")])]
+
     def _attach_subnet_port(self, vapv, hostnames, lb):
         try:
             for hostname in hostnames:
@@ -137,89 +148,93 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
                 vapv, hostname, lb
             )
 
-    def _spawn_vapv(self, hostnames, lb):
+    def _spawn_vapv(self, hostnames, lb, identifier=None):
         """
         Creates a vAPV HA cluster as Nova VM instances.
-        The VMs are registered with Services Director to provide licensing and
-        configuration proxying.
+        The ports of both instances are created in parallel and both VMs are
+        booted at the same time; a Nova anti-affinity server group keeps them
+        on different compute hosts.
         """
-        identifier = self.openstack_connector.get_identifier(lb)
+        if identifier is None:
+            identifier = self.identity.identifier(lb)
         # Initialize lists of items to clean up if operation fails
         port_ids = []
         security_groups = []
+        server_groups = []
         vms = []
         try:  # For rolling back objects if failure occurs...
-            # Create ports...
-            ports = {}
+            # Create the security groups shared by both instances...
             if cfg.CONF.lbaas_settings.management_mode == "FLOATING_IP":
-                # Primary data port (floating IP)
-                (port, sec_grp, mgmt_ip) = self.openstack_connector.create_port(
-                    lb, hostnames[0], create_floating_ip=True, cluster=True,
-                    identifier=identifier
-                )
-                ports[hostnames[0]] = {
-                    "ports": {
-                        "data": port,
-                        "mgmt": None
-                    },
-                    "mgmt_ip": mgmt_ip,
-                    "cluster_ip": port['fixed_ips'][0]['ip_address']
-                }
-                port_ids.append(port['id'])
+                sec_grp = self.openstack_connector.create_lb_security_group(
+                    lb.tenant_id, identifier, mgmt_port=True, cluster=True
+                )['security_group']['id']
                 security_groups = [sec_grp]
-                # Secondary data port (floating IP)
-                (port, junk, mgmt_ip) = self.openstack_connector.create_port(
-                    lb, hostnames[1], security_group=sec_grp,
-                    create_floating_ip=True, cluster=True
-                )
-                ports[hostnames[1]] = {
-                    "ports": {
-                        "data": port,
-                        "mgmt": None
-                    },
-                    "mgmt_ip": mgmt_ip,
-                    "cluster_ip": port['fixed_ips'][0]['ip_address']
-                }
-                port_ids.append(port['id'])
+                port_calls = [
+                    partial(
+                        self.openstack_connector.create_port, lb, host,
+                        security_group=sec_grp, create_floating_ip=True,
+                        cluster=True
+                    )
+                    for host in hostnames
+                ]
             elif cfg.CONF.lbaas_settings.management_mode == "MGMT_NET":
-                # Primary data port (management network)
-                (data_port, data_sec_grp, junk) = self.openstack_connector.create_port(
-                    lb, hostnames[0], cluster=True, identifier=identifier
-                )
-                # Primary mgmt port (management network)
-                (mgmt_port, mgmt_sec_grp, mgmt_ip) = self.openstack_connector.create_port(
-                    lb, hostnames[0], mgmt_port=True, cluster=True, identifier=identifier
-                )
-                ports[hostnames[0]] = {
-                    "ports": {
-                        "data": data_port,
-                        "mgmt": mgmt_port
-                    },
-                    "mgmt_ip": mgmt_ip,
-                    "cluster_ip": mgmt_ip
-                }
-                security_groups = [data_sec_grp, mgmt_sec_grp]
-                port_ids.append(data_port['id'])
-                port_ids.append(mgmt_port['id'])
-                # Secondary data port (management network)
-                (data_port, sec_grp, junk) = self.openstack_connector.create_port(
-                    lb, hostnames[1], security_group=data_sec_grp, cluster=True
-                )
-                # Secondary mgmt port (management network)
-                (mgmt_port, junk, mgmt_ip) = self.openstack_connector.create_port(
-                    lb, hostnames[1], mgmt_port=True, security_group=mgmt_sec_grp,
-                    cluster=True
-                )
-                ports[hostnames[1]] = {
-                    "ports": {
-                        "data": data_port,
-                        "mgmt": mgmt_port
-                    },
-                    "mgmt_ip": mgmt_ip,
-                    "cluster_ip": mgmt_ip
-                }
-                port_ids.append(data_port['id'])
-                port_ids.append(mgmt_port['id'])
+                data_sec_grp = self.openstack_connector.\
+                    create_lb_security_group(
+                        lb.tenant_id, identifier
+                    )['security_group']['id']
+                security_groups.append(data_sec_grp)
+                mgmt_sec_grp = self.openstack_connector.\
+                    create_lb_security_group(
+                        lb.tenant_id, identifier, mgmt_port=True,
+                        mgmt_label=True, cluster=True
+                    )['security_group']['id']
+                security_groups.append(mgmt_sec_grp)
+                port_calls = []
+                for host in hostnames:
+                    port_calls.append(partial(
+                        self.openstack_connector.create_port, lb, host,
+                        security_group=data_sec_grp, cluster=True
+                    ))
+                    port_calls.append(partial(
+                        self.openstack_connector.create_port, lb, host,
+                        mgmt_port=True, security_group=mgmt_sec_grp,
+                        cluster=True
+                    ))
+
+            # Create ports...
+            try:
+                created_ports = run_in_parallel(port_calls)
+            except ParallelExecutionError as e:
+                port_ids += [
+                    result[0]['id'] for result in e.results
+                    if result is not None
+                ]
+                raise
+            port_ids += [result[0]['id'] for result in created_ports]
+            ports = {}
+            if cfg.CONF.lbaas_settings.management_mode == "FLOATING_IP":
+                for host, (port, junk, mgmt_ip) in zip(
+                        hostnames, created_ports):
+                    ports[host] = {
+                        "ports": {
+                            "data": port,
+                            "mgmt": None
+                        },
+                        "mgmt_ip": mgmt_ip,
+                        "cluster_ip": port['fixed_ips'][0]['ip_address']
+                    }
+            else:
+                for index, host in enumerate(hostnames):
+                    (data_port, junk, junk) = created_ports[index * 2]
+                    (mgmt_port, junk, mgmt_ip) = created_ports[index * 2 + 1]
+                    ports[host] = {
+                        "ports": {
+                            "data": data_port,
+                            "mgmt": mgmt_port
+                        },
+                        "mgmt_ip": mgmt_ip,
+                        "cluster_ip": mgmt_ip
+                    }
 
             # Create instances...
             try:
@@ -230,21 +245,37 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
                 bandwidth = self._get_setting(
                     lb.tenant_id, "services_director_settings", "bandwidth"
                 )
-            avoid = None
-            for host in hostnames:
-                # Launch vAPV...
-                vm = self.openstack_connector.create_vapv(
-                    host, lb, ports[host]['ports'], avoid
+            server_group = None
+            if cfg.CONF.lbaas_settings.allow_different_host_hint is True:
+                server_group = self.openstack_connector.create_server_group(
+                    self._get_server_group_name(identifier)
                 )
-                vms.append(vm['id'])
-                # Set params for next iteration...
-                if cfg.CONF.lbaas_settings.allow_different_host_hint is True:
-                    avoid = vm['id']
+                server_groups.append(server_group)
+            # Launch both vAPVs, then wait for both builds to complete
+            try:
+                instances = run_in_parallel([
+                    partial(
+                        self.openstack_connector.create_vapv, host, lb,
+                        ports[host]['ports'], server_group=server_group,
+                        wait=False
+                    )
+                    for host in hostnames
+                ])
+            except ParallelExecutionError as e:
+                vms += [vm['id'] for vm in e.results if vm is not None]
+                raise
+            vms += [vm['id'] for vm in instances]
+            run_in_parallel([
+                partial(self.openstack_connector._await_build_complete, vm)
+                for vm in vms
+            ])
+            return ports
 
         except Exception as e:
             if cfg.CONF.lbaas_settings.roll_back_on_error is True:
                 self.openstack_connector.clean_up(
                     instances=vms,
+                    server_groups=server_groups,
                     security_groups=security_groups,
                     ports=port_ids
                 )
@@ -262,3 +293,15 @@ class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
                 LOG.debug("\nvAPV {} destroyed".format(hostname))
             except Exception as e:
                 LOG.error(e)
+        self.openstack_connector.invalidate_subnet(lb.vip_subnet_id)
+        try:
+            server_group = self.openstack_connector.get_server_group_id(
+                self._get_server_group_name(self.identity.identifier(lb))
+            )
+            if server_group is not None:
+                self.openstack_connector.delete_server_group(server_group)
+        except Exception as e:
+            LOG.error(e)
+
+    def _get_server_group_name(self, identifier):
+        return "vapv-{}".format(identifier)
@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+import datetime
+from driver_common import logging_wrapper
+from driver_private_instances import ArrayDeviceDriverV2 \
+    as vAPVDeviceDriverPrivateInstances
+from neutron_lbaas.db.loadbalancer import models as lbaas_models
+from oslo_config import cfg
+from oslo_log import log as logging
+from scheduler import BinPackingScheduler, LoadWeigher
+from uuid import uuid4
+
+LOG = logging.getLogger(__name__)
+
+SHARED_IDENTIFIER_PREFIX = "shared-"
+
+
+class ArrayDeviceDriverV2(vAPVDeviceDriverPrivateInstances):
+    """
+    Services Director Unmanaged Version with a shared pool of vAPVs.
+
+    Loadbalancers of all tenants on a VIP subnet are packed onto the
+    subnet's shared vAPVs; a new vAPV is only spawned when none of them
+    has room. Tenants may still be customized to use a private deployment
+    model, in which case the private instance code paths are used.
+
+    Besides resizing, the autoscaler can move loadbalancers off a busy
+    shared vAPV onto a new one, and empty an idle one into the other
+    shared vAPVs of its subnet.
+    """
+
+    def __init__(self, plugin):
+        super(ArrayDeviceDriverV2, self).__init__(plugin)
+        self.placement_db = repository.ArrayLbPlacementRepository()
+        # Live statistics steer new loadbalancers away from busy vAPVs
+        if self.stats_collector.enabled:
+            self.scheduler = BinPackingScheduler(
+                LoadWeigher(self.stats_collector)
+            )
+        else:
+            self.scheduler = BinPackingScheduler()
+
+    @logging_wrapper
+    def create_loadbalancer(self, context, lb):
+        """
+        Places the loadbalancer on the fullest shared vAPV of its VIP
+        subnet that still has room and is not hot, spawning a new vAPV if
+        there is none.
+        """
+        if not self._is_shared(lb):
+            return super(ArrayDeviceDriverV2, self).create_loadbalancer(
+                context, lb
+            )
+        self._assert_not_mgmt_network(lb.vip_subnet_id)
+        self._assert_shared_subnet(lb.vip_subnet_id)
+        hostname = self._place(context, lb, self._get_lb_bandwidth(lb))
+        LOG.info("\nLoadbalancer {} placed on shared vAPV {}".format(
+            lb.id, hostname
+        ))
+        self.update_loadbalancer(context, lb, None)
+        self.description_poller.add(lb)
+
+    @logging_wrapper
+    def update_loadbalancer(self, context, lb, old):
+        """
+        Also keeps the bandwidth reserved by the loadbalancer on its shared
+        vAPV in step with lb.bandwidth.
+        """
+        if self._is_shared(lb) and old is not None:
+            delta = self._get_lb_bandwidth(lb) - self._get_lb_bandwidth(old)
+            if delta:
+                hostname = self._get_hostname(lb)
+                counters = self.array_amphora_db.adjust_counters(
+                    context.session, hostname, bandwidth=delta
+                )
+                self.placement_db.update_bandwidth(
+                    context.session, lb.id, self._get_lb_bandwidth(lb)
+                )
+                if self.scheduler.max_bandwidth and \
+                        counters['bandwidth'] > self.scheduler.max_bandwidth:
+                    LOG.warning(
+                        "\nShared vAPV {} is over its bandwidth capacity: "
+                        "{}".format(hostname, counters['bandwidth'])
+                    )
+        super(ArrayDeviceDriverV2, self).update_loadbalancer(context, lb, old)
+
+    @logging_wrapper
+    def delete_loadbalancer(self, context, lb):
+        """
+        Removes the loadbalancer from its shared vAPV. The vAPV is
+        destroyed once the last loadbalancer on it has been deleted.
+        """
+        if not self._is_shared(lb):
+            return super(ArrayDeviceDriverV2, self).delete_loadbalancer(
+                context, lb
+            )
+        placement = self.placement_db.get(
+            context.session, loadbalancer_id=lb.id
+        )
+        if placement is None:
+            LOG.warning(
+                "\ndelete_loadbalancer({}): no shared vAPV placement "
+                "found".format(lb.id)
+            )
+            self.identity.invalidate(lb.id)
+            return
+        hostname = placement['hostname']
+        counters = self.array_amphora_db.adjust_counters(
+            context.session, hostname, in_use_lb=-1,
+            bandwidth=-placement['bandwidth']
+        )
+        self.placement_db.delete(context.session, loadbalancer_id=lb.id)
+        if counters['in_use_lb'] == 0 and \
+                self.array_amphora_db.delete_if_unused(
+                    context.session, hostname):
+            LOG.debug(
+                "\ndelete_loadbalancer({}): last loadbalancer deleted; "
+                "destroying shared vAPV {}".format(lb.id, hostname)
+            )
+            self._destroy_vapv(hostname, lb)
+        elif counters['in_use_lb'] >= 0:
+            # Still in use, or claimed again by a concurrent placement
+            port_ids = self.openstack_connector.get_server_port_ids(hostname)
+            self.openstack_connector.delete_ip_from_ports(
+                lb.vip_address, port_ids
+            )
+        self.identity.invalidate(lb.id)
+
+#############
+# LISTENERS #
+#############
+
+    @logging_wrapper
+    def create_listener(self, context, listener):
+        super(ArrayDeviceDriverV2, self).create_listener(context, listener)
+        self._adjust_counters(
+            context, listener.loadbalancer, listener_count=1
+        )
+
+    @logging_wrapper
+    def delete_listener(self, context, listener):
+        super(ArrayDeviceDriverV2, self).delete_listener(context, listener)
+        self._adjust_counters(
+            context, listener.loadbalancer, listener_count=-1
+        )
+
+###########
+# MEMBERS #
+###########
+
+    @logging_wrapper
+    def create_member(self, context, member):
+        super(ArrayDeviceDriverV2, self).create_member(context, member)
+        self._adjust_counters(
+            context, member.root_loadbalancer, member_count=1
+        )
+
+    @logging_wrapper
+    def delete_member(self, context, member):
+        super(ArrayDeviceDriverV2, self).delete_member(context, member)
+        self._adjust_counters(
+            context, member.root_loadbalancer, member_count=-1
+        )
+
+########
+# MISC #
+########
+
+    def _is_shared(self, lb):
+        return self._get_setting(
+            lb.tenant_id, "lbaas_settings", "deployment_model"
+        ) == "SHARED"
+
+    def _assert_shared_subnet(self, subnet_id):
+        shared_subnets = cfg.CONF.lbaas_settings.shared_subnets
+        if shared_subnets and subnet_id not in shared_subnets:
+            raise Exception(
+                "Subnet {} is not one of the shared_subnets".format(subnet_id)
+            )
+
+    def _get_lb_bandwidth(self, lb):
+        return getattr(lb, "bandwidth", 0) or 0
+
+    def _adjust_counters(self, context, lb, **deltas):
+        if not self._is_shared(lb):
+            return
+        hostname = self._get_hostname(lb)
+        counters = self.array_amphora_db.adjust_counters(
+            context.session, hostname, **deltas
+        )
+        vapv = self.array_amphora_db.get_vapv_by_hostname(
+            context.session, hostname
+        )
+        if vapv is not None and self.scheduler.utilization(vapv) > 1:
+            LOG.warning("\nShared vAPV {} is over capacity: {}".format(
+                hostname, counters
+            ))
+
+    def _get_candidates(self, context, lb, bandwidth, confirm=False):
+        return self.scheduler.rank(
+            self.array_amphora_db.find_vapvs(
+                context.session,
+                tenant_id=self.openstack_connector.lbaas_project_id,
+                subnet_id=lb.vip_subnet_id,
+                confirm=confirm
+            ),
+            bandwidth
+        )
+
+    def _place(self, context, lb, bandwidth):
+        """
+        Adds the loadbalancer to a shared vAPV and records the placement.
+
+        :returns: hostname of the vAPV.
+        """
+        while True:
+            for vapv in self._get_candidates(context, lb, bandwidth):
+                # Another worker may have filled the vAPV since it was
+                # ranked, so the capacity is claimed conditionally.
+                if self.array_amphora_db.claim_capacity(
+                        context.session, vapv['hostname'],
+                        self.scheduler.max_loadbalancers,
+                        self.scheduler.max_bandwidth, bandwidth,
+                        max_listeners=self.scheduler.max_listeners,
+                        max_members=self.scheduler.max_members):
+                    self._record_placement(
+                        context, lb, vapv['hostname'], bandwidth
+                    )
+                    return vapv['hostname']
+            # No room on the subnet: spawn a vAPV unless a concurrent
+            # request is already doing so, in which case try again.
+            identifier = "{}{}".format(
+                SHARED_IDENTIFIER_PREFIX, uuid4().hex[:12]
+            )
+            hostname = self._format_hostname(identifier)
+            if self.spawn_registry.run_once(
+                    "{}{}".format(SHARED_IDENTIFIER_PREFIX, lb.vip_subnet_id),
+                    # Not the index: a stale record would stop the spawn
+                    exists=lambda: bool(self._get_candidates(
+                        context, lb, bandwidth, confirm=True
+                    )),
+                    spawn=lambda: self._create_shared_vapv(
+                        context, lb, identifier, hostname, bandwidth
+                    )):
+                return hostname
+
+    def _create_shared_vapv(self, context, lb, identifier, hostname,
+                            bandwidth, in_use_lb=1):
+        self._create_subnet_vapv(
+            context, hostname, lb, identifier=identifier,
+            tenant_id=self.openstack_connector.lbaas_project_id,
+            in_use_lb=in_use_lb,
+            bandwidth=bandwidth
+        )
+        if in_use_lb:
+            self._record_placement(context, lb, hostname, bandwidth)
+
+    def _record_placement(self, context, lb, hostname, bandwidth):
+        self.placement_db.create(
+            context.session,
+            loadbalancer_id=lb.id,
+            tenant_id=lb.tenant_id,
+            identifier=self._get_shared_identifier(hostname),
+            hostname=hostname,
+            bandwidth=bandwidth,
+            created_at=datetime.datetime.utcnow()
+        )
+        self.identity.invalidate(lb.id)
+
+    def _get_instance_bandwidth(self, lb):
+        # Shared vAPVs get the allocation of the LBaaS project
+        if not self._is_shared(lb):
+            return super(ArrayDeviceDriverV2, self)._get_instance_bandwidth(
+                lb
+            )
+        return int(self._get_setting(
+            self.openstack_connector.lbaas_project_id,
+            "services_director_settings", "bandwidth"
+        ) or 0)
+
+    def _is_cacheable_identifier(self, identifier):
+        # Shared loadbalancers can be moved by other processes, so their
+        # placement is read every time
+        return not identifier.startswith(SHARED_IDENTIFIER_PREFIX)
+
+    def _get_shared_identifier(self, hostname):
+        # Shared vAPV hostnames are _format_hostname(identifier)
+        return hostname[len(self._format_hostname("")):]
+
+###############
+# AUTOSCALING #
+###############
+
+    def scale_up(self, vapv, flavors):
+        """
+        Resizes a busy shared vAPV, or if it is already at the largest
+        flavor, moves the newer half of its loadbalancers onto a new vAPV.
+        """
+        if super(ArrayDeviceDriverV2, self).scale_up(vapv, flavors):
+            return True
+        if not self._is_shared_vapv(vapv):
+            return False
+        return self._scale_out(vapv)
+
+    def scale_down(self, vapv, flavors):
+        """
+        Moves the loadbalancers of an idle shared vAPV onto the other
+        shared vAPVs of its subnet and destroys it, or if they do not have
+        room, resizes it.
+        """
+        if self._is_shared_vapv(vapv) and self._consolidate(vapv):
+            return True
+        return super(ArrayDeviceDriverV2, self).scale_down(vapv, flavors)
+
+    def get_hosted_loadbalancers(self, context, vapv):
+        if not self._is_shared_vapv(vapv):
+            return super(ArrayDeviceDriverV2, self).get_hosted_loadbalancers(
+                context, vapv
+            )
+        ids = [
+            placement['loadbalancer_id'] for placement in
+            self.placement_db.get_by_hostname(
+                context.session, vapv['hostname']
+            )
+        ]
+        if not ids:
+            return []
+        return self.get_loadbalancers(context, filters={"id": ids})
+
+    def _is_shared_vapv(self, vapv):
+        return vapv['tenant_id'] == self.openstack_connector.lbaas_project_id
+
+    def _scale_out(self, vapv):
+        context = db_api.get_admin_context()
+        placements = self.placement_db.get_by_hostname(
+            context.session, vapv['hostname']
+        )
+        if len(placements) < 2:
+            return False
+        loadbalancers = [
+            self.plugin.db.get_loadbalancer(
+                context, placement['loadbalancer_id']
+            )
+            for placement in placements[len(placements) / 2:]
+        ]
+        identifier = "{}{}".format(SHARED_IDENTIFIER_PREFIX, uuid4().hex[:12])
+        hostname = self._format_hostname(identifier)
+        self._create_shared_vapv(
+            context, loadbalancers[0], identifier, hostname, 0, in_use_lb=0
+        )
+        target = self.array_amphora_db.get_vapv_by_hostname(
+            context.session, hostname
+        )
+        for lb in loadbalancers:
+            try:
+                self._move_loadbalancer(context, lb, vapv, target)
+            except Exception as e:
+                # e.g. being updated through the API; it stays on vapv
+                LOG.error("\nError moving loadbalancer {} to vAPV {}: "
+                          "{}".format(lb.id, hostname, e))
+        return True
+
+    def _consolidate(self, vapv):
+        context = db_api.get_admin_context()
+        placements = self.placement_db.get_by_hostname(
+            context.session, vapv['hostname']
+        )
+        others = [
+            other for other in self.array_amphora_db.find_vapvs(
+                context.session,
+                tenant_id=self.openstack_connector.lbaas_project_id,
+                subnet_id=vapv['subnet_id']
+            ) if other['hostname'] != vapv['hostname']
+        ]
+        spare = sum(
+            self.scheduler.max_loadbalancers - other['in_use_lb']
+            for other in self.scheduler.rank(others)
+        )
+        if spare < len(placements):
+            return False
+        for placement in placements:
+            lb = self.plugin.db.get_loadbalancer(
+                context, placement['loadbalancer_id']
+            )
+            moved = False
+            for target in self.scheduler.rank(
+                    self.array_amphora_db.find_vapvs(
+                        context.session,
+                        tenant_id=self.openstack_connector.lbaas_project_id,
+                        subnet_id=vapv['subnet_id']),
+                    placement['bandwidth']):
+                if target['hostname'] == vapv['hostname']:
+                    continue
+                try:
+                    if self._move_loadbalancer(context, lb, vapv, target):
+                        moved = True
+                        break
+                except Exception as e:
+                    LOG.error("\nError moving loadbalancer {} to vAPV {}: "
+                              "{}".format(lb.id, target['hostname'], e))
+                    break
+            if not moved:
+                LOG.warning(
+                    "\nCould not move loadbalancer {} off idle vAPV "
+                    "{}".format(lb.id, vapv['hostname'])
+                )
+                return True
+        if self.array_amphora_db.delete_if_unused(
+                context.session, vapv['hostname']):
+            self._destroy_shared_vapv(vapv)
+        return True
+
+    def _destroy_shared_vapv(self, vapv):
+        # Needs no loadbalancer, unlike _destroy_vapv, so that an empty
+        # vAPV (e.g. a _scale_out target whose moves failed) can go too
+        self.openstack_connector.destroy_vapv(vapv['hostname'], None)
+        self.openstack_connector.invalidate_subnet(vapv['subnet_id'])
+        LOG.debug("\nvAPV {} destroyed".format(vapv['hostname']))
+
+#############
+# MIGRATION #
+#############
+
+    def migrate_loadbalancer(self, context, lb_id, target_hostname=None):
+        """
+        Moves a loadbalancer to another shared vAPV of its subnet, by
+        default the one the scheduler would place it on.
+
+        :returns: hostname of the vAPV the loadbalancer was moved to.
+        """
+        lb = self.plugin.db.get_loadbalancer(context, lb_id)
+        if lb.provisioning_status != "ACTIVE":
+            raise Exception("Loadbalancer {} is {}".format(
+                lb.id, lb.provisioning_status
+            ))
+        placement = self.placement_db.get(
+            context.session, loadbalancer_id=lb.id
+        )
+        if placement is None:
+            raise Exception(
+                "Loadbalancer {} is not on a shared vAPV".format(lb.id)
+            )
+        source = self.array_amphora_db.get_vapv_by_hostname(
+            context.session, placement['hostname']
+        )
+        if target_hostname is not None:
+            target = self.array_amphora_db.get_vapv_by_hostname(
+                context.session, target_hostname
+            )
+            if target is None or not self._is_shared_vapv(target) or \
+                    target['subnet_id'] != source['subnet_id']:
+                raise Exception(
+                    "{} is not a shared vAPV on subnet {}".format(
+                        target_hostname, source['subnet_id']
+                    )
+                )
+            targets = [target]
+        else:
+            targets = self._get_candidates(
+                context, lb, placement['bandwidth']
+            )
+        for target in targets:
+            if target['hostname'] == source['hostname']:
+                continue
+            if self._move_loadbalancer(context, lb, source, target):
+                return target['hostname']
+        raise Exception(
+            "No shared vAPV has room for loadbalancer {}".format(lb.id)
+        )
+
+    def drain_vapv(self, context, hostname):
+        """
+        Moves all loadbalancers off a shared vAPV, e.g. before its host is
+        taken down. The empty vAPV is left in place.
+
+        :returns: list of (loadbalancer_id, error) of those that could not
+                  be moved.
+        """
+        failures = []
+        for placement in self.placement_db.get_by_hostname(
+                context.session, hostname):
+            lb_id = placement['loadbalancer_id']
+            try:
+                self.migrate_loadbalancer(context, lb_id)
+            except Exception as e:
+                LOG.error("\nError moving loadbalancer {} off vAPV {}: "
+                          "{}".format(lb_id, hostname, e))
+                failures.append((lb_id, e))
+        return failures
+
+    def _move_loadbalancer(self, context, lb, source, target):
+        """
+        Moves a loadbalancer from the source shared vAPV to target, with
+        as little downtime as possible: its configuration is pushed to
+        target, the VIP is moved, the capacity counters and the placement
+        record are updated, and only then is the configuration removed
+        from source.
+
+        The loadbalancer is PENDING_UPDATE for the length of the move, so
+        Neutron refuses API changes to it meanwhile.
+
+        :returns: False if target no longer has room.
+        :raises: StateInvalid if the loadbalancer is already pending.
+        """
+        self.plugin.db.test_and_set_status(
+            context, lbaas_models.LoadBalancer, lb.id, "PENDING_UPDATE"
+        )
+        try:
+            return self._relocate_loadbalancer(context, lb, source, target)
+        finally:
+            self.plugin.db.update_status(
+                context, lbaas_models.LoadBalancer, lb.id,
+                provisioning_status="ACTIVE"
+            )
+
+    def _relocate_loadbalancer(self, context, lb, source, target):
+        placement = self.placement_db.get(
+            context.session, loadbalancer_id=lb.id
+        )
+        bandwidth = placement['bandwidth']
+        counters = {
+            "listener_count": len(lb.listeners),
+            "member_count": sum(len(pool.members) for pool in lb.pools)
+        }
+        if not self.array_amphora_db.claim_capacity(
+                context.session, target['hostname'],
+                self.scheduler.max_loadbalancers,
+                self.scheduler.max_bandwidth, bandwidth,
+                max_listeners=self.scheduler.max_listeners,
+                max_members=self.scheduler.max_members, **counters):
+            return False
+        target_identifier = self._get_shared_identifier(target['hostname'])
+        allowed = []
+        pushed = False
+        try:
+            for listener in lb.listeners:
+                protocol = 'udp' if listener.protocol == "UDP" else 'tcp'
+                self.openstack_connector.allow_port(
+                    lb, listener.protocol_port, target_identifier, protocol
+                )
+                allowed.append((listener.protocol_port, protocol))
+            pushed = True
+            self._push_configuration(lb, target)
+            self.openstack_connector.add_ip_to_ports(
+                lb.vip_address,
+                self.openstack_connector.get_server_port_ids(
+                    target['hostname']
+                )
+            )
+        except Exception:
+            # Leave the target as it was; the loadbalancer stays on source
+            try:
+                if pushed:
+                    self._remove_configuration(lb, target)
+                for port, protocol in allowed:
+                    self.openstack_connector.block_port(
+                        lb, port, target_identifier, protocol
+                    )
+            except Exception as e:
+                LOG.error(
+                    "\nError rolling back loadbalancer {} on vAPV {}: "
+                    "{}".format(lb.id, target['hostname'], e)
+                )
+            self.array_amphora_db.adjust_counters(
+                context.session, target['hostname'], in_use_lb=-1,
+                bandwidth=-bandwidth,
+                **{name: -count for name, count in counters.iteritems()}
+            )
+            raise
+        self.placement_db.move(
+            context.session, lb.id, target['hostname'], target_identifier
+        )
+        self.identity.invalidate(lb.id)
+        self.array_amphora_db.adjust_counters(
+            context.session, source['hostname'], in_use_lb=-1,
+            bandwidth=-bandwidth,
+            **{name: -count for name, count in counters.iteritems()}
+        )
+        try:
+            self.openstack_connector.delete_ip_from_ports(
+                lb.vip_address,
+                self.openstack_connector.get_server_port_ids(
+                    source['hostname']
+                )
+            )
+            self._remove_configuration(lb, source)
+            for listener in lb.listeners:
+                self.openstack_connector.block_port(
+                    lb, listener.protocol_port,
+                    self._get_shared_identifier(source['hostname']),
+                    'udp' if listener.protocol == "UDP" else 'tcp'
+                )
+        except Exception as e:
+            LOG.error(
+                "\nError removing loadbalancer {} from vAPV {}: {}".format(
+                    lb.id, source['hostname'], e
+                )
+            )
+        LOG.info("\nLoadbalancer {} moved from vAPV {} to {}".format(
+            lb.id, source['hostname'], target['hostname']
+        ))
+        return True
+
+    def _push_configuration(self, lb, vapv):
+        # One batch, saved once
+        self.array_vapv_driver.run_commands(vapv, [
+            command for obj in self._render_configuration(lb)
+            for command in obj.commands
+        ])
+
+    def _remove_configuration(self, lb, vapv):
+        self.array_vapv_driver.run_commands(vapv, [
+            command for obj in reversed(self._render_configuration(lb))
+            for command in obj.undo
+        ])
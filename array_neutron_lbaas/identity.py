@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from cache import TTLCache
+
+
+class IdentityResolver(object):
+    """
+    Memoizes, per loadbalancer, the identifier of the vAPV that hosts it
+    and the vAPV hostname(s) derived from it.
+
+    Working out the identifier needs the tenant's deployment_model, which
+    may be a customizations DB lookup, so it is only done once per
+    loadbalancer rather than on every listener/pool/member operation.
+    Identifiers that can change under other processes, such as those of
+    loadbalancers that can be moved between shared vAPVs, are looked up
+    every time: is_cacheable(identifier) says which may be memoized.
+    """
+
+    def __init__(self, get_identifier, format_hostname, ttl,
+                 is_cacheable=None):
+        self.get_identifier = get_identifier
+        self.format_hostname = format_hostname
+        self.is_cacheable = is_cacheable or (lambda identifier: True)
+        self.cache = TTLCache(ttl)
+
+    def resolve(self, lb):
+        """
+        Returns (identifier, hostname) for lb. hostname is a tuple of
+        hostnames for HA pairs.
+        """
+        if isinstance(lb, dict):
+            lb_id = lb['id']
+            tenant_id = lb['tenant_id']
+        else:
+            lb_id = lb.id
+            tenant_id = lb.tenant_id
+        entry = self.cache.get(lb_id)
+        if entry is None:
+            identifier = self.get_identifier(lb)
+            entry = (tenant_id, identifier, self.format_hostname(identifier))
+            if identifier is not None and self.is_cacheable(identifier):
+                self.cache.set(lb_id, entry)
+        return entry[1], entry[2]
+
+    def identifier(self, lb):
+        return self.resolve(lb)[0]
+
+    def hostname(self, lb):
+        return self.resolve(lb)[1]
+
+    def invalidate(self, lb_id=None):
+        self.cache.invalidate(lb_id)
+
+    def invalidate_tenant(self, tenant_id):
+        self.cache.invalidate_matching(lambda entry: entry[0] == tenant_id)
+
+    def customization_changed(self, tenant_id, section, parameter):
+        """
+        Tenant settings listener: a new deployment_model changes the
+        identifier of all the tenant's loadbalancers. A tenant_id of None
+        means that some tenant's customizations changed.
+        """
+        if tenant_id is None:
+            self.invalidate()
+        elif section == "lbaas_settings" and parameter == "deployment_model":
+            self.invalidate_tenant(tenant_id)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.concurrency import PeriodicWorker
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import models
+from array_neutron_lbaas.db import repository
+import datetime
+import os
+from oslo_config import cfg
+from oslo_log import log as logging
+import socket
+from threading import Lock
+from uuid import uuid4
+
+LOG = logging.getLogger(__name__)
+
+RESERVE_PORT = "port"
+RESERVE_FLOATINGIP = "floatingip"
+# Seconds after which a resource still being allocated is given up on
+STALE_ALLOCATION_AGE = 600
+# array_spawn_lock row held by the worker adding resources to the reserve
+REFILL_LOCK = "mgmt-reserve-refill"
+# Seconds after which a refill lock is taken to be left by a dead worker
+REFILL_LOCK_MAX_AGE = 300
+
+
+class ManagementReserve(object):
+    """
+    Keeps a small reserve of ready-made management resources so that
+    spawning a vAPV does not have to create them on the critical path:
+    management ports already bound to the management security group in
+    MGMT_NET mode, and allocated but unassociated floating IPs in
+    FLOATING_IP mode.
+    """
+
+    def __init__(self, openstack_connector):
+        self.openstack_connector = openstack_connector
+        self.reserve_db = repository.ArrayMgmtReserveRepository()
+        self.lock_db = repository.ArraySpawnLockRepository()
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.refiller = None
+        self._refill_lock = Lock()
+        if cfg.CONF.lbaas_settings.management_mode == "MGMT_NET":
+            self.resource_type = RESERVE_PORT
+        else:
+            self.resource_type = RESERVE_FLOATINGIP
+        self.enabled = self._is_supported()
+
+    def _is_supported(self):
+        settings = cfg.CONF.lbaas_settings
+        if not settings.mgmt_reserve_size:
+            return False
+        if self.resource_type == RESERVE_PORT and \
+                not settings.management_security_group:
+            LOG.warning(
+                "\nManagement port reserve requires "
+                "management_security_group to be set"
+            )
+            return False
+        return True
+
+    def start(self):
+        self.refiller = PeriodicWorker(
+            self.refill, cfg.CONF.lbaas_settings.mgmt_reserve_refill_interval,
+            name="vapv-mgmt-reserve"
+        )
+        self.refiller.start()
+
+    def claim_port(self, hostname):
+        """
+        Takes a management port out of the reserve and names it after the
+        vAPV. Returns (port, security_group, mgmt_ip) like
+        OpenStackInterface.create_port, or None if the reserve is empty.
+        """
+        if not self.enabled or self.resource_type != RESERVE_PORT:
+            return None
+        session = db_api.get_admin_session()
+        record = self.reserve_db.claim(session, resource_type=RESERVE_PORT)
+        self._wake_refiller()
+        if record is None:
+            return None
+        neutron = self.openstack_connector.get_neutron_client()
+        try:
+            port = neutron.update_port(
+                record['resource_id'],
+                {"port": {"name": "mgmt-{}".format(hostname)}}
+            )['port']
+        except Exception as e:
+            LOG.error("\nError claiming management port {}: {}".format(
+                record['resource_id'], e
+            ))
+            self._discard(session, record)
+            return None
+        self.reserve_db.delete(session, id=record['id'])
+        return (
+            port, cfg.CONF.lbaas_settings.management_security_group,
+            record['address']
+        )
+
+    def claim_floatingip(self, port_id):
+        """
+        Associates a reserved floating IP with port_id. Returns the floating
+        IP in the same form as OpenStackInterface.create_floatingip, or None
+        if the reserve is empty.
+        """
+        if not self.enabled or self.resource_type != RESERVE_FLOATINGIP:
+            return None
+        session = db_api.get_admin_session()
+        record = self.reserve_db.claim(
+            session, resource_type=RESERVE_FLOATINGIP
+        )
+        self._wake_refiller()
+        if record is None:
+            return None
+        neutron = self.openstack_connector.get_neutron_client()
+        try:
+            floatingip = neutron.update_floatingip(
+                record['resource_id'], {"floatingip": {"port_id": port_id}}
+            )
+        except Exception as e:
+            LOG.error("\nError claiming floating IP {}: {}".format(
+                record['address'], e
+            ))
+            self._discard(session, record)
+            return None
+        self.reserve_db.delete(session, id=record['id'])
+        return floatingip
+
+    def refill(self):
+        """
+        Allocates resources until the reserve is full. The missing ones
+        are counted and recorded as BUILDING under the REFILL_LOCK row, so
+        that several workers do not overfill the reserve.
+        """
+        with self._refill_lock:
+            session = db_api.get_admin_session()
+            for record in self.reserve_db.get_stale(
+                    session, STALE_ALLOCATION_AGE,
+                    resource_type=self.resource_type):
+                self._discard(session, record)
+            if not self.lock_db.acquire_or_break(
+                    session, REFILL_LOCK, self.owner, REFILL_LOCK_MAX_AGE):
+                return
+            records = []
+            try:
+                missing = cfg.CONF.lbaas_settings.mgmt_reserve_size - \
+                    self.reserve_db.count(
+                        session, resource_type=self.resource_type
+                    )
+                for _ in xrange(missing):
+                    records.append(self.reserve_db.create(
+                        session,
+                        resource_type=self.resource_type,
+                        status=models.RESERVE_BUILDING,
+                        created_at=datetime.datetime.utcnow()
+                    ))
+            finally:
+                self.lock_db.release(session, REFILL_LOCK, self.owner)
+            for record in records:
+                self._allocate(session, record)
+
+    def _allocate(self, session, record):
+        neutron = self.openstack_connector.get_neutron_client()
+        try:
+            if self.resource_type == RESERVE_PORT:
+                port = neutron.create_port({"port": {
+                    "admin_state_up": True,
+                    "network_id": cfg.CONF.lbaas_settings.management_network,
+                    "tenant_id": self.openstack_connector.lbaas_project_id,
+                    "name": "mgmt-reserve-{}".format(uuid4().hex[:12]),
+                    "security_groups": [
+                        cfg.CONF.lbaas_settings.management_security_group
+                    ]
+                }})['port']
+                resource_id = port['id']
+                address = port['fixed_ips'][0]['ip_address']
+            else:
+                floatingip = neutron.create_floatingip({"floatingip": {
+                    "floating_network_id":
+                        cfg.CONF.lbaas_settings.management_network,
+                    "tenant_id": self.openstack_connector.lbaas_project_id
+                }})['floatingip']
+                resource_id = floatingip['id']
+                address = floatingip['floating_ip_address']
+        except Exception as e:
+            LOG.error("\nError allocating reserved management {}: {}".format(
+                self.resource_type, e
+            ))
+            self.reserve_db.delete(session, id=record['id'])
+            return
+        self.reserve_db.update(
+            session, record['id'], resource_id=resource_id, address=address,
+            status=models.RESERVE_READY
+        )
+
+    def _discard(self, session, record):
+        if record['resource_id']:
+            neutron = self.openstack_connector.get_neutron_client()
+            try:
+                if record['resource_type'] == RESERVE_PORT:
+                    neutron.delete_port(record['resource_id'])
+                else:
+                    neutron.delete_floatingip(record['resource_id'])
+            except Exception as e:
+                LOG.error(e)
+        self.reserve_db.delete(session, id=record['id'])
+
+    def _wake_refiller(self):
+        if self.refiller is not None:
+            self.refiller.wake()
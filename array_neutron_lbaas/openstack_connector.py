@@ -15,10 +15,12 @@
 #
 #
 
-from array_neutron_lbaas_customizations_db import helper \
-     as customization_helper
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+from cache import TTLCache
 import json
-from neutronclient.neutron import client as neutron_client
+from mgmt_reserve import ManagementReserve
+import os
 from oslo_config import cfg
 from oslo_log import log as logging
 import re
@@ -26,7 +28,10 @@ import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import socket
 from struct import pack
-from time import sleep
+from tenant_settings import TenantSettings
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import sleep, time
 import hashlib
 
 LOG = logging.getLogger(__name__)
@@ -49,41 +54,111 @@ class OpenStackInterface(object):
         self.lbaas_username = cfg.CONF.lbaas_settings.lbaas_project_username
         self.lbaas_project_id = cfg.CONF.lbaas_settings.lbaas_project_id
 
-        # Get Neutron and Nova API endpoints...
+        # Neutron and Nova API endpoints are discovered on first use
+        self._endpoints = None
+        self._endpoints_lock = Lock()
+
+        # Per-tenant settings, shared with the device driver
+        self.tenant_settings = TenantSettings()
+        self.customizations_db = self.tenant_settings.helper
+
+        # Loadbalancer -> vAPV placements of the SHARED deployment model
+        self.placement_db = repository.ArrayLbPlacementRepository()
+
+        # Reserve of ready-made management ports/floating IPs
+        self.mgmt_reserve = ManagementReserve(self)
+
+        # Subnet metadata, looked up several times per loadbalancer create
+        self.subnet_cache = TTLCache(
+            cfg.CONF.lbaas_settings.subnet_cache_ttl
+        )
+
+    @property
+    def neutron_endpoint(self):
+        return self._get_endpoints()['neutron']
+
+    @property
+    def nova_endpoint(self):
+        return self._get_endpoints()['nova']
+
+    def _get_endpoints(self):
+        """
+        Returns the Neutron and Nova admin endpoints. They are looked up in
+        Keystone on first use rather than when the driver is loaded, and
+        are then memoized (and optionally cached on disk) so that
+        neutron-server workers do not each have to query Keystone at boot.
+        """
+        if self._endpoints is None:
+            with self._endpoints_lock:
+                if self._endpoints is None:
+                    endpoints = self._read_endpoint_cache()
+                    if endpoints is None:
+                        endpoints = self._discover_endpoints()
+                        self._write_endpoint_cache(endpoints)
+                    self._endpoints = endpoints
+        return self._endpoints
+
+    def _discover_endpoints(self):
         keystone = self.get_keystone_client(lbaas_project=False)
         neutron_service = keystone.services.find(name="neutron")
         nova_service = keystone.services.find(name="nova")
 
         if cfg.CONF.lbaas_settings.keystone_version == "2":
-            self.neutron_endpoint = keystone.endpoints.find(
+            neutron_endpoint = keystone.endpoints.find(
                 service_id=neutron_service.id
             ).adminurl
-            self.nova_endpoint = keystone.endpoints.find(
+            nova_endpoint = keystone.endpoints.find(
                 service_id=nova_service.id
             ).adminurl
         else:
-            self.neutron_endpoint = keystone.endpoints.find(
+            neutron_endpoint = keystone.endpoints.find(
                 interface="admin", service_id=neutron_service.id
             ).url
             nova_endpoint = keystone.endpoints.find(
                 interface="admin", service_id=nova_service.id
             ).url
-            self.nova_endpoint = nova_endpoint.replace(
+            nova_endpoint = nova_endpoint.replace(
                 "%(tenant_id)s", self.lbaas_project_id
             )
+        return {"neutron": neutron_endpoint, "nova": nova_endpoint}
 
-        # Get connector to tenant customizations database if enabled...
-        if cfg.CONF.lbaas_settings.allow_tenant_customizations is True:
-            self.customizations_db = customization_helper.\
-                ArrayLbaasTenantCustomizationsDatabaseHelper(
-                    cfg.CONF.lbaas_settings.tenant_customizations_db
-                )
-        else:
-            self.customizations_db = None
+    def _read_endpoint_cache(self):
+        cache_file = cfg.CONF.lbaas_settings.endpoint_cache_file
+        if not cache_file:
+            return None
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['timestamp'] + \
+                    cfg.CONF.lbaas_settings.endpoint_cache_ttl < time():
+                return None
+            return cached['endpoints']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_endpoint_cache(self, endpoints):
+        cache_file = cfg.CONF.lbaas_settings.endpoint_cache_file
+        if not cache_file:
+            return
+        try:
+            # Write to a temporary file and rename it so that other workers
+            # never read a partially written cache
+            with NamedTemporaryFile(
+                    "w", dir=os.path.dirname(cache_file) or ".",
+                    delete=False) as f:
+                json.dump({"timestamp": time(), "endpoints": endpoints}, f)
+            os.rename(f.name, cache_file)
+        except (IOError, OSError) as e:
+            LOG.warning(
+                "\nUnable to write endpoint cache {}: {}".format(cache_file, e)
+            )
 
-    def create_vapv(self, hostname, lb, ports, cluster=None, avoid=None):
+    def create_vapv(self, hostname, lb, ports, cluster=None, avoid=None,
+                    server_group=None, wait=True):
         """
         Creates a vAPV instance as a Nova VM.
+        If wait is False, returns as soon as Nova has accepted the request;
+        the caller must then call _await_build_complete itself.
         """
         nics = [{"port": ports['data']['id']}]
         if ports['mgmt'] is not None:
@@ -92,10 +167,12 @@ class OpenStackInterface(object):
             tenant_id=lb.tenant_id,
             hostname=hostname,
             nics=nics,
-            avoid_host_of=avoid
+            avoid_host_of=avoid,
+            server_group=server_group
         )
-        sleep(2)
-        self._await_build_complete(instance['id'])
+        if wait:
+            sleep(2)
+            self._await_build_complete(instance['id'])
         return instance
 
     def destroy_vapv(self, hostname, lb):
@@ -140,6 +217,9 @@ class OpenStackInterface(object):
                 LOG.error("\nError deleting port {}: {}".format(port, e))
         # Delete security groups
         for sec_grp in sec_grp_list:
+            if sec_grp == cfg.CONF.lbaas_settings.management_security_group:
+                # Shared by all management ports
+                continue
             try:
                 neutron.delete_security_group(sec_grp)
             except Exception:
@@ -147,10 +227,13 @@ class OpenStackInterface(object):
                 pass
 
     def clean_up(self, ports=None, security_groups=None, instances=None,
-                 floating_ips=None):
+                 floating_ips=None, server_groups=None):
         if instances is not None:
             for instance in instances:
                 self.delete_server(instance)
+        if server_groups is not None:
+            for server_group in server_groups:
+                self.delete_server_group(server_group)
         neutron = self.get_neutron_client()
         if floating_ips is not None:
             for flip in floating_ips:
@@ -160,6 +243,9 @@ class OpenStackInterface(object):
                 neutron.delete_port(port)
         if security_groups is not None:
             for sec_grp in security_groups:
+                if sec_grp == \
+                        cfg.CONF.lbaas_settings.management_security_group:
+                    continue
                 neutron.delete_security_group(sec_grp)
 
     def vapv_exists(self, hostname):
@@ -234,11 +320,17 @@ class OpenStackInterface(object):
                     identifier=None):
         if identifier is None and security_group is None:
             raise Exception("Must specify either security_group or identifier")
+        # Management ports of standby instances are created without an lb
+        tenant_id = lb.tenant_id if lb is not None else self.lbaas_project_id
+        # Single instances can use a management port from the reserve
+        if mgmt_port is True and cluster is False and security_group is None:
+            reserved = self.mgmt_reserve.claim_port(hostname)
+            if reserved is not None:
+                return reserved
         # Gather parameters and create the port
         neutron = self.get_neutron_client()
         if mgmt_port is False:
-            subnet = neutron.show_subnet(lb.vip_subnet_id)
-            network_id = subnet['subnet']['network_id']
+            network_id = self.get_network_for_subnet(lb.vip_subnet_id)
         else:
             network_id = cfg.CONF.lbaas_settings.management_network
         port_config = {"port": {
@@ -254,22 +346,24 @@ class OpenStackInterface(object):
         port = neutron.create_port(port_config)['port']
         # Create or assign the appropriate security group to the port
         if create_floating_ip is True:
-            floatingip = self.create_floatingip(port['id'])
+            floatingip = self.mgmt_reserve.claim_floatingip(port['id'])
+            if floatingip is None:
+                floatingip = self.create_floatingip(port['id'])
             mgmt_ip = floatingip['floatingip']['floating_ip_address']
             if security_group is None:
                 sec_grp = self.create_lb_security_group(
-                    lb.tenant_id, identifier, mgmt_port=True, cluster=cluster
+                    tenant_id, identifier, mgmt_port=True, cluster=cluster
                 )
                 security_group = sec_grp['security_group']['id']
         else:
             if security_group is None:
                 if mgmt_port is False:
                     sec_grp = self.create_lb_security_group(
-                        lb.tenant_id, identifier
+                        tenant_id, identifier
                     )
                 else:
                     sec_grp = self.create_lb_security_group(
-                        lb.tenant_id, identifier, mgmt_port=True,
+                        tenant_id, identifier, mgmt_port=True,
                         mgmt_label=True, cluster=cluster
                     )
                 security_group = sec_grp['security_group']['id']
@@ -456,33 +550,49 @@ class OpenStackInterface(object):
         Removes access to a given port from a security group.
         """
         neutron = self.get_neutron_client()
-        # Only block the port if not in use by another listener hosted on
-        # the same vAPV
+        # Only block the port if not in use by a listener of another
+        # loadbalancer hosted on the same vAPV
         if force is False:
-            # Get all listeners belonging to this tenant that use this port
-            listeners = neutron.list_listeners(
-                tenant_id=lb.tenant_id,
-                protocol_port=port
-            )['listeners']
-            # Create a counter of instances of port for each vAPV identifier
-            identifier_port_counter = {}
-            processed_lbs = []  # Only count each LB once as they don't allow
-                                # duplicate ports
+            # A shared vAPV hosts the loadbalancers of several tenants,
+            # which are those placed on it
+            session = db_api.get_admin_session()
+            placement = self.placement_db.get(session, identifier=identifier)
+            if placement is not None:
+                shared_lb_ids = set(
+                    shared['loadbalancer_id']
+                    for shared in self.placement_db.get_by_hostname(
+                        session, placement['hostname']
+                    )
+                )
+                listeners = neutron.list_listeners(
+                    protocol_port=port
+                )['listeners']
+            else:
+                shared_lb_ids = None
+                # Get all listeners belonging to this tenant that use this
+                # port
+                listeners = neutron.list_listeners(
+                    tenant_id=lb.tenant_id,
+                    protocol_port=port
+                )['listeners']
+            processed_lbs = [lb.id]  # Only count each other LB once as they
+                                     # don't allow duplicate ports
             for listener in listeners:
                 for loadbalancer in listener['loadbalancers']:
                     if loadbalancer['id'] in processed_lbs:
                         continue
                     processed_lbs.append(loadbalancer['id'])
-                    tmp_lb = neutron.show_loadbalancer(loadbalancer['id'])
-                    tmp_lb_id = self.get_identifier(tmp_lb['loadbalancer'])
-                    try:
-                        identifier_port_counter[tmp_lb_id] += 1
-                    except KeyError:
-                        identifier_port_counter[tmp_lb_id] = 1
-            # If there is more than one listener on this vAPV using the
-            # port, exit the function without removing it from sec group
-            if identifier_port_counter[identifier] > 1:
-                return False
+                    if shared_lb_ids is not None:
+                        in_use = loadbalancer['id'] in shared_lb_ids
+                    else:
+                        tmp_lb = neutron.show_loadbalancer(loadbalancer['id'])
+                        in_use = self.get_identifier(
+                            tmp_lb['loadbalancer']
+                        ) == identifier
+                    # If another loadbalancer on this vAPV uses the port,
+                    # exit the function without removing it from sec group
+                    if in_use:
+                        return False
         # Get the name of the security group for the "loadbalancer"
         sec_grp_name = "lbaas-{}".format(identifier)
         # Get the security group
@@ -518,6 +628,14 @@ class OpenStackInterface(object):
             return hashlib.sha1(
                 "{}-{}".format(subnet_id, tenant_id)
             ).hexdigest()
+        elif deployment_model == "SHARED":
+            # Shared vAPVs are chosen by the scheduler, so the identifier
+            # is whatever was recorded when the loadbalancer was placed
+            placement = self.placement_db.get(
+                db_api.get_admin_session(), loadbalancer_id=loadbalancer_id
+            )
+            if placement is not None:
+                return placement['identifier']
 
     def create_floatingip(self, port_id):
         neutron = self.get_neutron_client()
@@ -530,10 +648,37 @@ class OpenStackInterface(object):
         return neutron.create_floatingip(floatingip_data)
 
     def get_network_for_subnet(self, subnet_id):
+        return self.get_subnet_info(subnet_id)['network_id']
+
+    def get_subnet_info(self, subnet_id):
+        """
+        Returns the cached metadata of a subnet as a dict with the keys
+        cidr, netmask, network_id, gateway_ip and gateway_mac. The gateway
+        MAC is only looked up by get_subnet_gateway.
+        """
+        return self.subnet_cache.get_or_load(
+            subnet_id, lambda: self._load_subnet_info(subnet_id)
+        )
+
+    def _load_subnet_info(self, subnet_id):
         neutron = self.get_neutron_client()
-        return neutron.show_subnet(subnet_id)['subnet']['network_id']
+        subnet = neutron.show_subnet(subnet_id)['subnet']
+        return {
+            "cidr": subnet['cidr'],
+            "netmask": self.get_netmask(subnet['cidr']),
+            "network_id": subnet['network_id'],
+            "gateway_ip": subnet['gateway_ip'],
+            "gateway_mac": None
+        }
 
-    def create_server(self, tenant_id, hostname, nics, avoid_host_of=None):
+    def invalidate_subnet(self, subnet_id=None):
+        """
+        Drops cached metadata for a subnet, or for all subnets.
+        """
+        self.subnet_cache.invalidate(subnet_id)
+
+    def create_server(self, tenant_id, hostname, nics, avoid_host_of=None,
+                      availability_zone=None, server_group=None):
         """
         Creates a Nova instance of the vAPV image.
         """
@@ -552,7 +697,9 @@ class OpenStackInterface(object):
             "config_drive": True
         }}
         specify_az = self._get_setting(tenant_id,"lbaas_settings","specify_az")
-        if specify_az is True:
+        if availability_zone is not None:
+            body['server']['availability_zone'] = availability_zone
+        elif specify_az is True:
             if hostname.endswith("-sec"):
                 body['server']['availability_zone'] = \
                 self._get_setting(tenant_id,"lbaas_settings","secondary_az")
@@ -563,6 +710,8 @@ class OpenStackInterface(object):
             body['os:scheduler_hints'] = {
                 "different_host": [avoid_host_of]
             }
+        if server_group is not None:
+            body['os:scheduler_hints'] = {"group": server_group}
         try:
             LOG.debug("will create the server(%s): %s", body, self.nova_endpoint)
             response = requests.post(
@@ -616,6 +765,54 @@ class OpenStackInterface(object):
                     port_id, server_id, response.text
             ))
 
+    def get_server_flavor(self, server_id):
+        """
+        Returns the ID (or, with newer Nova microversions, the name) of the
+        flavor of a Nova instance.
+        """
+        flavor = self.get_server(server_id)['flavor']
+        return flavor.get('id', flavor.get('original_name'))
+
+    def resize_server(self, server_id, flavor_id):
+        """
+        Resizes a Nova instance to another flavor and confirms the resize.
+        The instance is restarted.
+        """
+        self._server_action(server_id, {"resize": {"flavorRef": flavor_id}})
+        self._await_status(server_id, "VERIFY_RESIZE")
+        self._server_action(server_id, {"confirmResize": None})
+        self._await_status(server_id, "ACTIVE")
+
+    def _server_action(self, server_id, action):
+        token = self.get_auth_token()
+        response = requests.post(
+            "{}/servers/{}/action".format(self.nova_endpoint, server_id),
+            data=json.dumps(action),
+            headers={"X-Auth-Token": token, "Content-Type": "application/json"}
+        )
+        if response.status_code >= 300:
+            raise Exception(
+                "Action {} on instance '{}' failed: {}".format(
+                    action.keys()[0], server_id, response.text
+            ))
+
+    def _await_status(self, server_id, status, timeout=1800):
+        deadline = time() + timeout
+        while True:
+            current = self.get_server(server_id)['status']
+            if current == status:
+                return
+            if current == 'ERROR':
+                raise Exception(
+                    "Instance '{}' went into ERROR state".format(server_id)
+                )
+            if time() > deadline:
+                raise Exception(
+                    "Timed out waiting for instance '{}' to become {}".format(
+                        server_id, status
+                    ))
+            sleep(10)
+
     def get_mgmt_ip(self, hostname):
         neutron = self.get_neutron_client()
         mgmt_net = neutron.show_network(
@@ -671,6 +868,61 @@ class OpenStackInterface(object):
         except Exception:
             raise ServerNotFoundError(hostname=hostname)
 
+    def create_server_group(self, name, policy="anti-affinity"):
+        """
+        Creates a Nova server group and returns its ID.
+        """
+        token = self.get_auth_token()
+        response = requests.post(
+            "{}/os-server-groups".format(self.nova_endpoint),
+            data=json.dumps(
+                {"server_group": {"name": name, "policies": [policy]}}
+            ),
+            headers={"X-Auth-Token": token, "Content-Type": "application/json"}
+        )
+        if response.status_code != 200:
+            raise Exception(
+                "Unable to create server group '{}': {}".format(
+                    name, response.text
+            ))
+        return response.json()['server_group']['id']
+
+    def get_server_group_id(self, name):
+        token = self.get_auth_token()
+        response = requests.get(
+            "{}/os-server-groups".format(self.nova_endpoint),
+            headers={"X-Auth-Token": token}
+        )
+        for server_group in response.json().get('server_groups', []):
+            if server_group['name'] == name:
+                return server_group['id']
+        return None
+
+    def delete_server_group(self, server_group_id):
+        token = self.get_auth_token()
+        requests.delete(
+            "{}/os-server-groups/{}".format(
+                self.nova_endpoint, server_group_id
+            ),
+            headers={"X-Auth-Token": token}
+        )
+
+    def rename_server(self, server_id, hostname):
+        """
+        Changes the name of a Nova instance.
+        """
+        token = self.get_auth_token()
+        response = requests.put(
+            "{}/servers/{}".format(self.nova_endpoint, server_id),
+            data=json.dumps({"server": {"name": hostname}}),
+            headers={"X-Auth-Token": token, "Content-Type": "application/json"}
+        )
+        if response.status_code != 200:
+            raise Exception(
+                "Unable to rename instance '{}' to '{}': {}".format(
+                    server_id, hostname, response.text
+            ))
+
     def delete_server(self, server_id):
         """
         Deletes a Nova instance.
@@ -682,16 +934,24 @@ class OpenStackInterface(object):
         )
 
     def get_subnet_gateway(self, subnet_id):
-        neutron = self.get_neutron_client()
-        subnet = neutron.show_subnet(subnet_id)['subnet']
-        ports = neutron.list_ports(network_id=subnet['network_id'])['ports']
-        for port in ports:
-            for fixed_ip in port['fixed_ips']:
-                if fixed_ip['ip_address'] == subnet['gateway_ip']:
-                    return (subnet['gateway_ip'], port['mac_address'])
-        return (None, None)
+        subnet = self.get_subnet_info(subnet_id)
+        if subnet['gateway_ip'] and subnet['gateway_mac'] is None:
+            # Only fetch the port that owns the gateway address
+            neutron = self.get_neutron_client()
+            ports = neutron.list_ports(
+                network_id=subnet['network_id'],
+                fixed_ips=["ip_address={}".format(subnet['gateway_ip'])]
+            )['ports']
+            for port in ports:
+                for fixed_ip in port['fixed_ips']:
+                    if fixed_ip['ip_address'] == subnet['gateway_ip']:
+                        subnet['gateway_mac'] = port['mac_address']
+        if subnet['gateway_mac'] is None:
+            return (None, None)
+        return (subnet['gateway_ip'], subnet['gateway_mac'])
 
     def get_neutron_client(self):
+        from neutronclient.neutron import client as neutron_client
         auth_token = self.get_auth_token(lbaas_project=False)
         neutron = neutron_client.Client(
             '2.0', endpoint_url=self.neutron_endpoint, token=auth_token
@@ -730,9 +990,7 @@ class OpenStackInterface(object):
         return keystone_client.auth_token
 
     def get_subnet_netmask(self, subnet_id):
-        neutron = self.get_neutron_client()
-        subnet = neutron.show_subnet(subnet_id)['subnet']
-        return self.get_netmask(subnet['cidr'])
+        return self.get_subnet_info(subnet_id)['netmask']
 
     def get_netmask(self, cidr):
         mask = int(cidr.split("/")[1])
@@ -740,13 +998,5 @@ class OpenStackInterface(object):
         return socket.inet_ntoa(pack('>I', bits))
 
     def _get_setting(self, tenant_id, section, param):
-        setting = None
-        if self.customizations_db:
-            setting = self.customizations_db.get_customization(
-                tenant_id, section, param
-            )
-        if setting is None:
-            global_section = getattr(cfg.CONF, section)
-            setting = getattr(global_section, param)
-        return setting
+        return self.tenant_settings.get(tenant_id, section, param)
 
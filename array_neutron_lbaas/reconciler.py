@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.array import adc_config
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+from concurrency import PeriodicWorker
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Reconciler(object):
+    """
+    Periodically checks the running config of the vAPVs against Neutron
+    and repairs the configuration objects (virtual services, groups,
+    reals, health checks and policies) that have drifted, e.g. because a
+    vAPV rebooted without saving its config or was edited by hand.
+
+    Two checksums are kept per object in the array_config_checksum table:
+    one of the commands rendered from Neutron and one of the object's lines
+    in the running config when it was last known to be in sync. As the
+    running config need not echo the commands verbatim, an object has
+    drifted when its lines are missing, when they changed although Neutron
+    did not, or when Neutron changed but they did not. Only drifted objects
+    (and the objects that their repair removes) are pushed again.
+
+    Each run checks at most reconcile_max_vapvs vAPVs, least recently
+    checked first, and repairs at most reconcile_max_repairs objects on
+    each. Drift is only logged unless reconcile_repair is set.
+    """
+
+    def __init__(self, driver):
+        settings = cfg.CONF.lbaas_settings
+        self.driver = driver
+        self.checksum_db = repository.ArrayConfigChecksumRepository()
+        self.interval = settings.reconcile_interval
+        self.enabled = bool(self.interval)
+        self.max_vapvs = settings.reconcile_max_vapvs
+        self.max_repairs = settings.reconcile_max_repairs
+        self.repair = settings.reconcile_repair
+        self.worker = None
+
+    def start(self):
+        self.worker = PeriodicWorker(
+            self.reconcile, self.interval, name="vapv-reconciler"
+        )
+        self.worker.start()
+
+    def reconcile(self):
+        context = db_api.get_admin_context()
+        # Loadbalancers with changes in flight are left to the driver
+        loadbalancers = [
+            lb for lb in self.driver.get_loadbalancers(context)
+            if lb.provisioning_status == "ACTIVE"
+        ]
+        vapvs = self.driver.get_vapv_loadbalancers(context, loadbalancers)
+        checked = 0
+        # Never checked first, then least recently checked
+        for vapv, lbs in sorted(
+                vapvs.values(),
+                key=lambda item: (item[0].get('reconciled_at') is not None,
+                                  item[0].get('reconciled_at'))):
+            if checked >= self.max_vapvs:
+                break
+            if not vapv['pri_mgmt_address']:
+                continue
+            # Also stops other neutron-server workers checking the vAPV
+            if not self.driver.array_amphora_db.mark_reconciled(
+                    context.session, vapv['hostname'], self.interval):
+                continue
+            checked += 1
+            try:
+                self._reconcile_vapv(context, vapv, lbs)
+            except Exception as e:
+                LOG.error("\nError reconciling vAPV {}: {}".format(
+                    vapv['hostname'], e
+                ))
+        # Forget vAPVs that have been deleted
+        self.checksum_db.delete_hostnames_except(context.session, [
+            vapv['hostname']
+            for vapv in self.driver.array_amphora_db.find_vapvs(
+                context.session
+            )
+        ])
+
+    def _reconcile_vapv(self, context, vapv, lbs):
+        hostname = vapv['hostname']
+        running_config = self.driver.array_vapv_driver.get_running_config(
+            vapv
+        )
+        if running_config is None:
+            LOG.warning("\nCould not read the running config of vAPV "
+                        "{}".format(hostname))
+            return
+        objects = []
+        for lb in lbs:
+            objects.extend(self.driver._render_configuration(lb))
+        records = self.checksum_db.get_by_hostname(context.session, hostname)
+        in_sync = {}
+        drifted = set()
+        for obj in objects:
+            expected = adc_config.checksum(
+                adc_config.split_lines(obj.commands)
+            )
+            lines = adc_config.find_lines(running_config, obj)
+            device = adc_config.checksum(lines) if lines else None
+            record = records.get(obj.key)
+            if device is None:
+                drifted.add(obj.key)
+            elif record is None or record['device'] is None:
+                # First sight of the object, or first check after a repair
+                in_sync[obj.key] = (expected, device)
+            elif record['expected'] != expected:
+                if device == record['device']:
+                    # The change never reached the vAPV
+                    drifted.add(obj.key)
+                else:
+                    in_sync[obj.key] = (expected, device)
+            elif device != record['device']:
+                drifted.add(obj.key)
+            else:
+                in_sync[obj.key] = (expected, device)
+        # Repairing an object removes it first, and with it its children
+        repairs = []
+        for obj in objects:
+            if obj.key in drifted or drifted.intersection(obj.parents):
+                drifted.add(obj.key)
+                repairs.append(obj)
+        for key, (expected, device) in in_sync.iteritems():
+            if key not in drifted and (
+                    key not in records or
+                    records[key]['expected'] != expected or
+                    records[key]['device'] != device):
+                self.checksum_db.save(
+                    context.session, hostname, key, expected, device
+                )
+        self.checksum_db.delete_stale(
+            context.session, hostname, [obj.key for obj in objects]
+        )
+        if not repairs:
+            return
+        LOG.warning("\nConfiguration of vAPV {} has drifted: {}".format(
+            hostname, ", ".join(obj.key for obj in repairs)
+        ))
+        if self.repair:
+            self._repair(context, vapv, self._limit(repairs))
+
+    def _limit(self, repairs):
+        """
+        Returns at most max_repairs of the repairs, in order. A parent is
+        only repaired with all the children that its removal takes away,
+        so whole subtrees are kept or left for a later run; the first is
+        kept even if it is larger than max_repairs.
+        """
+        # Subtree of each object: objects sharing a repaired parent (a
+        # policy has two) belong to the same one
+        subtree = {}
+        for obj in repairs:
+            roots = set(
+                subtree[parent] for parent in obj.parents
+                if parent in subtree
+            )
+            root = min(roots) if roots else obj.key
+            for key, value in subtree.items():
+                if value in roots:
+                    subtree[key] = root
+            subtree[obj.key] = root
+        sizes = {}
+        for root in subtree.values():
+            sizes[root] = sizes.get(root, 0) + 1
+        kept = set()
+        count = 0
+        for obj in repairs:
+            root = subtree[obj.key]
+            if root in kept:
+                continue
+            if count and count + sizes[root] > self.max_repairs:
+                continue
+            kept.add(root)
+            count += sizes[root]
+        return [obj for obj in repairs if subtree[obj.key] in kept]
+
+    def _repair(self, context, vapv, repairs):
+        commands = []
+        for obj in reversed(repairs):
+            commands.extend(obj.undo)
+        for obj in repairs:
+            commands.extend(obj.commands)
+        self.driver.array_vapv_driver.run_commands(vapv, commands)
+        # The lines of the repaired objects are read on the next check
+        for obj in repairs:
+            self.checksum_db.save(
+                context.session, vapv['hostname'], obj.key,
+                adc_config.checksum(adc_config.split_lines(obj.commands)),
+                None
+            )
+        LOG.info("\nRepaired {} on vAPV {}".format(
+            ", ".join(obj.key for obj in repairs), vapv['hostname']
+        ))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+from concurrency import run_with_limit
+from functools import partial
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class FleetResync(object):
+    """
+    Pushes the configuration of the loadbalancers of this provider back to
+    their vAPVs, e.g. to recover after an outage.
+
+    The loadbalancers of a vAPV are pushed as one list of commands followed
+    by a single write memory, split into at most max_per_vapv batches that
+    run at the same time; at most max_parallel batches run at the same time
+    overall. Recovery time therefore grows with the number of vAPVs rather
+    than the number of loadbalancers. With force, objects are removed
+    before they are created again, which interrupts their traffic.
+    """
+
+    def __init__(self, driver, max_parallel=10, max_per_vapv=1, force=False,
+                 progress=None):
+        self.driver = driver
+        self.checksum_db = repository.ArrayConfigChecksumRepository()
+        self.max_parallel = max(1, max_parallel)
+        self.max_per_vapv = max(1, max_per_vapv)
+        self.force = force
+        # progress(done, total, hostname, loadbalancer_ids, error)
+        self.progress = progress
+
+    def run(self, context, loadbalancer_ids=None, hostnames=None):
+        """
+        Resyncs the loadbalancers (all of them unless loadbalancer_ids or
+        hostnames is given) and returns the batches that failed, and the
+        loadbalancers whose vAPV has no record, as a list of
+        (hostname, [loadbalancer_id, ...], error).
+        """
+        loadbalancers = [
+            lb for lb in self.driver.get_loadbalancers(context)
+            if not lb.provisioning_status.startswith("PENDING_") and
+            (not loadbalancer_ids or lb.id in loadbalancer_ids)
+        ]
+        unresolved = []
+        vapvs = self.driver.get_vapv_loadbalancers(
+            context, loadbalancers, unresolved
+        )
+        batches = []
+        for hostname, (vapv, lbs) in sorted(vapvs.iteritems()):
+            if hostnames and hostname not in hostnames:
+                continue
+            count = min(self.max_per_vapv, len(lbs))
+            for index in xrange(count):
+                batches.append((index, vapv, lbs[index::count]))
+        # The first batch of every vAPV goes before the second of any
+        batches.sort(key=lambda batch: batch[0])
+        done = [0]
+
+        def finished(index, result, error):
+            done[0] += 1
+            if self.progress is not None:
+                vapv, lbs = batches[index][1:]
+                self.progress(
+                    done[0], len(batches), vapv['hostname'],
+                    [lb.id for lb in lbs], error
+                )
+
+        results, errors = run_with_limit(
+            [
+                partial(self._push, vapv, lbs)
+                for _, vapv, lbs in batches
+            ],
+            self.max_parallel, finished
+        )
+        failures = []
+        # Without a vAPV record there is nothing to push to
+        unresolved_hostnames = {}
+        for lb in unresolved:
+            hostname = self.driver._get_record_hostname(
+                self.driver._get_hostname(lb)
+            )
+            if not hostnames or hostname in hostnames:
+                unresolved_hostnames.setdefault(hostname, []).append(lb.id)
+        for hostname, lb_ids in sorted(unresolved_hostnames.iteritems()):
+            failures.append(
+                (hostname, lb_ids, "No vAPV record; not resynced")
+            )
+        for (_, vapv, lbs), error in zip(batches, errors):
+            if error is not None:
+                failures.append(
+                    (vapv['hostname'], [lb.id for lb in lbs], error)
+                )
+        return failures
+
+    def _push(self, vapv, lbs):
+        objects = []
+        for lb in lbs:
+            objects.extend(self.driver._render_configuration(lb))
+        commands = []
+        if self.force:
+            for obj in reversed(objects):
+                commands.extend(obj.undo)
+        for obj in objects:
+            commands.extend(obj.commands)
+        LOG.info("\nResyncing {} loadbalancers on vAPV {}".format(
+            len(lbs), vapv['hostname']
+        ))
+        self.driver.array_vapv_driver.run_commands(vapv, commands)
+        # Let the reconciler take new checksums of the vAPV's config
+        # (batches run in their own threads, so each needs its own session)
+        self.checksum_db.delete_stale(
+            db_api.get_admin_session(), vapv['hostname'], []
+        )
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from oslo_config import cfg
+
+
+class LoadWeigher(object):
+    """
+    Scores the live load of a vAPV from the samples of a StatsCollector.
+
+    The load is the weighted mean of the current connections and the
+    throughput, each as a fraction of what one vAPV is expected to
+    handle. A vAPV whose load leaves less than placement_headroom spare
+    is hot.
+    """
+
+    def __init__(self, stats):
+        settings = cfg.CONF.lbaas_settings
+        self.stats = stats
+        self.connections_weight = settings.placement_connections_weight
+        self.throughput_weight = settings.placement_throughput_weight
+        self.max_connections = settings.vapv_max_connections
+        self.max_throughput = settings.vapv_max_throughput
+        self.headroom = settings.placement_headroom
+
+    def load(self, vapv):
+        """
+        Returns the load of the vAPV, 0 if it is idle or there is no
+        recent sample of it.
+        """
+        sample = self.stats.get(vapv['hostname'])
+        total_weight = self.connections_weight + self.throughput_weight
+        if sample is None or not total_weight:
+            return 0.0
+        return (
+            self.connections_weight *
+            float(sample['connections']) / self.max_connections +
+            self.throughput_weight *
+            float(sample['throughput']) / self.max_throughput
+        ) / total_weight
+
+    def is_hot(self, vapv):
+        return self.load(vapv) > 1 - self.headroom
+
+
+class BinPackingScheduler(object):
+    """
+    Chooses the shared vAPV that a new loadbalancer is placed on.
+
+    Each vAPV has a capacity in loadbalancers, listeners, members and
+    bandwidth. Candidates that still have room are tried fullest first
+    (best fit), so that loadbalancers are packed onto as few vAPVs as
+    possible and emptied vAPVs can be destroyed. With a LoadWeigher, hot
+    vAPVs are skipped and equally full candidates are tried least loaded
+    first.
+    """
+
+    def __init__(self, weigher=None):
+        settings = cfg.CONF.lbaas_settings
+        self.weigher = weigher
+        self.max_loadbalancers = settings.shared_max_loadbalancers
+        self.max_listeners = settings.shared_max_listeners
+        self.max_members = settings.shared_max_members
+        self.max_bandwidth = settings.shared_max_bandwidth
+
+    def fits(self, vapv, bandwidth=0):
+        """
+        Returns True if a loadbalancer needing bandwidth can be added to
+        the vAPV. A limit of 0 means unlimited.
+        """
+        if vapv['in_use_lb'] >= self.max_loadbalancers:
+            return False
+        if self.max_listeners and \
+                vapv['listener_count'] >= self.max_listeners:
+            return False
+        if self.max_members and vapv['member_count'] >= self.max_members:
+            return False
+        if self.max_bandwidth and \
+                vapv['bandwidth'] + bandwidth > self.max_bandwidth:
+            return False
+        return True
+
+    def utilization(self, vapv):
+        """
+        Returns the fraction (0 to 1) of the vAPV's scarcest resource that
+        is in use.
+        """
+        usage = [float(vapv['in_use_lb']) / self.max_loadbalancers]
+        for count, limit in [
+                (vapv['listener_count'], self.max_listeners),
+                (vapv['member_count'], self.max_members),
+                (vapv['bandwidth'], self.max_bandwidth)]:
+            if limit:
+                usage.append(float(count) / limit)
+        return max(usage)
+
+    def rank(self, candidates, bandwidth=0):
+        """
+        Returns the candidates that can take a loadbalancer needing
+        bandwidth, in the order in which they should be tried.
+        """
+        candidates = [
+            vapv for vapv in candidates if self.fits(vapv, bandwidth)
+        ]
+        if self.weigher is None:
+            return sorted(candidates, key=self.utilization, reverse=True)
+        candidates = [
+            vapv for vapv in candidates if not self.weigher.is_hot(vapv)
+        ]
+        return sorted(
+            candidates,
+            key=lambda vapv: (-self.utilization(vapv), self.weigher.load(vapv))
+        )
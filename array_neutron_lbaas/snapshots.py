@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.array import adc_config
+from array_neutron_lbaas.array.apv_driver import CLUSTER_PRIORITY_PRIMARY
+from array_neutron_lbaas.array.apv_driver import CLUSTER_PRIORITY_SECONDARY
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+from concurrency import PeriodicWorker
+import json
+from oslo_config import cfg
+from oslo_log import log as logging
+from threading import Lock
+from time import time
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between checks for vAPVs whose snapshot is due
+SNAPSHOT_POLL_INTERVAL = 5
+
+
+class ConfigSnapshots(object):
+    """
+    Keeps versioned snapshots of the configuration rendered from Neutron
+    for each vAPV, so that a rebuilt instance can be restored with one
+    bulk push instead of object by object.
+
+    A snapshot holds the settings of each instance (traffic interface
+    address, bandwidth and HA cluster) and the objects of the vAPV's
+    loadbalancers. It is taken snapshot_delay seconds after the last
+    change saved on a vAPV, so a burst of changes yields a single
+    snapshot. Snapshots are stored zlib-compressed in the
+    array_config_snapshot table, keyed by the vAPV record, so the two
+    instances of an HA pair share them. A snapshot identical to the
+    previous version is not stored, and only the newest snapshot_versions
+    versions are kept.
+    """
+
+    def __init__(self, driver):
+        settings = cfg.CONF.lbaas_settings
+        self.driver = driver
+        self.snapshot_db = repository.ArrayConfigSnapshotRepository()
+        self.delay = settings.snapshot_delay
+        self.enabled = bool(self.delay)
+        self.versions = max(1, settings.snapshot_versions)
+        self.pending = {}
+        self.worker = None
+        self._lock = Lock()
+
+    def start(self):
+        self.driver.array_vapv_driver.add_listener(self.changed)
+        self.worker = PeriodicWorker(
+            self.poll, SNAPSHOT_POLL_INTERVAL, name="vapv-config-snapshots"
+        )
+        self.worker.start()
+
+    def changed(self, vapv):
+        # Each change pushes the snapshot back
+        with self._lock:
+            self.pending[vapv['hostname']] = time() + self.delay
+
+    def poll(self):
+        now = time()
+        with self._lock:
+            due = [
+                hostname for hostname, due_time in self.pending.iteritems()
+                if due_time <= now
+            ]
+            for hostname in due:
+                del self.pending[hostname]
+        if not due:
+            return
+        context = db_api.get_admin_context()
+        for hostname in due:
+            vapv = self.driver.array_amphora_db.get_vapv_by_hostname(
+                context.session, hostname
+            )
+            if vapv is None:
+                continue
+            try:
+                # Only the loadbalancers of the due vAPV are loaded
+                self.take(context, vapv, [
+                    lb for lb in self.driver.get_hosted_loadbalancers(
+                        context, vapv
+                    ) if lb.provisioning_status != "PENDING_DELETE"
+                ])
+            except Exception as e:
+                LOG.error("\nError taking a snapshot of vAPV {}: {}".format(
+                    hostname, e
+                ))
+        # Forget vAPVs that have been deleted
+        self.snapshot_db.delete_hostnames_except(context.session, [
+            vapv['hostname']
+            for vapv in self.driver.array_amphora_db.find_vapvs(
+                context.session
+            )
+        ])
+
+    def take(self, context, vapv, lbs):
+        """
+        Stores a snapshot of the configuration of the vAPV's instances and
+        of the loadbalancers on it.
+
+        :returns: the new version, or None if the configuration has not
+                  changed since the latest snapshot.
+        """
+        content = {
+            "instances": self._render_instances(vapv, lbs),
+            "commands": []
+        }
+        for lb in lbs:
+            for obj in self.driver._render_configuration(lb):
+                content['commands'].extend(obj.commands)
+        lines = content['commands'] + [
+            command for commands in content['instances']
+            for command in commands
+        ]
+        version = self.snapshot_db.add_version(
+            context.session, vapv['hostname'], adc_config.checksum(lines),
+            zlib.compress(json.dumps(content)), self.versions
+        )
+        if version is not None:
+            LOG.debug("\nSnapshot {} of vAPV {} taken: {} commands".format(
+                version, vapv['hostname'], len(lines)
+            ))
+        return version
+
+    def _render_instances(self, vapv, lbs):
+        # The settings of each instance, primary first: its traffic
+        # interface address, bandwidth and, for HA pairs, cluster
+        connector = self.driver.openstack_connector
+        netmask = connector.get_subnet_netmask(vapv['subnet_id'])
+        bandwidth = 0
+        if lbs:
+            bandwidth = self.driver._get_instance_bandwidth(lbs[0])
+        clustered = bool(vapv.get('sec_mgmt_address'))
+        vip_addresses = sorted(lb.vip_address for lb in lbs)
+        instances = []
+        for hostname, priority in zip(
+                self.driver._get_instance_hostnames(vapv),
+                [CLUSTER_PRIORITY_PRIMARY, CLUSTER_PRIORITY_SECONDARY]):
+            data_ip = None
+            for port in connector.get_server_ports(hostname):
+                for fixed_ip in port['fixed_ips']:
+                    if fixed_ip['subnet_id'] == vapv['subnet_id']:
+                        data_ip = fixed_ip['ip_address']
+            instances.append(adc_config.render_instance(
+                data_ip, netmask, bandwidth,
+                priority if clustered else None, vip_addresses
+            ))
+        return instances
+
+    def restore(self, context, hostname, version=None, management_ip=None):
+        """
+        Pushes a snapshot (by default the latest) to the instances of a
+        vAPV, one bulk push each. management_ip may name the instances to
+        restore, e.g. only the rebuilt member of an HA pair.
+
+        :returns: the version that was restored.
+        """
+        vapv = self.driver.array_amphora_db.get_vapv_by_hostname(
+            context.session, hostname
+        )
+        if vapv is None:
+            raise Exception("No vAPV record found for {}".format(hostname))
+        if version is None:
+            snapshot = self.snapshot_db.get_latest(context.session, hostname)
+        else:
+            snapshot = self.snapshot_db.get(
+                context.session, hostname=hostname, version=version
+            )
+        if snapshot is None:
+            raise Exception("No snapshot of vAPV {} found".format(hostname))
+        content = zlib.decompress(snapshot['content'])
+        try:
+            content = json.loads(content)
+        except ValueError:
+            # Snapshots taken before the instance settings were included
+            content = {"instances": [], "commands": content.splitlines()}
+        members = [vapv['pri_mgmt_address'], vapv.get('sec_mgmt_address')]
+        if management_ip is None:
+            management_ip = [address for address in members if address]
+        for address in management_ip:
+            instance = []
+            if address in members and \
+                    members.index(address) < len(content['instances']):
+                instance = content['instances'][members.index(address)]
+            else:
+                LOG.warning(
+                    "\n{} is not a recorded instance of vAPV {}; restoring "
+                    "its loadbalancers only".format(address, hostname)
+                )
+            self.driver.array_vapv_driver.run_commands(
+                vapv, instance + content['commands'], [address]
+            )
+        LOG.info("\nvAPV {} restored from snapshot {}".format(
+            hostname, snapshot['version']
+        ))
+        return snapshot['version']
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import repository
+import os
+from oslo_config import cfg
+from oslo_log import log as logging
+import socket
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between checks of a spawn lock held by another worker
+LOCK_POLL_INTERVAL = 1
+# Seconds between refreshes of a spawn lock by the worker holding it
+LOCK_REFRESH_INTERVAL = 30
+# Seconds after which a spawn lock that has not been refreshed is taken to
+# be left by a dead worker
+STALE_LOCK_AGE = 300
+
+
+class SpawnRegistry(object):
+    """
+    Makes sure that a given vAPV is only spawned once when several
+    loadbalancers that share it are created concurrently.
+
+    Requests in the same process wait on the in-flight spawn of the first
+    request. Across neutron-server workers, the spawning worker holds a
+    row in the array_spawn_lock table until the spawn has finished, and
+    refreshes it meanwhile, so that however long the spawn takes, the lock
+    only goes stale if the worker dies.
+    """
+
+    def __init__(self):
+        self.lock_db = repository.ArraySpawnLockRepository()
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self._in_flight = {}
+        self._in_flight_lock = Lock()
+
+    def run_once(self, hostname, exists, spawn):
+        """
+        Calls spawn() unless exists() reports that the vAPV is already
+        there. If another request is spawning the same vAPV, waits for it
+        to finish instead; should that spawn fail, this request spawns it.
+
+        :returns: True if this call spawned the vAPV, otherwise False.
+        """
+        if not isinstance(hostname, basestring):
+            hostname = hostname[0]
+        timeout = cfg.CONF.lbaas_settings.spawn_lock_timeout
+        while True:
+            if exists():
+                return False
+            with self._in_flight_lock:
+                in_flight = self._in_flight.get(hostname)
+                if in_flight is None:
+                    done = self._in_flight[hostname] = Event()
+            if in_flight is not None:
+                LOG.debug("\nWaiting for in-flight spawn of {}".format(
+                    hostname
+                ))
+                in_flight.wait(timeout)
+                if not in_flight.is_set():
+                    raise Exception(
+                        "Timed out waiting for vAPV {} to be spawned".format(
+                            hostname
+                        )
+                    )
+                continue
+            try:
+                return self._run_locked(hostname, exists, spawn, timeout)
+            finally:
+                with self._in_flight_lock:
+                    del self._in_flight[hostname]
+                done.set()
+
+    def _run_locked(self, hostname, exists, spawn, timeout):
+        session = db_api.get_admin_session()
+        deadline = time() + timeout
+        while not self.lock_db.acquire(session, hostname, self.owner):
+            # Another worker is spawning the vAPV
+            if self.lock_db.break_stale(session, hostname, STALE_LOCK_AGE):
+                LOG.warning("\nBroke stale spawn lock on {}".format(hostname))
+                continue
+            if time() > deadline:
+                raise Exception(
+                    "Timed out waiting for vAPV {} to be spawned by another "
+                    "worker".format(hostname)
+                )
+            sleep(LOCK_POLL_INTERVAL)
+        stop = Event()
+        refresher = Thread(
+            target=self._refresh_lock, args=(hostname, stop),
+            name="vapv-spawn-lock"
+        )
+        refresher.daemon = True
+        refresher.start()
+        try:
+            if exists():
+                return False
+            spawn()
+            return True
+        finally:
+            stop.set()
+            self.lock_db.release(session, hostname, self.owner)
+
+    def _refresh_lock(self, hostname, stop):
+        session = db_api.get_admin_session()
+        while not stop.wait(LOCK_REFRESH_INTERVAL):
+            try:
+                self.lock_db.refresh(session, hostname, self.owner)
+            except Exception as e:
+                LOG.error("\nError refreshing spawn lock on {}: {}".format(
+                    hostname, e
+                ))
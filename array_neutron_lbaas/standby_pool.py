@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.concurrency import PeriodicWorker
+from array_neutron_lbaas.db import api as db_api
+from array_neutron_lbaas.db import models
+from array_neutron_lbaas.db import repository
+import datetime
+import os
+from oslo_config import cfg
+from oslo_log import log as logging
+import socket
+from threading import Lock
+from uuid import uuid4
+
+LOG = logging.getLogger(__name__)
+
+STANDBY_HOSTNAME_PREFIX = "vapv-standby-"
+# array_spawn_lock row held by the worker adding instances to the pool
+REFILL_LOCK = "standby-pool-refill"
+# Seconds after which a refill lock is taken to be left by a dead worker
+REFILL_LOCK_MAX_AGE = 300
+
+
+class StandbyPool(object):
+    """
+    Keeps a reserve of pre-booted, unassigned vAPV instances in the LBaaS
+    project. Claiming an instance only requires a data port on the tenant
+    subnet to be attached, so loadbalancer creation does not have to wait
+    for a Nova boot.
+    """
+
+    def __init__(self, openstack_connector):
+        self.openstack_connector = openstack_connector
+        self.standby_db = repository.ArrayStandbyVapvRepository()
+        self.lock_db = repository.ArraySpawnLockRepository()
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.refiller = None
+        self._refill_lock = Lock()
+        self.enabled = self._is_supported()
+
+    def _is_supported(self):
+        settings = cfg.CONF.lbaas_settings
+        if not any(self.targets().values()):
+            return False
+        if settings.deploy_ha_pairs is True:
+            LOG.warning("\nvAPV standby pool is not supported with HA pairs")
+            return False
+        if settings.management_mode != "MGMT_NET":
+            LOG.warning(
+                "\nvAPV standby pool requires the MGMT_NET management mode"
+            )
+            return False
+        return True
+
+    def targets(self):
+        """
+        Returns a dict of {availability_zone: number of standby instances}.
+        An availability zone of None lets Nova choose.
+        """
+        az_targets = cfg.CONF.lbaas_settings.standby_pool_az_targets
+        if az_targets:
+            return {az: int(count) for az, count in az_targets.iteritems()}
+        return {None: cfg.CONF.lbaas_settings.standby_pool_size}
+
+    def start(self):
+        self.refiller = PeriodicWorker(
+            self.refill, cfg.CONF.lbaas_settings.standby_pool_refill_interval,
+            name="vapv-standby-pool"
+        )
+        self.refiller.start()
+
+    def claim(self, hostname, lb, identifier):
+        """
+        Takes a standby instance out of the pool and turns it into the vAPV
+        for the given loadbalancer. Returns the ports dict in the same form
+        as a freshly spawned instance, or None if no suitable standby
+        instance is available.
+        """
+        if not self._is_default_build(lb.tenant_id):
+            return None
+        session = db_api.get_admin_session()
+        availability_zone = self._get_az(lb.tenant_id)
+        if availability_zone is not None:
+            record = self.standby_db.claim(
+                session, availability_zone=availability_zone
+            )
+        else:
+            record = self.standby_db.claim(session)
+        if record is None:
+            LOG.debug("\nvAPV standby pool is empty; spawning {}".format(
+                hostname
+            ))
+            return None
+        data_port = None
+        security_group = None
+        try:
+            data_port, security_group, junk = \
+                self.openstack_connector.create_port(
+                    lb, hostname, identifier=identifier
+                )
+            self.openstack_connector.attach_port_to_instance(
+                record['server_id'], data_port['id']
+            )
+            self.openstack_connector.rename_server(
+                record['server_id'], hostname
+            )
+            neutron = self.openstack_connector.get_neutron_client()
+            mgmt_port = neutron.show_port(record['mgmt_port_id'])['port']
+        except Exception as e:
+            LOG.error("\nError claiming standby vAPV {}: {}".format(
+                record['hostname'], e
+            ))
+            # The instance may be half-configured, so it is not returned
+            # to the pool.
+            self.openstack_connector.clean_up(
+                instances=[record['server_id']],
+                ports=[data_port['id']] if data_port else None,
+                security_groups=[security_group] if security_group else None
+            )
+            self.standby_db.delete(session, id=record['id'])
+            self.wake_refiller()
+            return None
+        self.standby_db.delete(session, id=record['id'])
+        self.wake_refiller()
+        LOG.info("\nStandby vAPV {} claimed as {}".format(
+            record['hostname'], hostname
+        ))
+        return {"data": data_port, "mgmt": mgmt_port}
+
+    def wake_refiller(self):
+        if self.refiller is not None:
+            self.refiller.wake()
+
+    def refill(self):
+        """
+        Boots standby instances until every availability zone target is
+        met. Instances that are still booting count towards the target.
+        The missing instances are counted and recorded as BUILDING under
+        the REFILL_LOCK row, so that several workers do not overfill the
+        pool; a worker that finds the lock taken leaves the refill to the
+        holder.
+        """
+        with self._refill_lock:
+            session = db_api.get_admin_session()
+            self._remove_stale(session)
+            if not self.lock_db.acquire_or_break(
+                    session, REFILL_LOCK, self.owner, REFILL_LOCK_MAX_AGE):
+                return
+            records = []
+            try:
+                for az, target in self.targets().iteritems():
+                    missing = target - self.standby_db.count(
+                        session, availability_zone=az
+                    )
+                    for _ in xrange(missing):
+                        records.append(self._add_standby(session, az))
+            finally:
+                self.lock_db.release(session, REFILL_LOCK, self.owner)
+            for record in records:
+                self._boot_standby(session, record)
+
+    def _add_standby(self, session, availability_zone):
+        return self.standby_db.create(
+            session,
+            hostname="{}{}".format(
+                STANDBY_HOSTNAME_PREFIX, uuid4().hex[:12]
+            ),
+            status=models.RESERVE_BUILDING,
+            availability_zone=availability_zone,
+            created_at=datetime.datetime.utcnow()
+        )
+
+    def _boot_standby(self, session, record):
+        hostname = record['hostname']
+        identifier = hostname[len(STANDBY_HOSTNAME_PREFIX):]
+        availability_zone = record['availability_zone']
+        mgmt_port = None
+        security_group = None
+        server_id = None
+        try:
+            mgmt_port, security_group, mgmt_ip = \
+                self.openstack_connector.create_port(
+                    None, hostname, mgmt_port=True, identifier=identifier
+                )
+            self.standby_db.update(
+                session, record['id'], mgmt_port_id=mgmt_port['id'],
+                mgmt_address=mgmt_ip
+            )
+            server = self.openstack_connector.create_server(
+                tenant_id=self.openstack_connector.lbaas_project_id,
+                hostname=hostname,
+                nics=[{"port": mgmt_port['id']}],
+                availability_zone=availability_zone
+            )
+            server_id = server['id']
+            self.standby_db.update(session, record['id'], server_id=server_id)
+            self.openstack_connector._await_build_complete(server_id)
+        except Exception as e:
+            LOG.error("\nError booting standby vAPV {}: {}".format(
+                hostname, e
+            ))
+            self.openstack_connector.clean_up(
+                instances=[server_id] if server_id else None,
+                ports=[mgmt_port['id']] if mgmt_port else None,
+                security_groups=[security_group] if security_group else None
+            )
+            self.standby_db.delete(session, id=record['id'])
+            return
+        self.standby_db.update(
+            session, record['id'], status=models.RESERVE_READY
+        )
+        LOG.info("\nStandby vAPV {} ready".format(hostname))
+
+    def _remove_stale(self, session):
+        timeout = cfg.CONF.lbaas_settings.standby_pool_build_timeout
+        for record in self.standby_db.get_stale(session, timeout):
+            LOG.warning("\nRemoving stale standby vAPV {}".format(
+                record['hostname']
+            ))
+            try:
+                self.openstack_connector.clean_up(
+                    instances=[record['server_id']]
+                    if record['server_id'] else None,
+                    ports=[record['mgmt_port_id']]
+                    if record['mgmt_port_id'] else None
+                )
+            except Exception as e:
+                LOG.error(e)
+            self.standby_db.delete(session, id=record['id'])
+
+    def _get_az(self, tenant_id):
+        if cfg.CONF.lbaas_settings.standby_pool_az_targets and \
+                self.openstack_connector._get_setting(
+                    tenant_id, "lbaas_settings", "specify_az") is True:
+            return self.openstack_connector._get_setting(
+                tenant_id, "lbaas_settings", "primary_az"
+            )
+        return None
+
+    def _is_default_build(self, tenant_id):
+        # Standby instances are booted from the global image and flavor, so
+        # tenants with customized ones always get a fresh instance.
+        for param in ["image_id", "flavor_id"]:
+            setting = self.openstack_connector._get_setting(
+                tenant_id, "lbaas_settings", param
+            )
+            if setting != getattr(cfg.CONF.lbaas_settings, param):
+                return False
+        return True
+
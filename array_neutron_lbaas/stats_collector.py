@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from array_neutron_lbaas.db import api as db_api
+from concurrency import ParallelExecutionError, PeriodicWorker, \
+    run_in_parallel
+from functools import partial
+from oslo_config import cfg
+from oslo_log import log as logging
+from threading import Lock
+from time import time
+
+LOG = logging.getLogger(__name__)
+
+# Number of vAPVs queried at the same time
+COLLECTION_PARALLELISM = 10
+# Samples older than this many collection intervals are ignored
+SAMPLE_MAX_AGE_INTERVALS = 3
+
+
+class StatsCollector(object):
+    """
+    Periodically reads the connection, traffic and CPU counters of every
+    vAPV and keeps the most recent sample of each in memory: the number of
+    current connections, the CPU utilization, and the throughput in Mbps
+    worked out from the byte counters of two consecutive reads.
+    """
+
+    def __init__(self, array_vapv_driver, array_amphora_db):
+        self.array_vapv_driver = array_vapv_driver
+        self.array_amphora_db = array_amphora_db
+        self.interval = cfg.CONF.lbaas_settings.stats_collection_interval
+        self.enabled = bool(self.interval)
+        self.samples = {}
+        self.collector = None
+        self._lock = Lock()
+
+    def start(self):
+        self.collector = PeriodicWorker(
+            self.collect, self.interval, name="vapv-stats-collector"
+        )
+        self.collector.start()
+
+    def get(self, hostname):
+        """
+        Returns the latest sample of the vAPV as a dict with the keys
+        connections, throughput and cpu (None if the vAPV does not report
+        it), or None if there is no recent one.
+        """
+        with self._lock:
+            sample = self.samples.get(hostname)
+        if sample is None or sample['throughput'] is None:
+            return None
+        if time() - sample['timestamp'] > \
+                self.interval * SAMPLE_MAX_AGE_INTERVALS:
+            return None
+        return sample
+
+    def collect(self):
+        vapvs = [
+            vapv for vapv in self.array_amphora_db.find_vapvs(
+                db_api.get_admin_session()
+            ) if vapv['pri_mgmt_address']
+        ]
+        for start in xrange(0, len(vapvs), COLLECTION_PARALLELISM):
+            chunk = vapvs[start:start + COLLECTION_PARALLELISM]
+            try:
+                counters = run_in_parallel([
+                    partial(self.array_vapv_driver.get_stats, vapv)
+                    for vapv in chunk
+                ])
+            except ParallelExecutionError as e:
+                LOG.warning("\nError collecting vAPV statistics: {}".format(e))
+                counters = e.results
+            for vapv, vapv_counters in zip(chunk, counters):
+                if vapv_counters is not None:
+                    self._record(vapv['hostname'], vapv_counters)
+        # Forget vAPVs that have been deleted
+        hostnames = set(vapv['hostname'] for vapv in vapvs)
+        with self._lock:
+            for hostname in self.samples.keys():
+                if hostname not in hostnames:
+                    del self.samples[hostname]
+
+    def _record(self, hostname, counters):
+        now = time()
+        total_bytes = counters['bytes_in'] + counters['bytes_out']
+        with self._lock:
+            previous = self.samples.get(hostname)
+            throughput = None
+            if previous is not None and now > previous['timestamp'] and \
+                    total_bytes >= previous['total_bytes']:
+                throughput = (
+                    (total_bytes - previous['total_bytes']) * 8 /
+                    (now - previous['timestamp']) / 1000000
+                )
+            elif previous is not None:
+                # The counters were reset, e.g. by a reboot
+                throughput = previous['throughput']
+            self.samples[hostname] = {
+                "connections": counters['connections'],
+                "cpu": counters.get('cpu'),
+                "throughput": throughput,
+                "total_bytes": total_bytes,
+                "timestamp": now
+            }
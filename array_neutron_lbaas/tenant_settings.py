@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+
+from cache import TTLCache
+from oslo_config import cfg
+from oslo_log import log as logging
+from threading import Lock
+from time import time
+
+LOG = logging.getLogger(__name__)
+
+
+class TenantSettings(object):
+    """
+    Resolves settings that may be customized per tenant, falling back to
+    the global configuration.
+
+    Each tenant's customizations are loaded with a single query and cached.
+    Changes made through this process's helper invalidate the tenant
+    straight away; changes made elsewhere (e.g. with the
+    array_lbaas_tenant_customization tool) are detected by checking the
+    customizations version at most every customization_version_interval
+    seconds.
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self.cache = TTLCache(cfg.CONF.lbaas_settings.customization_cache_ttl)
+        self._version = None
+        self._version_checked = 0
+        self._version_lock = Lock()
+        if cfg.CONF.lbaas_settings.allow_tenant_customizations is True:
+            from array_neutron_lbaas_customizations_db import helper \
+                as customization_helper
+            self.helper = customization_helper.\
+                ArrayLbaasTenantCustomizationsDatabaseHelper(
+                    cfg.CONF.lbaas_settings.tenant_customizations_db,
+                    pool_size=cfg.CONF.lbaas_settings.
+                    customizations_db_pool_size,
+                    max_overflow=cfg.CONF.lbaas_settings.
+                    customizations_db_max_overflow
+                )
+            self.helper.add_listener(self._customization_changed)
+        else:
+            self.helper = None
+
+    def add_listener(self, callback):
+        """
+        Registers callback(tenant_id, section, parameter) to be called when
+        customizations change. All three are None when the change was made
+        by another process and the affected tenant is not known.
+        """
+        self.listeners.append(callback)
+
+    def get(self, tenant_id, section, param):
+        setting = None
+        if self.helper is not None:
+            self.helper._validate_setting(section, param)
+            setting = self.get_all(tenant_id).get(section, {}).get(param)
+        if setting is None:
+            global_section = getattr(cfg.CONF, section)
+            setting = getattr(global_section, param)
+        return setting
+
+    def get_all(self, tenant_id):
+        """
+        Returns {section: {parameter: value}} of the tenant's
+        customizations, or None if customizations are disabled.
+        """
+        if self.helper is None:
+            return None
+        self._check_version()
+        return self.cache.get_or_load(
+            tenant_id,
+            lambda: self.helper.get_all_tenant_customizations(tenant_id)
+        )
+
+    def _check_version(self):
+        interval = cfg.CONF.lbaas_settings.customization_version_interval
+        if time() - self._version_checked < interval:
+            return
+        with self._version_lock:
+            if time() - self._version_checked < interval:
+                return
+            version = self.helper.get_version()
+            self._version_checked = time()
+            if version is None or version == self._version:
+                return
+            if self._version is not None:
+                LOG.debug("\nTenant customizations changed; clearing cache")
+                self.cache.invalidate()
+                self._notify(None, None, None)
+            self._version = version
+
+    def _customization_changed(self, tenant_id, section, parameter):
+        self.cache.invalidate(tenant_id)
+        self._notify(tenant_id, section, parameter)
+
+    def _notify(self, tenant_id, section, parameter):
+        for callback in self.listeners:
+            callback(tenant_id, section, parameter)
@@ -15,9 +15,11 @@
 #
 #
 
+from contextlib import contextmanager
 import models
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
 class ArrayLbaasTenantCustomizationsDatabaseHelper(object):
@@ -32,88 +34,167 @@ class ArrayLbaasTenantCustomizationsDatabaseHelper(object):
             "secondary_az",
             "specify_az",
             "image_id",
-            "flavor_id"
+            "flavor_id",
+            "autoscale_enabled",
+            "autoscale_high_threshold",
+            "autoscale_low_threshold",
+            "autoscale_periods",
+            "autoscale_cooldown",
+            "autoscale_flavors"
         ],
         "vapv_settings": [
             "nameservers"
         ],
         "services_director_settings": [
             "bandwidth",
+            "listener_bandwidth",
             "feature_pack"
         ]
     }
 
-    def __init__(self, db_path):
-        self.engine = create_engine(db_path, pool_recycle=300)
-        session_maker = sessionmaker(bind=self.engine)
-        self.db = session_maker()
+    def __init__(self, db_path, pool_size=5, max_overflow=10):
+        engine_args = {"pool_recycle": 300}
+        if not db_path.startswith("sqlite"):
+            # Test connections before use so that a DB restart does not
+            # surface as an error on the next provisioning request
+            engine_args.update({
+                "pool_size": pool_size,
+                "max_overflow": max_overflow,
+                "pool_pre_ping": True
+            })
+        self.engine = create_engine(db_path, **engine_args)
+        # The helper is used from the API workers and from provisioning
+        # threads at the same time, so each thread gets its own session
+        self.db = scoped_session(sessionmaker(bind=self.engine))
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """
+        Registers callback(tenant_id, section, parameter) to be called
+        whenever a customization is set or deleted through this helper.
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, tenant_id, section, parameter):
+        for callback in self.listeners:
+            callback(tenant_id, section, parameter)
+
+    @contextmanager
+    def _session(self):
+        """
+        Yields the calling thread's session and returns its connection to
+        the pool afterwards, as provisioning threads are short-lived.
+        """
+        try:
+            yield self.db()
+        finally:
+            self.db.remove()
 
     def create_table(self):
         models.BaseTable.metadata.create_all(self.engine)
 
     def get_all_tenant_customizations(self, tenant_id):
-        customizations = self.db.query(
-            models.ArrayLbaasTenantCustomizations
-        ).\
-            filter_by(tenant_id=tenant_id).\
-            all()
+        model = models.ArrayLbaasTenantCustomizations
+        with self._session() as db:
+            # Read-only: fetch plain rows rather than ORM instances
+            customizations = db.query(
+                model.config_section, model.parameter, model.value
+            ).\
+                filter(model.tenant_id == tenant_id).\
+                all()
         results = {}
-        for record in customizations:
+        for section, parameter, value in customizations:
             try:
-                results[record.config_section][record.parameter] = record.value
+                results[section][parameter] = value
             except KeyError:
-                results[record.config_section] = {
-                    record.parameter: record.value
-                }
+                results[section] = {parameter: value}
         return results
 
     def get_customization(self, tenant_id, section, parameter):
         self._validate_setting(section, parameter)
-        try:
-            customization = self.db.query(
-                models.ArrayLbaasTenantCustomizations
-            ).\
-                filter_by(tenant_id=tenant_id).\
-                filter_by(config_section=section).\
-                filter_by(parameter=parameter).\
-                one()
-        except NoResultFound:
-            return None
-        return customization.value
+        model = models.ArrayLbaasTenantCustomizations
+        with self._session() as db:
+            return db.query(model.value).\
+                filter(model.tenant_id == tenant_id).\
+                filter(model.config_section == section).\
+                filter(model.parameter == parameter).\
+                scalar()
 
     def set_customization(self, tenant_id, section, parameter, value):
         self._validate_setting(section, parameter)
-        try:
-            customization = self.db.query(
-                models.ArrayLbaasTenantCustomizations
-            ).\
-                filter_by(tenant_id=tenant_id).\
-                filter_by(config_section=section).\
-                filter_by(parameter=parameter).\
-                one()
-            customization.value = value
-        except NoResultFound:
-            self.db.add(models.ArrayLbaasTenantCustomizations(
-                tenant_id=tenant_id,
-                config_section=section,
-                parameter=parameter,
-                value=value
-            ))
-        self.db.commit()
+        with self._session() as db:
+            try:
+                customization = db.query(
+                    models.ArrayLbaasTenantCustomizations
+                ).\
+                    filter_by(tenant_id=tenant_id).\
+                    filter_by(config_section=section).\
+                    filter_by(parameter=parameter).\
+                    one()
+                customization.value = value
+            except NoResultFound:
+                db.add(models.ArrayLbaasTenantCustomizations(
+                    tenant_id=tenant_id,
+                    config_section=section,
+                    parameter=parameter,
+                    value=value
+                ))
+            self._bump_version(db)
+            db.commit()
+        self._notify(tenant_id, section, parameter)
 
     def delete_customization(self, tenant_id, section, parameter):
+        with self._session() as db:
+            try:
+                customization = db.query(
+                    models.ArrayLbaasTenantCustomizations
+                ).\
+                    filter_by(tenant_id=tenant_id).\
+                    filter_by(config_section=section).\
+                    filter_by(parameter=parameter).\
+                    one()
+                db.delete(customization)
+                self._bump_version(db)
+                db.commit()
+            except NoResultFound:
+                return False
+        self._notify(tenant_id, section, parameter)
+
+    def get_version(self):
+        """
+        Returns the customizations version, which changes whenever any
+        customization is set or deleted, or None if the version table has
+        not been created.
+        """
+        with self._session() as db:
+            try:
+                version = db.query(
+                    models.ArrayLbaasTenantCustomizationsVersion.version
+                ).\
+                    filter_by(uid=1).\
+                    scalar()
+            except SQLAlchemyError:
+                db.rollback()
+                return None
+        return version or 0
+
+    def _bump_version(self, db):
+        # A savepoint, so that a database without the version table (see
+        # get_version) still saves the customization itself
         try:
-            customization = self.db.query(
-                models.ArrayLbaasTenantCustomizations
-            ).\
-                filter_by(tenant_id=tenant_id).\
-                filter_by(config_section=section).\
-                filter_by(parameter=parameter).\
-                one()
-            self.db.delete(customization)
-            self.db.commit()
-        except NoResultFound:
-            return False
+            with db.begin_nested():
+                updated = db.query(
+                    models.ArrayLbaasTenantCustomizationsVersion
+                ).\
+                    filter_by(uid=1).\
+                    update({"version": models.
+                            ArrayLbaasTenantCustomizationsVersion.version + 1})
+                if not updated:
+                    db.add(models.ArrayLbaasTenantCustomizationsVersion(
+                        uid=1, version=1
+                    ))
+        except SQLAlchemyError:
+            pass
 
     def _validate_setting(self, section, parameter):
         try:
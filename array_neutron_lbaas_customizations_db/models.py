@@ -57,3 +57,15 @@ class ArrayLbaasTenantCustomizations(BaseTable):
             self.uid, self.tenant_id, self.config_section, 
             self.parameter, self.value
         )
+
+
+class ArrayLbaasTenantCustomizationsVersion(BaseTable):
+
+    __bind_key__ = "arraylbaastenantcust"
+    __tablename__ = "array_lbaas_tenant_customizations_version"
+
+    """ Single row; the version is bumped on every customization change. """
+    uid = Column(Integer, primary_key=True)
+
+    """ Incremented whenever any tenant customization is set or deleted. """
+    version = Column(Integer, nullable=False, default=0)
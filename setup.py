@@ -16,6 +16,9 @@ setup(
         "scripts/array_lbaas_config_generator",
         "scripts/array_lbaas_init_db",
         "scripts/array_lbaas_init_network",
+        "scripts/array_lbaas_migrate",
+        "scripts/array_lbaas_resync",
+        "scripts/array_lbaas_snapshot",
         "scripts/array_lbaas_tenant_customization"
     ],
     data_files=[
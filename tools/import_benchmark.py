@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""
+Times the import of the driver entry point in fresh interpreters and checks
+that the heavy client libraries are not loaded by it.
+
+Usage (from the top of the source tree, in the neutron-server environment):
+
+# python tools/import_benchmark.py [--budget SECONDS] [--runs N]
+
+Exits with status 1 if the median import time exceeds the budget or if a
+deferred module was imported.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULE = "array_neutron_lbaas.driver.driver_v2"
+# Only needed once the driver is instantiated or a feature is used
+DEFERRED_MODULES = (
+    "array_neutron_lbaas.driver_common",
+    "array_neutron_lbaas_customizations_db",
+    "keystoneclient",
+    "neutron_lbaas.common.cert_manager",
+    "neutron_lbaas.common.tls_utils",
+    "neutronclient",
+)
+
+CHILD = """
+import json, sys, time
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+deferred = %r
+print(json.dumps({
+    "elapsed": elapsed,
+    "loaded": sorted(set(
+        prefix for prefix in deferred for name in list(sys.modules)
+        if name == prefix or name.startswith(prefix + ".")
+    ))
+}))
+"""
+
+
+def run_once(root):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [root, env.get("PYTHONPATH")])
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD % (MODULE, DEFERRED_MODULES)], env=env
+    )
+    return json.loads(output.decode("utf8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="Maximum median import time in seconds")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Number of fresh interpreters to time")
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    results = [run_once(root) for _ in range(args.runs)]
+    timings = sorted(result["elapsed"] for result in results)
+    median = timings[len(timings) // 2]
+    loaded = sorted(set(
+        name for result in results for name in result["loaded"]
+    ))
+    print("import %s: best %.3fs, median %.3fs, worst %.3fs (%d runs)" % (
+        MODULE, timings[0], median, timings[-1], len(timings)
+    ))
+    failed = False
+    if median > args.budget:
+        print("FAIL: median exceeds the budget of %.3fs" % args.budget)
+        failed = True
+    if loaded:
+        print("FAIL: deferred modules were imported: %s" % ", ".join(loaded))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""
+Compares ArrayAmphora.to_dict with the former attribute-walking serializer
+over a large inventory of records, as loaded by an inventory refresh.
+
+Usage (from the top of the source tree, in the neutron-server environment):
+
+# python tools/serializer_benchmark.py [--records N] [--repeat N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+from uuid import uuid4
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from array_neutron_lbaas.db.models import ArrayAmphora  # noqa
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def legacy_to_dict(self, **kwargs):
+    # ArrayModelBase.to_dict before it was driven by the mapped columns
+    ret = {}
+    for attr in self.__dict__:
+        if attr.startswith('_') or not kwargs.get(attr, True):
+            continue
+        if isinstance(getattr(self, attr), list):
+            ret[attr] = []
+            for item in self.__dict__[attr]:
+                ret[attr] = item
+        elif isinstance(self.__dict__[attr], text_type):
+            ret[attr.encode('utf8')] = self.__dict__[attr].encode('utf8')
+        else:
+            ret[attr] = self.__dict__[attr]
+    return ret
+
+
+def make_records(count):
+    now = datetime.utcnow()
+    return [
+        ArrayAmphora(
+            id=text_type(uuid4()),
+            tenant_id=text_type(uuid4().hex),
+            in_use_lb=index % 50,
+            subnet_id=text_type(uuid4()),
+            pri_mgmt_address=text_type("10.0.%d.%d" % (index // 250, index % 250)),
+            sec_mgmt_address=None,
+            hostname=text_type("vapv-%s" % uuid4().hex[:12]),
+            listener_count=index % 200,
+            member_count=index % 1000,
+            bandwidth=0,
+            scaled_at=None,
+            reconciled_at=now
+        )
+        for index in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--records", type=int, default=10000,
+                        help="Number of vAPV records to serialize")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed scans; the best is reported")
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    # Warm up the per-class column cache, as the first real call would
+    records[0].to_dict()
+
+    timings = {}
+    for name, serialize in (("legacy", legacy_to_dict),
+                            ("columns", ArrayAmphora.to_dict)):
+        timings[name] = min(timeit.repeat(
+            lambda: [serialize(record) for record in records],
+            number=1, repeat=args.repeat
+        ))
+        print("%-8s %8.1f ms for %d records (%.2f us each)" % (
+            name, timings[name] * 1000, args.records,
+            timings[name] * 1e6 / args.records
+        ))
+    print("speedup  %8.2fx" % (timings["legacy"] / timings["columns"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())